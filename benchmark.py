@@ -0,0 +1,436 @@
+import sys
+import os
+import socket
+import select
+import time
+import hashlib
+import heapq
+import queue
+import json
+import random
+import tempfile
+import threading
+import multiprocessing
+import file_transfer as ft
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where CPU time and peak RSS aren't reported.
+    resource = None
+
+# Number of times each operation is repeated per measurement.
+iterations = 200000
+chunk_size = 1024
+# FilePkts sent per sendmmsg call, as with the default --batch.
+send_batch_size = 64
+# Transfer benchmark defaults.
+transfer_sizes = '1M,16M' # File sizes sent, comma separated.
+transfer_chunk_sizes = '1024,8192' # Chunk sizes tried for every size.
+transfer_window = 64
+# Extra seconds a reordered datagram is held back, so datagrams sent
+# after it overtake it.
+reorder_delay = 0.005
+# Socket buffer size of the proxy, so it doesn't drop datagrams itself.
+proxy_buffer_size = 8*1024*1024
+# Seconds the receiver gets to bind its socket before the sender starts.
+recv_start_time = 0.3
+# Seconds a transfer may take before it's given up.
+transfer_timeout = 300
+
+# The FilePkt/FilePktAck codec as it was before it moved to
+# struct.Struct, kept here so the microbenchmark has something to
+# compare against. Produces exactly the same bytes.
+def legacy_encode_file_pkt(chunk_no, chunk_data):
+    msg = int.to_bytes(ft.magic_number,1,'little')
+    msg += int.to_bytes(ft.MsgType.FilePkt.value,1,'little')
+    msg_data = int.to_bytes(chunk_no,4,'little')
+    msg_data += int.to_bytes(len(chunk_data),4,'little')
+    msg_data += chunk_data
+    msg += int.to_bytes(len(msg_data),4,'little')
+    msg += msg_data
+    return msg
+
+def legacy_decode_file_pkt(msg):
+    ret = {}
+    msg_type = ft.MsgType._value2member_map_[int.from_bytes(msg[1:2],'little')]
+    chunk_no = int.from_bytes(msg[6:10],'little')
+    chunk_data_size = int.from_bytes(msg[10:14],'little')
+    chunk_data = msg[14:14+chunk_data_size]
+    ret = {'chunk_no':chunk_no,'chunk_data':chunk_data}
+    ret['msg_type'] = msg_type
+    return ret
+
+def legacy_encode_file_pkt_ack(chunk_no, chunk_data_checksum):
+    msg = int.to_bytes(ft.magic_number,1,'little')
+    msg += int.to_bytes(ft.MsgType.FilePktAck.value,1,'little')
+    msg_data = int.to_bytes(chunk_no,4,'little')
+    msg_data += int.to_bytes(len(chunk_data_checksum),4,'little')
+    msg_data += chunk_data_checksum
+    msg += int.to_bytes(len(msg_data),4,'little')
+    msg += msg_data
+    return msg
+
+# Runs func(i) for every i in range(iterations) and returns how many
+# calls per second that came to.
+def measure(func):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    return iterations/(time.perf_counter()-start)
+
+def print_result(name, before, after):
+    print(f'{name:<24} before: {before:>12,.0f} pkts/s   '
+          f'after: {after:>12,.0f} pkts/s   x{after/before:.2f}')
+
+# Measures packets/sec of the per chunk codec paths, before and after
+# the struct based codec. Sending goes to a local socket that nothing
+# reads from, so it mostly measures the per packet call overhead.
+def bench_codec():
+    chunk_data = bytes(range(256))*(chunk_size//256)
+    checksum = hashlib.md5(chunk_data).digest()
+    file_pkt = legacy_encode_file_pkt(7,chunk_data)
+    file_pkt_view = memoryview(bytearray(file_pkt))
+    file_pkt_buffer = bytearray(ft.file_pkt_header_size+chunk_size)
+    ack_buffer = bytearray(ft.file_pkt_header_size+64)
+
+    print_result('FilePkt encode',
+        measure(lambda i: legacy_encode_file_pkt(i,chunk_data)),
+        measure(lambda i: ft.pack_file_pkt(file_pkt_buffer,i,chunk_data)))
+    print_result('FilePkt decode',
+        measure(lambda i: legacy_decode_file_pkt(file_pkt)),
+        measure(lambda i: ft.decode_file_pkt(file_pkt_view)))
+    print_result('FilePktAck encode',
+        measure(lambda i: legacy_encode_file_pkt_ack(i,checksum)),
+        measure(lambda i: ft.pack_file_pkt_ack(ack_buffer,i,checksum)))
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1',0))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    addr = sink.getsockname()
+    # FilePkts are packed straight into the slots of a DatagramBatch,
+    # as send_chunks does, and the last batch is sent by the last call.
+    batch = ft.DatagramBatch(sock,addr,send_batch_size,
+        ft.file_pkt_header_size+chunk_size,ft.file_pkt_header_size)
+    def batch_send(i):
+        batch.queue_send(ft.pack_file_pkt(batch.send_slot(),i,chunk_data))
+        if i == iterations-1:
+            batch.flush()
+    print_result('FilePkt encode+send',
+        measure(lambda i: sock.sendto(
+            legacy_encode_file_pkt(i,chunk_data),addr)),
+        measure(batch_send))
+    sock.close()
+    sink.close()
+
+# UDP proxy run in a thread of the benchmark process, between sender
+# and receiver, that makes loopback look like a worse link. Every
+# datagram, either way, is dropped with probability loss, sent twice
+# with probability duplicate, and held back delay seconds, plus or
+# minus up to jitter, plus reorder_delay with probability reorder.
+# Jitter alone keeps datagrams in order, like a queue would, so only
+# reorder reorders them. The sender talks to addr_a, and the receiver
+# to addr_b. Counts the datagrams and bytes each way, and FilePkts per
+# chunk number, so retransmits can be told from first sends.
+class ImpairmentProxy:
+    def __init__(self, sender_addr, recvr_addr, delay=0, jitter=0, loss=0,
+        duplicate=0, reorder=0, seed=None):
+        self.sender_addr = sender_addr
+        self.recvr_addr = recvr_addr
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.sock_a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock_a.bind(('127.0.0.1',0))
+        self.sock_b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock_b.bind(('127.0.0.1',0))
+        for sock in (self.sock_a,self.sock_b):
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,proxy_buffer_size)
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,proxy_buffer_size)
+        self.addr_a = self.sock_a.getsockname()
+        self.addr_b = self.sock_b.getsockname()
+        # Datagrams waiting for their delay to pass, as (release time,
+        # sequence number, socket to send from, data, destination).
+        self.queue = []
+        self.seq = 0
+        # Release time of the last datagram that wasn't reordered, for
+        # each way.
+        self.last_release = {}
+        self.counts = {'datagrams_to_recvr':0,'datagrams_to_sender':0,
+            'bytes_to_recvr':0,'bytes_to_sender':0,'dropped':0,
+            'duplicated':0,'reordered':0,'file_pkts':0}
+        self.chunk_nos = set()
+        self.running = True
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def schedule(self, sock, data, addr, now):
+        if self.random.random() < self.loss:
+            self.counts['dropped'] += 1
+            return
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.counts['duplicated'] += 1
+            copies = 2
+        for _ in range(copies):
+            release = max(now+self.delay+self.random.uniform(
+                -self.jitter,self.jitter),self.last_release.get(addr,0),now)
+            if self.random.random() < self.reorder:
+                self.counts['reordered'] += 1
+                release += reorder_delay
+            else:
+                self.last_release[addr] = release
+            heapq.heappush(self.queue,(release,self.seq,sock,data,addr))
+            self.seq += 1
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                sock, data, addr = heapq.heappop(self.queue)[2:]
+                sock.sendto(data,addr)
+            timeout = 0.05
+            if self.queue:
+                timeout = min(max(self.queue[0][0]-now,0),timeout)
+            readable = select.select([self.sock_a,self.sock_b],[],[],
+                timeout)[0]
+            now = time.monotonic()
+            for sock in readable:
+                try:
+                    data = sock.recv(ft.max_datagram_size)
+                except OSError:
+                    continue
+                if sock is self.sock_a:
+                    self.counts['datagrams_to_recvr'] += 1
+                    self.counts['bytes_to_recvr'] += len(data)
+                    if len(data) >= ft.file_pkt_header_size and \
+                        data[1] == ft.file_pkt_type:
+                        self.counts['file_pkts'] += 1
+                        self.chunk_nos.add(ft.decode_file_pkt(data)[0])
+                    self.schedule(self.sock_b,data,self.recvr_addr,now)
+                else:
+                    self.counts['datagrams_to_sender'] += 1
+                    self.counts['bytes_to_sender'] += len(data)
+                    self.schedule(self.sock_a,data,self.sender_addr,now)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock_a.close()
+        self.sock_b.close()
+
+    # FilePkts sent for chunks that had been sent before.
+    def retransmits(self):
+        return self.counts['file_pkts']-len(self.chunk_nos)
+
+# Returns a free UDP port on loopback.
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1',0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+# Returns (CPU seconds, peak RSS in bytes) of this process, or
+# (None, None) where the resource module isn't available.
+def get_usage():
+    if resource is None:
+        return None, None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, and in bytes on macOS.
+    peak_rss = usage.ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return usage.ru_utime+usage.ru_stime, peak_rss
+
+# Runs in a child process for each side of a transfer. Calls func with
+# args and kwargs, with its output thrown away, and puts (name, wall
+# seconds, CPU seconds, peak RSS, error) on result_queue. The CPU time
+# of starting the process is left out.
+def run_side(name, func, args, kwargs, result_queue):
+    sys.stdout = open(os.devnull,'w')
+    error = None
+    start_cpu_time = get_usage()[0]
+    start = time.perf_counter()
+    try:
+        func(*args,**kwargs)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    elapsed = time.perf_counter()-start
+    cpu_time, peak_rss = get_usage()
+    if cpu_time is not None:
+        cpu_time -= start_cpu_time
+    result_queue.put((name,elapsed,cpu_time,peak_rss,error))
+
+# Sends src_path to dst_path over loopback, with send and recv each in
+# their own process, through an ImpairmentProxy if impairment (its
+# keyword arguments) is given. send_kwargs and recv_kwargs are passed
+# on to send and recv. Returns the metrics of the run as a dict. The
+# processes are spawned, not forked, as a forked child would start out
+# with the benchmark's peak RSS.
+def run_transfer(src_path, dst_path, chunk_size, send_kwargs, recv_kwargs,
+    impairment):
+    sender_addr = ('127.0.0.1',free_port())
+    recvr_addr = ('127.0.0.1',free_port())
+    proxy = None
+    # Each side talks to the proxy instead of the other side.
+    send_to_addr, recv_from_addr = recvr_addr, sender_addr
+    if impairment is not None:
+        proxy = ImpairmentProxy(sender_addr,recvr_addr,**impairment)
+        send_to_addr, recv_from_addr = proxy.addr_a, proxy.addr_b
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+    spawn = multiprocessing.get_context('spawn')
+    result_queue = spawn.Queue()
+    recv_process = spawn.Process(target=run_side,args=('recv',
+        ft.recv,(dst_path,recv_from_addr,recvr_addr),recv_kwargs,
+        result_queue))
+    recv_process.start()
+    time.sleep(recv_start_time)
+    send_process = spawn.Process(target=run_side,args=('send',
+        ft.send,(src_path,sender_addr,send_to_addr),
+        dict(send_kwargs,chunk_size=chunk_size),result_queue))
+    send_process.start()
+    sides = {}
+    deadline = time.monotonic()+transfer_timeout
+    while len(sides) < 2 and time.monotonic() < deadline:
+        try:
+            name, *side = result_queue.get(timeout=1)
+            sides[name] = side
+        except queue.Empty:
+            if not send_process.is_alive() and not recv_process.is_alive():
+                break
+    for process in (send_process,recv_process):
+        process.terminate()
+        process.join()
+    if proxy is not None:
+        proxy.close()
+
+    file_size = os.path.getsize(src_path)
+    with open(src_path,'rb') as f:
+        src_checksum = ft.compute_file_checksum(f)
+    ok = os.path.exists(dst_path)
+    if ok:
+        with open(dst_path,'rb') as f:
+            ok = ft.compute_file_checksum(f) == src_checksum
+    chunk_count = -(-file_size//chunk_size)
+    result = {'file_size':file_size,'chunk_size':chunk_size,
+        'chunk_count':chunk_count,'ok':ok,'impairment':impairment}
+    # Throughput is counted from the sender's side, which ends once the
+    # receiver's EOFPkt arrives. The receiver then stays around a
+    # little in case the EOFPkt got lost.
+    if 'send' in sides:
+        elapsed = sides['send'][0]
+        result['seconds'] = elapsed
+        result['mb_per_sec'] = file_size/elapsed/10**6
+    for name in ('send','recv'):
+        if name in sides:
+            elapsed, cpu_time, peak_rss, error = sides[name]
+            result[name] = {'seconds':elapsed,'cpu_seconds':cpu_time,
+                'peak_rss_bytes':peak_rss,'error':error}
+        else:
+            result[name] = {'error':'No result, timed out'}
+    # Without a proxy only the FilePkts a lossless transfer needs are
+    # known.
+    if proxy is not None:
+        result.update(proxy.counts)
+        result['retransmits'] = proxy.retransmits()
+        datagrams = proxy.counts['datagrams_to_recvr']+\
+            proxy.counts['datagrams_to_sender']
+    else:
+        result['retransmits'] = None
+        datagrams = chunk_count
+    if 'seconds' in result:
+        result['packets_per_sec'] = datagrams/result['seconds']
+    return result
+
+# Runs run_transfer for every file size and chunk size in options (see
+# the usage), and prints the results as a JSON list, or writes them to
+# the --output file. Progress goes to stderr.
+def bench_transfer(options):
+    sizes = [ft.parse_rate(size)
+        for size in options.get('sizes',transfer_sizes).split(',')]
+    chunk_sizes = [int(chunk_size) for chunk_size
+        in options.get('chunk-sizes',transfer_chunk_sizes).split(',')]
+    send_kwargs = {
+        'window_size':int(options.get('window',transfer_window)),
+        'ack_mode':ft.AckMode[options.get('ack','sack')],
+        'integrity_mode':ft.IntegrityMode[options.get('integrity','crc32')],
+        'fec_group_size':int(options.get('fec',0)),
+        'compression_mode':ft.CompressionMode[
+            options.get('compression','none')]}
+    recv_kwargs = {}
+    if 'sock-buf' in options:
+        send_kwargs['sock_buffer_size'] = int(options['sock-buf'])
+        recv_kwargs['sock_buffer_size'] = int(options['sock-buf'])
+    if 'rate' in options:
+        send_kwargs['rate'] = options['rate'] if options['rate'] == 'auto' \
+            else ft.parse_rate(options['rate'])
+    impairment = {
+        # Delays are given in milliseconds.
+        'delay':float(options.get('delay',0))/1000,
+        'jitter':float(options.get('jitter',0))/1000,
+        'loss':float(options.get('loss',0)),
+        'duplicate':float(options.get('duplicate',0)),
+        'reorder':float(options.get('reorder',0)),
+        'seed':int(options['seed']) if 'seed' in options else None}
+    if not options.get('proxy',False) and not any(
+        value for name, value in impairment.items() if name != 'seed'):
+        impairment = None
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            src_path = os.path.join(tmp_dir,f'src_{size}.bin')
+            with open(src_path,'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    f.write(os.urandom(min(remaining,ft.read_block_size)))
+                    remaining -= ft.read_block_size
+            for chunk_size in chunk_sizes:
+                print(f'Sending {size} bytes in chunks of {chunk_size}',
+                    file=sys.stderr)
+                result = run_transfer(src_path,
+                    os.path.join(tmp_dir,'dst.bin'),chunk_size,send_kwargs,
+                    recv_kwargs,impairment)
+                results.append(result)
+                print(f'  ok: {result["ok"]}, '
+                    f'{result.get("mb_per_sec",0):.1f} MB/s, '
+                    f'retransmits: {result["retransmits"]}',file=sys.stderr)
+    output = json.dumps(results,indent=2)
+    if 'output' in options:
+        with open(options['output'],'w') as f:
+            f.write(output+'\n')
+    else:
+        print(output)
+    return results
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] == 'help':
+        print('Usage: python benchmark.py codec\n'
+            '       python benchmark.py transfer [options]\n\n'
+            'Transfer options:\n'
+            f'--sizes LIST: File sizes to send, like 1M,16M (default '
+            f'{transfer_sizes})\n'
+            f'--chunk-sizes LIST: Chunk sizes to try for every file size '
+            f'(default {transfer_chunk_sizes})\n'
+            f'--window N, --ack MODE, --integrity MODE, --fec K, '
+            f'--compression MODE, --rate RATE: As for send (default window '
+            f'{transfer_window})\n'
+            '--sock-buf BYTES: Socket buffer size of both sides. With big '
+            'chunks, the default buffers drop much of the window\n'
+            '--delay MS, --jitter MS: Delay added to every datagram, either '
+            'way, plus or minus up to the jitter\n'
+            '--loss P, --duplicate P, --reorder P: Chance of each datagram '
+            'being dropped, sent twice or held back '
+            f'{reorder_delay*1000:g} ms more\n'
+            '--seed N: Seed of the impairments, so runs can be repeated\n'
+            '--proxy: Go through the proxy even without impairments, so '
+            'datagrams and retransmits are counted\n'
+            '--output FILE: Write the JSON results to FILE instead of '
+            'stdout')
+    elif sys.argv[1] == 'codec':
+        bench_codec()
+    elif sys.argv[1] == 'transfer':
+        bench_transfer(ft.parse_options(sys.argv[2:]))
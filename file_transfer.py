@@ -1,11 +1,75 @@
+import os
 import sys
+import errno
 import socket
+import select
+import ctypes
 import math
+import itertools
+import queue
+import collections
+import time
+import mmap
+import zlib
+import struct
+import bisect
+import threading
+import tempfile
 import hashlib
+import json
+import shutil
+import importlib
+import importlib.util
 from enum import Enum
 
+# Stands in for a module that's only imported the first time one of its
+# attributes is used. The import is done under lazy_import_lock, so
+# threads (loopback's receiver, serve's executor, to_thread) that use it
+# for the first time at once all get the whole module.
+# importlib.util.LazyLoader isn't thread safe before Python 3.12.
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            with lazy_import_lock:
+                if self.module is None:
+                    self.module = importlib.import_module(self.name)
+        return getattr(self.module,attr)
+
+lazy_import_lock = threading.Lock()
+
+# Returns a LazyModule for the module called name, or None if it isn't
+# installed.
+def lazy_import(name):
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name)
+
+# Modules that only some modes (or options) use are imported the first
+# time they're used, so importing this script as a library stays cheap.
+# asyncio alone takes longer to import than everything else.
+asyncio = lazy_import('asyncio')
+multiprocessing = lazy_import('multiprocessing')
+futures = lazy_import('concurrent.futures')
+http_server = lazy_import('http.server')
+xxhash = lazy_import('xxhash')
+zstandard = lazy_import('zstandard')
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
 MsgType = Enum('MsgType',[
-    'SendReq','SendAccept','FilePkt','FilePktAck','EOFPkt'])
+    'SendReq','SendAccept','FilePkt','FilePktAck','EOFPkt',
+    'MtuProbe','MtuProbeAck','FecPkt','CopyBlocks','CopyBlocksAck',
+    'SackPkt','NackPkt'])
 ProgState = Enum('ProgState',[
     # Recv mode states
     'AwaitingSendReq','SendingSendAccept','AwaitingFilePkt',
@@ -14,50 +78,616 @@ ProgState = Enum('ProgState',[
     'SendingSendReq','AwaitingSendAccept','SendingFilePkt',
     'AwaitingFilePktAck'
 ])
+# Options that can follow the fixed fields of SendReq and SendAccept.
+# Check docs for msg format.
+MsgOption = Enum('MsgOption',[
+    'IntegrityMode','ChunkSize','FecGroupSize','StreamMap','TransferId',
+    'FileName','MissingChunks','Delta','Compression','Batch','Sack'])
+# How the receiver proves each chunk arrived intact. The checksum it
+# computes over the chunk data is sent back in FilePktAck.
+# md5 is what older versions always use, none sends an empty checksum
+# and relies on the UDP checksum plus the whole file checksum in
+# EOFPkt, blake2b is a 64-bit BLAKE2b digest and xxh64 needs the
+# xxhash package.
+IntegrityMode = Enum('IntegrityMode',['md5','none','crc32','blake2b','xxh64'])
+# How the receiver acks chunks. chunk sends a FilePktAck with the
+# chunk's checksum for every FilePkt, which is all older versions know.
+# sack answers every batch of FilePkts with one SackPkt, and asks for
+# lost chunks with NackPkts.
+AckMode = Enum('AckMode',['chunk','sack'])
+# How the chunk data of FilePkts can be compressed. zlib and lzma come
+# with Python, zstd needs the zstandard package and lz4 the lz4 package.
+CompressionMode = Enum('CompressionMode',['none','zlib','lzma','zstd','lz4'])
+# MsgType and MsgOption members by value, built once, so decoding a msg
+# is a dict lookup instead of a call to the Enum.
+msg_types = {msg_type.value:msg_type for msg_type in MsgType}
+msg_options = {option.value:option for option in MsgOption}
 
 magic_number = 0x1a # Every msg must start with this byte
 sock_timeout = 20   # Seconds before socket times out.
+# Seconds the sender waits for a FilePktAck before it sends that
+# FilePkt again, and for SendAccept before it sends SendReq again,
+# until there are RTT samples to work the timeout out from (RFC 6298).
+# The timeout is then kept between min_rto and max_rto, so a few
+# retries still fit in sock_timeout.
+retransmit_timeout = 1
+min_rto = 0.2
+max_rto = 5
+# Once every chunk of a transfer is in, the receiver sends EOFPkt again
+# to every msg the sender still sends, until none arrive for this many
+# seconds. The sender asks for it again at least twice in that time.
+eof_linger = 2
+# Bytes of file data carried by each FilePkt, unless another chunk
+# size is given. Older versions only know this one.
+file_chunk_size = 1024
+read_block_size = 1024*1024 # Bytes read at a time while hashing a file.
+max_datagram_size = 65507 # Largest UDP payload over IPv4.
+# Status msgs and the progress bar are only printed if verbose is set,
+# which the command line does. Used as a library, transfers are silent.
+verbose = False
+# Progress bar. It's redrawn at most every progress_interval seconds,
+# and not at all in quiet mode (--quiet).
+progress_interval = 0.1
+quiet = False
+last_progress_draw_time = 0
+# Metrics. Upper bounds, in seconds, of the histogram buckets, and the
+# default seconds between the JSON lines of --metrics-file.
+histogram_bounds = [0.00001,0.00003,0.0001,0.0003,0.001,0.003,0.01,0.03,
+    0.1,0.3,1,3,10]
+metrics_interval = 1
+# Candidate path MTUs tried by probe_path_mtu, largest first: jumbo
+# frames, Ethernet, PPPoE, the IPv6 minimum and the IPv4 minimum.
+probe_mtus = [9000,1500,1492,1280,576]
+udp_ip_header_size = 28 # IPv4 header (20) plus UDP header (8).
+probe_timeout = 0.5 # Seconds to wait for MtuProbeAcks in each round.
+probe_rounds = 3    # Rounds of probes sent before giving up.
+# Linux socket options for path MTU discovery. Not every Python
+# version exports them, so fall back to the values from <linux/in.h>.
+IP_MTU_DISCOVER = getattr(socket,'IP_MTU_DISCOVER',10)
+IP_PMTUDISC_WANT = getattr(socket,'IP_PMTUDISC_WANT',1)
+IP_PMTUDISC_DO = getattr(socket,'IP_PMTUDISC_DO',2)
+# Rate control. Rates are in bits per second of whole datagrams,
+# counting the IP and UDP headers.
+rate_burst_time = 0.01 # Seconds worth of sending the token bucket can hold.
+initial_adaptive_rate = 10_000_000 # Rate adaptive mode starts from.
+min_adaptive_rate = 100_000 # Adaptive mode never goes below this.
+# Factor the rate is multiplied by when a chunk is lost.
+loss_decrease = 0.5
+# Factor the rate is multiplied by when the RTT shows a queue building
+# up, which is when it's above delay_threshold times the lowest RTT
+# seen plus delay_margin seconds.
+delay_decrease = 0.85
+delay_threshold = 1.5
+delay_margin = 0.005
+# After a decrease, the rate grows back by this fraction of the rate
+# before the decrease every RTT.
+additive_increase = 1/16
+rtt_gain = 1/8 # Weight of each new sample in the smoothed RTT.
+rttvar_gain = 1/4 # Weight of each new sample in the RTT variation.
+max_streams = 64 # Most streams a parallel transfer can be split into.
+# Seconds between checks on the worker processes of a parallel transfer.
+stream_poll_interval = 0.1
+# Seconds between checks for idle sessions in serve mode.
+session_check_interval = 1
+# Seconds between writes of the chunk journal that lets a transfer be
+# resumed.
+journal_sync_interval = 1
+journal_magic = b'FTJ1' # Every chunk journal file starts with this.
+# Most chunk ranges SendAccept lists in MissingChunks, so it still fits
+# the sender's handshake buffer alongside a full StreamMap. If more
+# chunks than that are missing, ranges close to each other are merged,
+# and a few chunks the receiver already has are sent again.
+max_missing_ranges = 32
+# SACK. A SackPkt holds the receiver's chunk bitmap from the first
+# chunk it's missing on, up to max_sack_bitmap_size bytes (so chunks
+# further on than that aren't acked until the gap is filled). A chunk
+# is taken as lost once nack_reorder chunks after it have arrived, and
+# a NackPkt lists at most max_nack_ranges ranges of them. serve holds
+# its SackPkts back until sack_every chunks are waiting to be acked, or
+# for sack_delay seconds.
+max_sack_bitmap_size = 1024
+nack_reorder = 3
+max_nack_ranges = 64
+sack_every = 32
+sack_delay = 0.002
+# Most runs of blocks one CopyBlocks msg lists in a delta transfer, so
+# it fits in one small datagram. More runs are split over several msgs,
+# and the sender keeps up to copy_blocks_window_size of them in flight.
+copy_runs_per_msg = 64
+copy_blocks_window_size = 16
+# Rolling through changed data for a delta transfer costs the sender
+# about a second of CPU per 3 MB. Once it has looked through
+# delta_probe_size bytes of the file, if less than delta_min_match_rate
+# of them were found in the old copy, it stops and sends every chunk.
+delta_probe_size = 8*1024*1024
+delta_min_match_rate = 0.5
+# FilePkts of block signatures the receiver keeps in flight while
+# sending them to the sender in a delta transfer.
+signature_window_size = 64
+adler32_modulus = 65521 # Largest prime below 2**16.
+# Chunk compression. Chunks are read and compressed by a pool of
+# compression_workers threads, up to compress_ahead chunks ahead of the
+# send loop.
+compression_workers = os.cpu_count() or 1
+compress_ahead = 64
+# After incompressible_streak chunks in a row that don't shrink, the
+# next incompressible_skip_count chunks are sent without trying.
+incompressible_streak = 8
+incompressible_skip_count = 64
+zlib_level = 1 # Fastest, since chunks are compressed on the fly.
+lzma_preset = 1
+
+# Takes a file object opened in binary mode and returns the MD5
+# checksum of its data. The file is read in blocks of read_block_size
+# into one reusable buffer, so memory use stays the same whatever the
+# file size.
+def compute_file_checksum(f):
+    start_time = time.perf_counter()
+    file_checksum = hashlib.md5()
+    buffer = bytearray(read_block_size)
+    buffer_view = memoryview(buffer)
+    f.seek(0)
+    while True:
+        read_size = f.readinto(buffer)
+        if not read_size:
+            break
+        file_checksum.update(buffer_view[:read_size])
+    metrics.observe('hash_seconds',time.perf_counter()-start_time)
+    return file_checksum.digest()
+
+# Returns a function that takes chunk data and returns its checksum
+# for integrity_mode.
+def get_chunk_checksum_func(integrity_mode):
+    match integrity_mode:
+        case IntegrityMode.md5:
+            return lambda chunk_data: hashlib.md5(chunk_data).digest()
+        case IntegrityMode.none:
+            return lambda chunk_data: b''
+        case IntegrityMode.crc32:
+            return lambda chunk_data: \
+                zlib.crc32(chunk_data).to_bytes(4,'little')
+        case IntegrityMode.blake2b:
+            return lambda chunk_data: \
+                hashlib.blake2b(chunk_data,digest_size=8).digest()
+        case IntegrityMode.xxh64:
+            return xxhash.xxh64_digest
+
+def integrity_mode_supported(integrity_mode):
+    return integrity_mode != IntegrityMode.xxh64 or xxhash is not None
+
+# Returns a function that takes chunk data and returns it compressed
+# for compression_mode, or None for none. zlib and lzma data is raw,
+# and zstd and lz4 data leaves out the size, since every byte counts in
+# small chunks.
+def get_compress_func(compression_mode):
+    match compression_mode:
+        case CompressionMode.none:
+            return None
+        case CompressionMode.zlib:
+            return lambda chunk_data: \
+                zlib.compress(chunk_data,zlib_level,wbits=-15)
+        case CompressionMode.lzma:
+            return lambda chunk_data: lzma.compress(chunk_data,
+                format=lzma.FORMAT_RAW,filters=get_lzma_filters())
+        case CompressionMode.zstd:
+            return lambda chunk_data: \
+                zstandard.ZstdCompressor(write_content_size=False).compress(
+                    chunk_data)
+        case CompressionMode.lz4:
+            return lambda chunk_data: \
+                lz4.block.compress(chunk_data,store_size=False)
+
+# Returns a function that takes chunk data compressed for
+# compression_mode and returns it decompressed, cut off at chunk_size
+# bytes. Raises the compression library's error if the data is bad.
+def get_decompress_func(compression_mode, chunk_size):
+    match compression_mode:
+        case CompressionMode.none:
+            return None
+        case CompressionMode.zlib:
+            return lambda chunk_data: zlib.decompressobj(
+                wbits=-15).decompress(chunk_data,chunk_size)
+        case CompressionMode.lzma:
+            return lambda chunk_data: lzma.LZMADecompressor(
+                format=lzma.FORMAT_RAW,filters=get_lzma_filters()).decompress(
+                chunk_data,chunk_size)
+        case CompressionMode.zstd:
+            return lambda chunk_data: zstandard.ZstdDecompressor(
+                ).decompress(chunk_data,max_output_size=chunk_size)
+        case CompressionMode.lz4:
+            return lambda chunk_data: lz4.block.decompress(
+                chunk_data,uncompressed_size=chunk_size)
+
+def get_lzma_filters():
+    return [{'id':lzma.FILTER_LZMA2,'preset':lzma_preset}]
+
+def compression_mode_supported(compression_mode):
+    match compression_mode:
+        case CompressionMode.lzma:
+            return lzma is not None
+        case CompressionMode.zstd:
+            return zstandard is not None
+        case CompressionMode.lz4:
+            return lz4 is not None
+    return True
+
+# Reads the file once and returns (file_checksum, chunk_checksums).
+# file_checksum is the MD5 of the file data. chunk_checksums holds the
+# checksum of every chunk, as returned by chunk_checksum_func, back to
+# back, so the send loop never has to hash chunks itself.
+def scan_file(f, chunk_size, chunk_checksum_func):
+    start_time = time.perf_counter()
+    file_checksum = hashlib.md5()
+    chunk_checksums = bytearray()
+    checksum_size = len(chunk_checksum_func(b''))
+    # Read whole chunks at a time, so no chunk is split across reads.
+    buffer = bytearray(max(read_block_size//chunk_size,1)*chunk_size)
+    buffer_view = memoryview(buffer)
+    f.seek(0)
+    while True:
+        read_size = f.readinto(buffer)
+        if not read_size:
+            break
+        file_checksum.update(buffer_view[:read_size])
+        if checksum_size > 0:
+            for start in range(0,read_size,chunk_size):
+                chunk_checksums += chunk_checksum_func(
+                    buffer_view[start:min(start+chunk_size,read_size)])
+    metrics.observe('hash_seconds',time.perf_counter()-start_time)
+    return file_checksum.digest(), chunk_checksums
+
+# Reads chunk number chunk_no from file object f and returns it. Uses
+# pread where the OS has it, so no seek is needed, and chunks written
+# with write_chunk are never read from a stale buffer.
+def read_chunk(f, chunk_no, chunk_size):
+    if hasattr(os,'pread'):
+        return os.pread(f.fileno(),chunk_size,chunk_no*chunk_size)
+    f.seek(chunk_no*chunk_size)
+    return f.read(chunk_size)
+
+# Writes chunk_data to file object f at the offset of chunk number
+# chunk_no. Uses pwrite where the OS has it, so no seek is needed.
+def write_chunk(f, chunk_no, chunk_size, chunk_data):
+    if hasattr(os,'pwrite'):
+        os.pwrite(f.fileno(),chunk_data,chunk_no*chunk_size)
+    else:
+        f.seek(chunk_no*chunk_size)
+        f.write(chunk_data)
+
+# A chunk bitmap keeps one bit per chunk, which is set once that chunk
+# has been received. Takes up chunk_count/8 bytes.
+def create_bitmap(chunk_count):
+    return bytearray((chunk_count+7)//8)
+
+def bitmap_get(bitmap, chunk_no):
+    return (bitmap[chunk_no >> 3] >> (chunk_no & 7)) & 1
 
-# Takes in a byte array, divides it up into chunks of chunk_size and
-# returns chunk_list containing those chunks.
-def slice_data(data, chunk_size):
-    chunk_count = math.ceil(len(data)/chunk_size)
-    chunk_list = []
-    print(f'File Data Size: {len(data)}, Chunk Count:{chunk_count}')
-    for i in range(chunk_count):
-        start = i*chunk_size
-        end = start+chunk_size
-        chunk_list.append(data[start:end])
-    return chunk_list
+# Returns the chunk numbers in chunk_nos (a range) whose bits aren't
+# set.
+def bitmap_missing(bitmap, chunk_nos):
+    return [chunk_no for chunk_no in chunk_nos
+        if not bitmap_get(bitmap,chunk_no)]
 
+# Returns the chunks of chunk_count whose bits aren't set, as a list of
+# ranges. Whole bytes of set or clear bits are skipped over at once.
+def bitmap_missing_ranges(bitmap, chunk_count):
+    ranges = []
+    start = None # First chunk of the range being built, if any.
+    for byte_no, byte in enumerate(bitmap):
+        if byte == 0xff:
+            if start is not None:
+                ranges.append(range(start,byte_no*8))
+                start = None
+            continue
+        if byte == 0 and start is not None:
+            continue
+        for bit in range(8):
+            chunk_no = byte_no*8+bit
+            if chunk_no >= chunk_count:
+                break
+            if (byte >> bit) & 1:
+                if start is not None:
+                    ranges.append(range(start,chunk_no))
+                    start = None
+            elif start is None:
+                start = chunk_no
+    if start is not None:
+        ranges.append(range(start,chunk_count))
+    return ranges
+
+# Takes a sorted list of ranges and returns it with at most max_count
+# ranges, merging the ones with the smallest gaps between them.
+def merge_ranges(ranges, max_count):
+    if len(ranges) <= max_count:
+        return ranges
+    # Gaps between neighbouring ranges, smallest first. The ones that
+    # are merged are the len(ranges)-max_count smallest.
+    gaps = sorted(range(len(ranges)-1),
+        key=lambda i: ranges[i+1].start-ranges[i].stop)
+    merged_gaps = set(gaps[:len(ranges)-max_count])
+    merged = [ranges[0]]
+    for i in range(1,len(ranges)):
+        if i-1 in merged_gaps:
+            merged[-1] = range(merged[-1].start,ranges[i].stop)
+        else:
+            merged.append(ranges[i])
+    return merged
+
+# Returns the parts of the sorted ranges in chunk_ranges that fall
+# inside the range chunk_nos.
+def intersect_ranges(chunk_ranges, chunk_nos):
+    ranges = []
+    for chunk_range in chunk_ranges:
+        start = max(chunk_range.start,chunk_nos.start)
+        stop = min(chunk_range.stop,chunk_nos.stop)
+        if start < stop:
+            ranges.append(range(start,stop))
+    return ranges
+
+def bitmap_set(bitmap, chunk_no):
+    bitmap[chunk_no >> 3] |= 1 << (chunk_no & 7)
+
+# Draws the progress bar, at most once every progress_interval seconds
+# (it's called for every batch), but always once it's full. Nothing is
+# drawn in quiet mode.
 def draw_progress_bar(val, max_val):
+    global last_progress_draw_time
+    if quiet or not verbose:
+        return
+    now = time.monotonic()
+    if val < max_val and now-last_progress_draw_time < progress_interval:
+        return
+    last_progress_draw_time = now
     max_bar_points = 50
-    prog_bar_str = '['
-    fill_perc = val/max_val
-    empty_perc = 1-fill_perc
+    fill_perc = val/max_val if max_val > 0 else 1
     fill_points = round(fill_perc*max_bar_points)
-    empty_points = max_bar_points-fill_points
-    for i in range(fill_points):
-        prog_bar_str += '0'
-    for i in range(empty_points):
-        prog_bar_str += '-'
-    prog_bar_str += ']'
+    prog_bar_str = '['+'0'*fill_points+'-'*(max_bar_points-fill_points)+']'
     print(f'{prog_bar_str} | {val}/{max_val}',end='\r')
 
+# Prints a status msg, if verbose is set.
+def log(*args, **kwargs):
+    if verbose:
+        print(*args,**kwargs)
+
+# Counts of observations of some duration, in seconds, Prometheus
+# style: counts[i] is how many were at most bounds[i] (and more than
+# the bound before it), and the last count is for the ones above every
+# bound. Also keeps their sum.
+class Histogram:
+    def __init__(self, bounds=histogram_bounds):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds)+1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds,value)] += 1
+        self.sum += value
+        self.count += 1
+
+# Counters and histograms of what the transfer is doing, kept in the
+# metrics global. Counters count events and bytes, histograms time the
+# work done per batch (and RTTs). Hot paths only add to them once per
+# batch where they can. Exported by MetricsFileExporter and
+# serve_metrics. Worker processes of a parallel transfer keep their
+# own, which are sent back as snapshots and merged in.
+class Metrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    # Returns everything counted so far as a dict that can be turned
+    # into JSON or merged into another Metrics.
+    def snapshot(self):
+        return {
+            'time':time.time(),
+            'counters':dict(self.counters),
+            'histograms':{name:{'bounds':histogram.bounds,
+                'counts':list(histogram.counts),'sum':histogram.sum,
+                'count':histogram.count}
+                for name, histogram in list(self.histograms.items())}}
+
+    def merge(self, snapshot):
+        for name, value in snapshot['counters'].items():
+            self.counters[name] += value
+        for name, data in snapshot['histograms'].items():
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(data['bounds'])
+            for i, count in enumerate(data['counts']):
+                histogram.counts[i] += count
+            histogram.sum += data['sum']
+            histogram.count += data['count']
+
+    # Formats the metrics in the Prometheus text format. Names get the
+    # ft_ prefix, and counters the _total suffix.
+    def to_prometheus(self):
+        lines = []
+        for name, value in sorted(dict(self.counters).items()):
+            lines.append(f'# TYPE ft_{name}_total counter')
+            lines.append(f'ft_{name}_total {value}')
+        for name, histogram in sorted(list(self.histograms.items())):
+            lines.append(f'# TYPE ft_{name} histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.bounds+[float('inf')],
+                histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'ft_{name}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f'ft_{name}_sum {histogram.sum}')
+            lines.append(f'ft_{name}_count {histogram.count}')
+        return '\n'.join(lines)+'\n'
+
+metrics = Metrics()
+
+# Appends a JSON line with a snapshot of metrics to path every interval
+# seconds, from a daemon thread, and once more when stopped.
+class MetricsFileExporter:
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        with open(self.path,'a') as f:
+            f.write(json.dumps(metrics.snapshot())+'\n')
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+# Serves metrics over HTTP on localhost port, from a daemon thread, for
+# Prometheus to scrape. Returns the server, to be shut down once the
+# transfer is over. The handler is defined here, so http.server is only
+# imported when it's needed.
+def serve_metrics(port):
+    # Answers every GET with the metrics in the Prometheus text format.
+    class MetricsHandler(http_server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type','text/plain; version=0.0.4')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Requests aren't logged, so they don't mix with the progress
+        # bar.
+        def log_message(self, format, *args):
+            pass
+
+    server = http_server.ThreadingHTTPServer(('127.0.0.1',port),
+        MetricsHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+# Starts the metrics exports asked for in the command line options.
+# Returns a function that stops them.
+def start_metrics_export(options):
+    exporter = None
+    server = None
+    if 'metrics-file' in options:
+        exporter = MetricsFileExporter(options['metrics-file'],
+            float(options.get('metrics-interval',metrics_interval)))
+    if 'metrics-port' in options:
+        server = serve_metrics(int(options['metrics-port']))
+    def stop():
+        if exporter is not None:
+            exporter.stop()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    return stop
+
+# Compiled layouts of the fixed size parts of each msg. Packing and
+# unpacking a whole layout in one call is a lot cheaper than building
+# msgs field by field with int.to_bytes. Check docs for msg format.
+msg_header_struct = struct.Struct('<BBI')      # Byte 0-5
+send_req_struct = struct.Struct('<IBBBBI')     # Byte 6-17
+send_accept_struct = struct.Struct('<B')       # Byte 6
+eof_pkt_struct = struct.Struct('<IB')          # Byte 6-10
+mtu_probe_struct = struct.Struct('<I')         # Byte 6-9
+msg_option_struct = struct.Struct('<BH')       # Option Byte 0-2
+stream_map_struct = struct.Struct('<IIHH')     # StreamMap entry Byte 0-11
+chunk_range_struct = struct.Struct('<II')      # MissingChunks entry Byte 0-7
+copy_blocks_struct = struct.Struct('<QII')     # Byte 6-21
+copy_blocks_ack_struct = struct.Struct('<I')   # Byte 6-9
+copy_run_struct = struct.Struct('<QII')        # CopyBlocks entry Byte 0-15
+sack_pkt_struct = struct.Struct('<I')          # Byte 6-9
+# Signature of one block of a delta transfer: weak (Adler-32) and
+# strong (64-bit BLAKE2b) hash.
+signature_struct = struct.Struct('<I8s')
+# Bundle of a batch transfer: the manifest starts with the number of
+# files, and has an entry for each, with its size, the size of its
+# path and its MD5 checksum, followed by the path.
+manifest_header_struct = struct.Struct('<I')
+manifest_entry_struct = struct.Struct('<QH16s')
+# Chunk journal header: magic, file checksum, chunk size, chunk count
+# and size of the last chunk (0 until it's received).
+journal_header_struct = struct.Struct('<4s16sIII')
+# FilePkt and FilePktAck share the same header layout, header
+# included: chunk number, then size of the data that follows. FecPkt
+# has the same layout too, with group number and the XOR of the chunk
+# sizes in the group instead.
+file_pkt_struct = struct.Struct('<BBIII')      # Byte 0-13
+file_pkt_header_size = file_pkt_struct.size
+# Set in the ChunkSize field (Byte 10-13) of a FilePkt whose chunk data
+# is compressed.
+compressed_flag = 1 << 31
+# Largest chunk checksum a FilePktAck can carry (MD5).
+max_checksum_size = 16
+# Largest chunk size a FilePkt can carry.
+max_chunk_size = max_datagram_size-file_pkt_header_size
+# Largest msg a sender gets back for its FilePkts, a SackPkt holding a
+# whole bitmap.
+max_ack_msg_size = msg_header_struct.size+sack_pkt_struct.size+\
+    max_sack_bitmap_size
+
+# MsgType values of the msgs sent for every chunk, looked up once
+# instead of on every packet.
+send_req_type = MsgType.SendReq.value
+file_pkt_type = MsgType.FilePkt.value
+file_pkt_ack_type = MsgType.FilePktAck.value
+fec_pkt_type = MsgType.FecPkt.value
+sack_pkt_type = MsgType.SackPkt.value
+nack_pkt_type = MsgType.NackPkt.value
+
+# Takes a dict of MsgOption to bytes and encodes it into the options
+# part of a msg. Check docs for msg format.
+def encode_options(options):
+    msg_options = b''
+    for option in options:
+        msg_options += msg_option_struct.pack(
+            option.value,len(options[option])) # Byte 0, Byte 1-2
+        msg_options += options[option] # Byte 3-n
+    return msg_options
+
+# Decodes the options part of a msg, which starts at offset and runs
+# to the end of msg, and returns a dict of MsgOption to bytes. Options
+# this version doesn't know are skipped.
+def decode_options(msg, offset):
+    options = {}
+    while offset+msg_option_struct.size <= len(msg):
+        # Byte 0, Byte 1-2
+        option, option_size = msg_option_struct.unpack_from(msg,offset)
+        offset += msg_option_struct.size
+        if option in msg_options:
+            options[msg_options[option]] = bytes(
+                msg[offset:offset+option_size]) # Byte 3-n
+        offset += option_size
+    return options
+
 # Takes kwargs dict of data, and based on msg_type, encodes
 # relevant data into a message. Data can differ, depending
 # on the msg_type. Check docs for msg format and to 
 # understand data layout.
 def encode_message(**kwargs):
     global magic_number
-    msg = int.to_bytes(magic_number,1,'little') # Byte 0 - Magic number
-    msg += int.to_bytes(kwargs['msg_type'].value,1,'little') # Byte 1 - MsgType
     msg_data = b''
     
     match kwargs['msg_type']:
         case MsgType.SendReq:
             # print('SendReq')
-            file_checksum = hashlib.md5(kwargs['file_data']).digest()
+            file_checksum = kwargs['file_checksum']
             file_checksum_size = len(file_checksum)
             addr_data = str.encode(kwargs['addr'])
             addr_data_size = len(addr_data)
@@ -70,60 +700,188 @@ def encode_message(**kwargs):
             file_data_checksum_offset = \
                 addr_data_offset+addr_data_size
 
-            msg_data = int.to_bytes(kwargs['chunk_count'],4,'little') # Byte 6-9
-            msg_data += int.to_bytes(addr_data_offset,1,'little') # Byte 10
-            msg_data += int.to_bytes(addr_data_size,1,'little') # Byte 11
-            msg_data += int.to_bytes(file_data_checksum_offset,1,'little') # Byte 12
-            msg_data += int.to_bytes(file_checksum_size,1,'little') # Byte 13
-            msg_data += int.to_bytes(len(data_blob),4,'little') # Byte 14-17
+            msg_data = send_req_struct.pack(
+                kwargs['chunk_count'], # Byte 6-9
+                addr_data_offset, # Byte 10
+                addr_data_size, # Byte 11
+                file_data_checksum_offset, # Byte 12
+                file_checksum_size, # Byte 13
+                len(data_blob)) # Byte 14-17
             msg_data += data_blob # Byte 18-n
+            msg_data += encode_options(kwargs.get('options',{}))
             
         case MsgType.SendAccept:
             addr_data = str.encode(kwargs['addr']) 
             addr_data_size = len(addr_data)
-            msg_data = addr_data_size.to_bytes(1,'little') # Byte 6
+            msg_data = send_accept_struct.pack(addr_data_size) # Byte 6
             msg_data += addr_data # Byte 7-n
+            msg_data += encode_options(kwargs.get('options',{}))
             pass
         case MsgType.FilePkt:
-            msg_data = int.to_bytes(kwargs['chunk_no'],4,'little') # Byte 6-9
-            msg_data += int.to_bytes(kwargs['chunk_size'],4,'little') # Byte 10-13
-            msg_data += kwargs['chunk_data'] # Byte 14-n
+            # Byte 0-13, then Byte 14-n
+            return file_pkt_struct.pack(
+                magic_number,file_pkt_type,8+kwargs['chunk_size'],
+                kwargs['chunk_no'],kwargs['chunk_size']) + \
+                kwargs['chunk_data']
         case MsgType.FilePktAck:
-            msg_data = int.to_bytes(kwargs['chunk_no'],4,'little') # Byte 6-9
             chunk_data_checksum = hashlib.md5(kwargs['chunk_data']).digest()
-            msg_data += int.to_bytes(len(chunk_data_checksum),4,'little') # Byte 10-13
-            msg_data += chunk_data_checksum # Byte 14-n
+            # Byte 0-13, then Byte 14-n
+            return file_pkt_struct.pack(
+                magic_number,file_pkt_ack_type,8+len(chunk_data_checksum),
+                kwargs['chunk_no'],len(chunk_data_checksum)) + \
+                chunk_data_checksum
+        case MsgType.FecPkt:
+            # Byte 0-13, then Byte 14-n
+            return file_pkt_struct.pack(
+                magic_number,fec_pkt_type,8+len(kwargs['parity']),
+                kwargs['group_no'],kwargs['chunk_size_parity']) + \
+                kwargs['parity']
         case MsgType.EOFPkt:
-            msg_data = int.to_bytes(
-                kwargs['total_filepkts_received'],4,'little') # Byte 6-9
-            file_checksum = hashlib.md5(kwargs['file_data']).digest()
-            msg_data += int.to_bytes(len(file_checksum),1,'little') # Byte 10
+            file_checksum = kwargs['file_checksum']
+            msg_data = eof_pkt_struct.pack(
+                kwargs['total_filepkts_received'], # Byte 6-9
+                len(file_checksum)) # Byte 10
             msg_data += file_checksum # Byte 11-n
+        case MsgType.MtuProbe:
+            # Padded with zeroes so the whole msg is probe_size bytes.
+            msg_data = mtu_probe_struct.pack(kwargs['probe_size']) # Byte 6-9
+            msg_data += bytes(
+                kwargs['probe_size']-msg_header_struct.size-
+                mtu_probe_struct.size) # Byte 10-n
+        case MsgType.MtuProbeAck:
+            msg_data = mtu_probe_struct.pack(kwargs['probe_size']) # Byte 6-9
+        case MsgType.CopyBlocks:
+            # Byte 6-13, Byte 14-17, Byte 18-21
+            msg_data = copy_blocks_struct.pack(kwargs['file_size'],
+                kwargs['run_count'],kwargs['first_run'])
+            msg_data += b''.join(copy_run_struct.pack(*copy_run)
+                for copy_run in kwargs['copy_runs']) # Byte 22-n
+        case MsgType.CopyBlocksAck:
+            # Byte 6-9
+            msg_data = copy_blocks_ack_struct.pack(kwargs['first_run'])
+        case MsgType.SackPkt:
+            msg_data = sack_pkt_struct.pack(kwargs['base_chunk_no']) # Byte 6-9
+            msg_data += kwargs['bitmap'] # Byte 10-n
+        case MsgType.NackPkt:
+            msg_data = encode_chunk_ranges(kwargs['chunk_ranges']) # Byte 6-n
         case _:
             pass
-    msg += int.to_bytes(len(msg_data),4,'little') # Byte 2-5
+    # Byte 0 - Magic number, Byte 1 - MsgType, Byte 2-5 - Data size
+    msg = msg_header_struct.pack(
+        magic_number,kwargs['msg_type'].value,len(msg_data))
     msg += msg_data # Byte 6-n
     # print(f'data_blob:{list(msg[14+18:100])}')
 
     return msg
 
+# Packs the header (Byte 0-13) of a FilePkt carrying chunk_size bytes
+# of chunk number chunk_no into header, a reusable bytearray of
+# file_pkt_header_size bytes.
+def pack_file_pkt_header(header, chunk_no, chunk_size, compressed=False):
+    file_pkt_struct.pack_into(
+        header,0,magic_number,file_pkt_type,8+chunk_size,chunk_no,
+        chunk_size | compressed_flag if compressed else chunk_size)
+
+# Packs a whole FilePkt for chunk chunk_no into buffer, which needs room
+# for file_pkt_header_size+len(chunk_data) bytes, and returns the msg
+# size. compressed says whether chunk_data is compressed.
+def pack_file_pkt(buffer, chunk_no, chunk_data, compressed=False):
+    chunk_size = len(chunk_data)
+    pack_file_pkt_header(buffer,chunk_no,chunk_size,compressed)
+    buffer[14:14+chunk_size] = chunk_data # Byte 14-n
+    return file_pkt_header_size+chunk_size
+
+# Packs a FilePktAck for chunk chunk_no into ack_buffer, a reusable
+# bytearray big enough for the header plus the largest checksum, and
+# returns a memoryview of the msg.
+def pack_file_pkt_ack(ack_buffer, chunk_no, chunk_data_checksum):
+    checksum_size = len(chunk_data_checksum)
+    file_pkt_struct.pack_into(
+        ack_buffer,0,magic_number,file_pkt_ack_type,8+checksum_size,
+        chunk_no,checksum_size)
+    ack_buffer[14:14+checksum_size] = chunk_data_checksum # Byte 14-n
+    return memoryview(ack_buffer)[:14+checksum_size]
+
+# Takes a FilePkt msg and returns (chunk_no, chunk_data, compressed)
+# without building a dict. If msg is a memoryview, chunk_data is a
+# slice of it rather than a copy, so it's only valid until the buffer
+# msg was received into gets reused.
+def decode_file_pkt(msg):
+    # Byte 6-9, Byte 10-13
+    chunk_no, chunk_data_size = file_pkt_struct.unpack_from(msg)[3:]
+    compressed = chunk_data_size & compressed_flag != 0
+    chunk_data_size &= compressed_flag-1
+    return chunk_no, msg[14:14+chunk_data_size], compressed # Byte 14-n
+
+# Same as decode_file_pkt, but for FilePktAck. Returns
+# (chunk_no, chunk_data_checksum).
+def decode_file_pkt_ack(msg):
+    # Byte 6-9, Byte 10-13
+    chunk_no, checksum_size = file_pkt_struct.unpack_from(msg)[3:]
+    return chunk_no, msg[14:14+checksum_size] # Byte 14-n
+
+# Same as decode_file_pkt, but for SackPkt. Returns (base_chunk_no,
+# bitmap), bitmap being a slice of msg if it's a memoryview.
+def decode_sack_pkt(msg):
+    data_size = msg_header_struct.unpack_from(msg)[2] # Byte 2-5
+    base_chunk_no = sack_pkt_struct.unpack_from(msg,6)[0] # Byte 6-9
+    return base_chunk_no, msg[10:6+data_size] # Byte 10-n
+
+# Packs a FecPkt for group number group_no into buffer, which needs
+# room for file_pkt_header_size+len(parity) bytes, and returns the msg
+# size. parity is the XOR of the data of every chunk in the group, and
+# chunk_size_parity the XOR of their sizes.
+def pack_fec_pkt(buffer, group_no, chunk_size_parity, parity):
+    parity_size = len(parity)
+    file_pkt_struct.pack_into(
+        buffer,0,magic_number,fec_pkt_type,8+parity_size,
+        group_no,chunk_size_parity) # Byte 0-13
+    buffer[14:14+parity_size] = parity # Byte 14-n
+    return file_pkt_header_size+parity_size
+
+# Takes a FecPkt msg and returns (group_no, chunk_size_parity, parity),
+# parity being a slice of msg the same way decode_file_pkt does it.
+def decode_fec_pkt(msg):
+    # Byte 2-5, Byte 6-9, Byte 10-13
+    data_size, group_no, chunk_size_parity = \
+        file_pkt_struct.unpack_from(msg)[2:]
+    return group_no, chunk_size_parity, msg[14:6+data_size] # Byte 14-n
+
+# Rebuilds the one missing chunk of a FEC group from the group's
+# FecPkt. Every other chunk of the group is read back from f, where it
+# was already written, and XORed with the parity. Chunks shorter than
+# chunk_size count as padded with zeroes, which the file already is
+# past the end of the last chunk. last_chunk_size is the size of the
+# file's last chunk if it was received, since that's the only one that
+# can be shorter. Returns the missing chunk's data.
+def rebuild_chunk(f, chunk_size, group_chunk_nos, missing_chunk_no,
+    chunk_size_parity, parity, last_chunk_no, last_chunk_size):
+    data = int.from_bytes(parity,'little')
+    size = chunk_size_parity
+    for chunk_no in group_chunk_nos:
+        if chunk_no == missing_chunk_no:
+            continue
+        data ^= int.from_bytes(read_chunk(f,chunk_no,chunk_size),'little')
+        size ^= last_chunk_size if chunk_no == last_chunk_no else chunk_size
+    return data.to_bytes(chunk_size,'little')[:size]
+
 # Takes a bytes object and based MsgType, decodes the data into
 # a readable form, stores it into a dict, and returns the dict.
+# Values are copied out of msg, except for chunk data and chunk
+# checksums, which are returned the same way decode_file_pkt does.
 def decode_message(msg):
     global magic_number
 
     ret = {}
     
-    msg_type = MsgType._value2member_map_[int.from_bytes(msg[1:2],'little')] # Byte 1
-    data_size = int.from_bytes(msg[2:6],'little') # Byte 2-5
+    # Byte 0, Byte 1, Byte 2-5
+    magic, msg_type, data_size = msg_header_struct.unpack_from(msg)
+    msg_type = msg_types[msg_type]
 
     if msg_type == MsgType.SendReq:
-        chunk_count = int.from_bytes(msg[6:10],'little') # Byte 6-9
-        addr_data_offset = msg[10] # Byte 10
-        addr_data_size = msg[11] # Byte 11
-        file_data_checksum_offset = msg[12] # Byte 12
-        file_data_checksum_size = msg[13] # Byte 13
-        data_blob_size = int.from_bytes(msg[14:18],'little') # Byte 14-17
+        chunk_count, addr_data_offset, addr_data_size, \
+            file_data_checksum_offset, file_data_checksum_size, \
+            data_blob_size = send_req_struct.unpack_from(msg,6) # Byte 6-17
         data_blob_index = 18
         # print((msg))
 
@@ -133,348 +891,3425 @@ def decode_message(msg):
                 data_blob_index+addr_data_offset+addr_data_size],'utf-8')
         addr = addr.split(':')
         addr = (addr[0],int(addr[1]))
-        file_data_checksum = msg[data_blob_index+file_data_checksum_offset:\
-            data_blob_index+file_data_checksum_offset+file_data_checksum_size]
+        file_data_checksum = bytes(
+            msg[data_blob_index+file_data_checksum_offset:\
+            data_blob_index+file_data_checksum_offset+file_data_checksum_size])
         # print(file_data_checksum)
         # print(list(file_data_checksum))
 
         ret = {
             'addr':addr,
             'chunk_count':chunk_count,
-            'file_checksum':file_data_checksum
+            'file_checksum':file_data_checksum,
+            'options':decode_options(
+                msg[:6+data_size],data_blob_index+data_blob_size)
         }
         # print(list(msg))
         pass
     elif msg_type == MsgType.SendAccept:
         addr_data_size = msg[6] # Byte 6
-        addr_data = msg[7:7+addr_data_size] # Byte 7-n
-        ret = {'addr':addr_data}
+        addr_data = bytes(msg[7:7+addr_data_size]) # Byte 7-n
+        ret = {
+            'addr':addr_data,
+            'options':decode_options(msg[:6+data_size],7+addr_data_size)
+        }
         # print(addr_data)
         # print(list(addr_data))
         pass
     elif msg_type == MsgType.FilePkt:
-        chunk_no = int.from_bytes(msg[6:10],'little') # Byte 6-9
-        chunk_data_size = int.from_bytes(msg[10:14],'little') # Byte 10-13
-        chunk_data = msg[14:14+chunk_data_size] # Byte 14-n
-        ret = {'chunk_no':chunk_no,'chunk_data':chunk_data}
+        chunk_no, chunk_data, compressed = decode_file_pkt(msg)
+        ret = {
+            'chunk_no':chunk_no,
+            'chunk_data':chunk_data,
+            'compressed':compressed
+        }
         pass
     elif msg_type == MsgType.FilePktAck:
-        chunk_no = int.from_bytes(msg[6:10],'little') # Byte 6-9
-        # Byte 10-13
-        chunk_data_checksum_size = int.from_bytes(msg[10:14],'little')
-        # Byte 14-n
-        chunk_data_checksum = msg[14:14+chunk_data_checksum_size]
-        ret = {'chunk_data_checksum':chunk_data_checksum}
+        chunk_no, chunk_data_checksum = decode_file_pkt_ack(msg)
+        ret = {
+            'chunk_no':chunk_no,
+            'chunk_data_checksum':chunk_data_checksum
+        }
         pass
     elif msg_type == MsgType.EOFPkt:
-        # Byte 6-9
-        total_filepkts_recvd = int.from_bytes(msg[6:10],'little')
-        file_checksum_data_size = msg[10] # Byte 10
-        file_checksum = msg[11:11+file_checksum_data_size] # Byte 11-n
+        # Byte 6-9, Byte 10
+        total_filepkts_recvd, file_checksum_data_size = \
+            eof_pkt_struct.unpack_from(msg,6)
+        file_checksum = bytes(msg[11:11+file_checksum_data_size]) # Byte 11-n
         ret = {'file_checksum':file_checksum}
         pass
+    elif msg_type == MsgType.MtuProbe or msg_type == MsgType.MtuProbeAck:
+        probe_size = mtu_probe_struct.unpack_from(msg,6)[0] # Byte 6-9
+        ret = {'probe_size':probe_size}
+    elif msg_type == MsgType.CopyBlocks:
+        # Byte 6-13, Byte 14-17, Byte 18-21
+        file_size, run_count, first_run = \
+            copy_blocks_struct.unpack_from(msg,6)
+        # Byte 22-n, cut to whole entries.
+        copy_runs_data = msg[22:6+data_size]
+        copy_runs_data = copy_runs_data[:len(copy_runs_data)-
+            len(copy_runs_data)%copy_run_struct.size]
+        ret = {
+            'file_size':file_size,
+            'run_count':run_count,
+            'first_run':first_run,
+            'copy_runs':list(copy_run_struct.iter_unpack(copy_runs_data))
+        }
+    elif msg_type == MsgType.CopyBlocksAck:
+        first_run = copy_blocks_ack_struct.unpack_from(msg,6)[0] # Byte 6-9
+        ret = {'first_run':first_run}
+    elif msg_type == MsgType.SackPkt:
+        base_chunk_no, bitmap = decode_sack_pkt(msg)
+        ret = {'base_chunk_no':base_chunk_no,'bitmap':bitmap}
+    elif msg_type == MsgType.NackPkt:
+        # Byte 6-n, cut to whole entries.
+        ranges_data = msg[6:6+data_size]
+        ranges_data = ranges_data[:len(ranges_data)-
+            len(ranges_data)%chunk_range_struct.size]
+        ret = {'chunk_ranges':[range(start,start+count) for start, count
+            in chunk_range_struct.iter_unpack(ranges_data)]}
 
     ret['msg_type'] = msg_type
     return ret
 
-def send(filename, sender_addr, recvr_addr):
-    global magic_number
+# sendmmsg/recvmmsg let one syscall send or receive many datagrams.
+# Python's socket module doesn't have them, so on Linux they're called
+# from libc through ctypes. Elsewhere DatagramBatch loops instead.
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base',ctypes.c_void_p),('iov_len',ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name',ctypes.c_void_p),('msg_namelen',ctypes.c_uint32),
+        ('msg_iov',ctypes.POINTER(iovec)),('msg_iovlen',ctypes.c_size_t),
+        ('msg_control',ctypes.c_void_p),('msg_controllen',ctypes.c_size_t),
+        ('msg_flags',ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr',msghdr),('msg_len',ctypes.c_uint)]
+
+libc = None
+if sys.platform.startswith('linux'):
+    try:
+        libc = ctypes.CDLL(None,use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int,ctypes.c_void_p,
+            ctypes.c_uint,ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int,ctypes.c_void_p,
+            ctypes.c_uint,ctypes.c_int,ctypes.c_void_p]
+    except (OSError,AttributeError):
+        libc = None
+has_mmsg = libc is not None
+MSG_DONTWAIT = getattr(socket,'MSG_DONTWAIT',0x40)
+sockaddr_in_size = 16
+
+# Takes an (IP, Port) address and returns it as a sockaddr_in.
+def pack_sockaddr_in(addr):
+    return struct.pack('=H',socket.AF_INET)+struct.pack('!H',addr[1])+\
+        socket.inet_aton(socket.gethostbyname(addr[0]))+bytes(8)
+
+# Takes a sockaddr_in and returns it as an (IP, Port) address.
+def unpack_sockaddr_in(sockaddr):
+    return (socket.inet_ntoa(sockaddr[4:8]),
+        struct.unpack_from('!H',sockaddr,2)[0])
+
+# Sets the kernel send and receive buffer sizes of sock, so bursts of
+# datagrams aren't dropped before we get to them. The OS may cap or
+# round the sizes, so the ones it ended up with are printed.
+def set_sock_buffer_size(sock, size):
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,size)
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,size)
+    log('Socket buffers: '
+        f'send {sock.getsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF)}, '
+        f'recv {sock.getsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF)}')
+
+# Sends and receives datagrams to and from peer_addr in batches of up
+# to batch_size, using one sendmmsg/recvmmsg call per batch where
+# possible. Msgs are packed straight into a ring of preallocated send
+# slots, and received into a ring of preallocated recv slots, so no
+# buffers are allocated per datagram.
+#
+# To send, pack a msg into send_slot() and call queue_send() with its
+# size. Queued msgs go out when flush() is called, or when the ring is
+# full. recv() waits up to timeout seconds for at least one datagram,
+# then drains whatever else is already waiting.
+class DatagramBatch:
+    def __init__(self, sock, peer_addr, batch_size, send_slot_size,
+        recv_slot_size):
+        self.sock = sock
+        self.peer_addr = (socket.gethostbyname(peer_addr[0]),peer_addr[1])
+        self.batch_size = batch_size
+        self.send_slots = [bytearray(send_slot_size) for i in range(batch_size)]
+        self.recv_slots = [bytearray(recv_slot_size) for i in range(batch_size)]
+        self.recv_views = [memoryview(slot) for slot in self.recv_slots]
+        self.send_sizes = [0]*batch_size
+        self.send_count = 0
+        if has_mmsg:
+            self.init_mmsg()
+
+    # Builds the mmsghdr arrays for sendmmsg/recvmmsg once. Each
+    # mmsghdr points at its slot, and every send points at peer_addr.
+    def init_mmsg(self):
+        self.peer_sockaddr = ctypes.create_string_buffer(
+            pack_sockaddr_in(self.peer_addr),sockaddr_in_size)
+        self.send_iovecs = (iovec*self.batch_size)()
+        self.send_msgs = (mmsghdr*self.batch_size)()
+        self.recv_iovecs = (iovec*self.batch_size)()
+        self.recv_msgs = (mmsghdr*self.batch_size)()
+        self.recv_sockaddrs = [ctypes.create_string_buffer(sockaddr_in_size)
+            for i in range(self.batch_size)]
+        for i in range(self.batch_size):
+            self.send_iovecs[i].iov_base = ctypes.addressof(
+                ctypes.c_char.from_buffer(self.send_slots[i]))
+            send_hdr = self.send_msgs[i].msg_hdr
+            send_hdr.msg_name = ctypes.addressof(self.peer_sockaddr)
+            send_hdr.msg_namelen = sockaddr_in_size
+            send_hdr.msg_iov = ctypes.pointer(self.send_iovecs[i])
+            send_hdr.msg_iovlen = 1
+            self.recv_iovecs[i].iov_base = ctypes.addressof(
+                ctypes.c_char.from_buffer(self.recv_slots[i]))
+            self.recv_iovecs[i].iov_len = len(self.recv_slots[i])
+            recv_hdr = self.recv_msgs[i].msg_hdr
+            recv_hdr.msg_name = ctypes.addressof(self.recv_sockaddrs[i])
+            recv_hdr.msg_iov = ctypes.pointer(self.recv_iovecs[i])
+            recv_hdr.msg_iovlen = 1
+
+    # Returns the bytearray of the next free send slot, flushing first
+    # if every slot is taken.
+    def send_slot(self):
+        if self.send_count == self.batch_size:
+            self.flush()
+        return self.send_slots[self.send_count]
+
+    # Marks the msg packed into the slot returned by send_slot() as
+    # ready to send.
+    def queue_send(self, msg_size):
+        self.send_sizes[self.send_count] = msg_size
+        if has_mmsg:
+            self.send_iovecs[self.send_count].iov_len = msg_size
+        self.send_count += 1
+
+    # Copies msg into the next send slot and queues it.
+    def queue_msg(self, msg):
+        self.send_slot()[:len(msg)] = msg
+        self.queue_send(len(msg))
+
+    # Sends every queued msg.
+    def flush(self):
+        if self.send_count == 0:
+            return
+        start_time = time.perf_counter()
+        sent = 0
+        if has_mmsg:
+            fd = self.sock.fileno()
+            while sent < self.send_count:
+                result = libc.sendmmsg(fd,
+                    ctypes.addressof(self.send_msgs)+
+                        sent*ctypes.sizeof(mmsghdr),
+                    self.send_count-sent,0)
+                if result < 0:
+                    err = ctypes.get_errno()
+                    if err not in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR):
+                        raise OSError(err,os.strerror(err))
+                    # Socket send buffer is full. Wait for room.
+                    select.select([],[self.sock],[],sock_timeout)
+                    continue
+                sent += result
+        else:
+            for i in range(self.send_count):
+                self.sock.sendto(
+                    memoryview(self.send_slots[i])[:self.send_sizes[i]],
+                    self.peer_addr)
+        metrics.observe('send_syscall_seconds',time.perf_counter()-start_time)
+        metrics.count('packets_sent',self.send_count)
+        metrics.count('bytes_sent',sum(self.send_sizes[:self.send_count]))
+        self.send_count = 0
+
+    # Waits up to timeout seconds for datagrams and returns a list of
+    # memoryviews of the ones that came from peer_addr. Raises
+    # socket.timeout if nothing arrived. The memoryviews are only valid
+    # until the next recv() call.
+    def recv(self, timeout):
+        recv_msgs = []
+        if has_mmsg:
+            if not select.select([self.sock],[],[],timeout)[0]:
+                raise socket.timeout('timed out')
+            start_time = time.perf_counter()
+            for i in range(self.batch_size):
+                self.recv_msgs[i].msg_hdr.msg_namelen = sockaddr_in_size
+            result = libc.recvmmsg(self.sock.fileno(),
+                ctypes.addressof(self.recv_msgs),self.batch_size,
+                MSG_DONTWAIT,None)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN,errno.EWOULDBLOCK,errno.EINTR):
+                    return recv_msgs
+                raise OSError(err,os.strerror(err))
+            recv_count = result
+            recv_bytes = 0
+            for i in range(result):
+                recv_bytes += self.recv_msgs[i].msg_len
+                if unpack_sockaddr_in(self.recv_sockaddrs[i].raw) == \
+                    self.peer_addr:
+                    recv_msgs.append(
+                        self.recv_views[i][:self.recv_msgs[i].msg_len])
+        else:
+            # Block for the first datagram, then take the rest without
+            # waiting. Only the time spent draining is measured.
+            self.sock.settimeout(timeout)
+            recv_count = 0
+            recv_bytes = 0
+            for i in range(self.batch_size):
+                try:
+                    recv_size, ret_addr = self.sock.recvfrom_into(
+                        self.recv_slots[i])
+                except (socket.timeout,BlockingIOError):
+                    if i == 0:
+                        raise socket.timeout('timed out')
+                    break
+                if i == 0:
+                    self.sock.settimeout(0)
+                    start_time = time.perf_counter()
+                recv_count += 1
+                recv_bytes += recv_size
+                if ret_addr == self.peer_addr:
+                    recv_msgs.append(self.recv_views[i][:recv_size])
+            self.sock.settimeout(sock_timeout)
+        metrics.observe('recv_syscall_seconds',time.perf_counter()-start_time)
+        metrics.count('packets_received',recv_count)
+        metrics.count('bytes_received',recv_bytes)
+        if len(recv_msgs) < recv_count:
+            metrics.count('packets_dropped_stray',recv_count-len(recv_msgs))
+        return recv_msgs
+
+# Finds the largest msg that gets to recvr_addr without being
+# fragmented, and returns the chunk size of a FilePkt that size. Returns
+# None if it can't be found out. Needs Linux, where IP_PMTUDISC_DO sets
+# the Don't Fragment bit on everything the socket sends. An MtuProbe of
+# every size in probe_mtus is sent, and the receiver answers each one
+# that gets through with an MtuProbeAck. Probes bigger than the MTU the
+# kernel already knows for the route fail straight away with EMSGSIZE.
+def probe_path_mtu(sock, recvr_addr):
     global sock_timeout
-    data = 0
-    print('Reading file...')
-    with open(filename,'rb') as f:
-        data = f.read()
-    print('Reading complete.')
-    # print('Opening socket.')
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    print(f'Binding socket to {sender_addr}')
-    sock.bind(sender_addr)
+    if not sys.platform.startswith('linux'):
+        return None
+    sock.setsockopt(socket.IPPROTO_IP,IP_MTU_DISCOVER,IP_PMTUDISC_DO)
+    recv_buffer = bytearray(64)
+    largest_probe_size = 0
+    for i in range(probe_rounds):
+        for mtu in probe_mtus:
+            try:
+                sock.sendto(encode_message(**{
+                    'msg_type':MsgType.MtuProbe,
+                    'probe_size':mtu-udp_ip_header_size}),recvr_addr)
+            except OSError:
+                # Bigger than the MTU of the route.
+                pass
+        # Collect MtuProbeAcks until probe_timeout runs out.
+        deadline = time.monotonic()+probe_timeout
+        while time.monotonic() < deadline:
+            sock.settimeout(max(deadline-time.monotonic(),0.001))
+            try:
+                recv_size, ret_addr = sock.recvfrom_into(recv_buffer)
+            except socket.timeout:
+                break
+            recv_msg = recv_buffer[:recv_size]
+            if ret_addr != recvr_addr or \
+                recv_size < msg_header_struct.size+mtu_probe_struct.size or \
+                recv_msg[0] != magic_number or \
+                recv_msg[1] != MsgType.MtuProbeAck.value:
+                continue
+            largest_probe_size = max(largest_probe_size,
+                decode_message(recv_msg)['probe_size'])
+        if largest_probe_size > 0:
+            break
+    # Back to the default, so FilePkts are never refused if the path
+    # MTU drops during the transfer.
+    sock.setsockopt(socket.IPPROTO_IP,IP_MTU_DISCOVER,IP_PMTUDISC_WANT)
     sock.settimeout(sock_timeout)
-    recv_buffer_size = 1250
-    file_checksum = hashlib.md5(data).digest()
-    chunk_list = slice_data(data, 1024)
-    chunk_count = len(chunk_list)
-    state = ProgState.SendingSendReq
-    curr_chunk_no = 0 # Increments each time a chunk was successfully sent.
-    # Used to confirm the correct chunk data was recevied by recvr.
-    curr_chunk_checksum = b'' 
-    # msg = create_message(**{
-    #     'msg_type':MsgType.FilePktAck,'chunk_no':curr_chunk_no,
-    #     'chunk_data':chunk_list[curr_chunk_no]
-    # })
-    # print(list(msg))
-    # dec_msg = decode_message(msg)
-    # print(dec_msg)
+    if largest_probe_size == 0:
+        return None
+    return largest_probe_size-file_pkt_header_size
 
-    # Debugging code
-    # ------------------------------------
-    # SendAccept
-    # temp_recvr_addr = ('192.168.8.103',9510)
-#     temp_debug_buffer = [26, 2, 19, 0, 0, 0, 18, 49, 57, 50, 46, 49, 54, 56, 46, 56, 46, 49, 49, 49, 58, 57, 
-# 53, 49, 48]
-#     # FilePktAck
-#     temp_debug_buffer = [26, 4, 24, 0, 0, 0, 0, 0, 0, 0, 16, 0, 0, 0, 144, 1, 80, 152, 60, 210, 79, 176, 214, 150, 63, 125, 40, 225, 127, 114]
-#     temp_debug_buffer = [26, 5, 21, 0, 0, 0, 1, 0, 0, 0, 16, 144, 1, 80, 152, 60, 210, 79, 176, 214, 150, 63, 125, 40, 225, 127, 114]
-#     temp_debug_buffer = bytes(temp_debug_buffer)
-#     state = ProgState.AwaitingFilePktAck
-#     curr_chunk_no = 0
-    # ------------------------------------
+# Turns a rate like 200M, 1.5G or 800K (bits per second) into a number.
+def parse_rate(rate):
+    multipliers = {'K':10**3,'M':10**6,'G':10**9}
+    rate = rate.strip().upper()
+    if rate[-1:] in multipliers:
+        return int(float(rate[:-1])*multipliers[rate[-1]])
+    return int(float(rate))
+
+# Formats a rate in bits per second for printing.
+def format_rate(rate):
+    for suffix, multiplier in (('G',10**9),('M',10**6),('K',10**3)):
+        if rate >= multiplier:
+            return f'{rate/multiplier:.1f} {suffix}bit/s'
+    return f'{rate:.0f} bit/s'
+
+# Paces sending to rate bits per second. Tokens are bytes, and the
+# bucket holds rate_burst_time seconds worth of them, but never less
+# than one datagram of datagram_size bytes (plus headers). limited is
+# set whenever a datagram had to be held back, so adaptive mode can
+# tell whether the rate is what's holding the sender back.
+class TokenBucket:
+    def __init__(self, rate, datagram_size):
+        self.datagram_size = datagram_size
+        self.last_refill = time.monotonic()
+        self.limited = False
+        self.set_rate(rate)
+        self.tokens = self.capacity
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.capacity = max(rate/8*rate_burst_time,
+            self.datagram_size+udp_ip_header_size)
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+            self.tokens+(now-self.last_refill)*self.rate/8)
+        self.last_refill = now
+
+    # Takes the tokens for a datagram of msg_size bytes and returns
+    # True, or returns False if there aren't enough yet. With force,
+    # they're taken anyway, and the bucket goes into debt.
+    def consume(self, msg_size, now, force=False):
+        self.refill(now)
+        msg_size += udp_ip_header_size
+        if self.tokens < msg_size and not force:
+            self.limited = True
+            return False
+        self.tokens -= msg_size
+        return True
+
+    # Returns seconds until a datagram of msg_size bytes can be sent.
+    def wait_time(self, msg_size, now):
+        self.refill(now)
+        missing = msg_size+udp_ip_header_size-self.tokens
+        return max(missing*8/self.rate,0)
+
+# Adapts the rate of a TokenBucket to the path, AIMD style. Once every
+# RTT it looks at the FilePktAcks that came back: if the RTT went up
+# well above the lowest RTT seen, a queue is building up somewhere and
+# the rate is cut a little. Otherwise, if the rate was what held the
+# sender back, it's raised: doubled every RTT until the first decrease
+# (slow start), then by a fixed step. A lost chunk cuts the rate by
+# half, unless it was sent before the last decrease, so a burst of
+# losses only counts once.
+class AdaptiveRate:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.srtt = None
+        self.min_rtt = None
+        self.slow_start = True
+        self.step = 0
+        now = time.monotonic()
+        self.round_end = now
+        self.last_decrease = now
+
+    # Called for every FilePktAck. rtt is the RTT sample it gave, or
+    # None if its chunk was sent more than once and the sample could
+    # belong to either send.
+    def on_ack(self, rtt, now):
+        if rtt is not None:
+            if self.srtt is None:
+                self.srtt = rtt
+            else:
+                self.srtt += (rtt-self.srtt)*rtt_gain
+            if self.min_rtt is None or rtt < self.min_rtt:
+                self.min_rtt = rtt
+        if self.srtt is None or now < self.round_end:
+            return
+        self.round_end = now+self.srtt
+        if self.srtt > self.min_rtt*delay_threshold+delay_margin:
+            self.decrease(delay_decrease,now)
+        elif self.bucket.limited:
+            if self.slow_start:
+                self.bucket.set_rate(self.bucket.rate*2)
+            else:
+                self.bucket.set_rate(self.bucket.rate+self.step)
+        self.bucket.limited = False
+
+    # Called when a chunk last sent at sent_time has to be sent again.
+    def on_loss(self, sent_time, now):
+        if sent_time < self.last_decrease:
+            return
+        self.decrease(loss_decrease,now)
+
+    def decrease(self, factor, now):
+        self.slow_start = False
+        self.step = self.bucket.rate*additive_increase
+        self.bucket.set_rate(
+            max(self.bucket.rate*factor,min_adaptive_rate))
+        self.last_decrease = now
+        self.round_end = now+(self.srtt or retransmit_timeout)
+
+# Works out the retransmission timeout from RTT samples, as in RFC
+# 6298: the smoothed RTT plus four times its mean deviation, kept
+# between min_rto and max_rto. Until the first sample it's
+# retransmit_timeout. Samples must only come from msgs that were sent
+# once (Karn's algorithm), since it's not known which send an answer
+# belongs to. Every timeout doubles it, until the next sample, unless
+# the msg that timed out was sent before the last doubling, so a burst
+# of losses only counts once.
+class RtoEstimator:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = retransmit_timeout
+        self.last_backoff = 0
+
+    def on_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt/2
+        else:
+            self.rttvar += (abs(self.srtt-rtt)-self.rttvar)*rttvar_gain
+            self.srtt += (rtt-self.srtt)*rtt_gain
+        self.rto = min(max(self.srtt+4*self.rttvar,min_rto),max_rto)
+
+    # Called when a msg last sent at sent_time timed out.
+    def backoff(self, sent_time, now):
+        if sent_time < self.last_backoff:
+            return
+        self.rto = min(self.rto*2,max_rto)
+        self.last_backoff = now
+
+# Splits chunk_count chunks into at most streams ranges of about the
+# same size, one per stream of a parallel transfer. Every range but the
+# last starts and ends on a multiple of align, so no FEC group, and no
+# byte of the chunk journal's bitmap, is split across two streams.
+# Returns a list of ranges.
+def split_chunks(chunk_count, streams, align=1):
+    per_stream = math.ceil(math.ceil(chunk_count/streams)/align)*align
+    return [range(start,min(start+per_stream,chunk_count))
+        for start in range(0,chunk_count,max(per_stream,1))]
+
+# Encodes a list of (chunk_nos, sender_port, recvr_port) into the data
+# of a StreamMap option. Check docs for msg format.
+def encode_stream_map(streams):
+    return b''.join(stream_map_struct.pack(
+        chunk_nos.start,len(chunk_nos),sender_port,recvr_port)
+        for chunk_nos, sender_port, recvr_port in streams)
+
+# Decodes the data of a StreamMap option into a list of
+# (chunk_nos, sender_port, recvr_port).
+def decode_stream_map(data):
+    streams = []
+    for offset in range(0,len(data)-stream_map_struct.size+1,
+        stream_map_struct.size):
+        first_chunk_no, chunk_count, sender_port, recvr_port = \
+            stream_map_struct.unpack_from(data,offset)
+        streams.append((range(first_chunk_no,first_chunk_no+chunk_count),
+            sender_port,recvr_port))
+    return streams
+
+# Encodes a list of ranges into the data of a MissingChunks option.
+def encode_chunk_ranges(chunk_ranges):
+    return b''.join(chunk_range_struct.pack(chunk_range.start,
+        len(chunk_range)) for chunk_range in chunk_ranges)
+
+# Decodes the data of a MissingChunks option into a list of ranges.
+# Ranges past chunk_count are cut off.
+def decode_chunk_ranges(data, chunk_count):
+    chunk_ranges = []
+    for offset in range(0,len(data)-chunk_range_struct.size+1,
+        chunk_range_struct.size):
+        start, count = chunk_range_struct.unpack_from(data,offset)
+        if start < chunk_count:
+            chunk_ranges.append(range(start,min(start+count,chunk_count)))
+    return chunk_ranges
+
+# Reads chunk number chunk_no from file object f and compresses it with
+# compress_func, unless that's None. Returns (chunk_data, payload,
+# compressed), payload being what's sent in the FilePkt: the compressed
+# data if it came out smaller, chunk_data if not.
+def compress_chunk(f, chunk_no, chunk_size, compress_func):
+    chunk_data = read_chunk(f,chunk_no,chunk_size)
+    if compress_func is not None:
+        compressed_data = compress_func(chunk_data)
+        if len(compressed_data) < len(chunk_data):
+            return chunk_data, compressed_data, True
+    return chunk_data, chunk_data, False
+
+# Reads and compresses the chunks of f in chunk_ranges (a sorted list of
+# ranges), in order, for send_chunks. The work is done by a pool of
+# compression_workers threads, up to compress_ahead chunks ahead of the
+# send loop, so the loop doesn't wait on it (zlib, lzma and zstd let go
+# of the GIL while they work). After incompressible_streak chunks in a
+# row that didn't shrink, the next incompressible_skip_count are sent
+# without trying, so files that are already compressed cost next to no
+# CPU. Also counts what was compressed, for the stats at the end.
+class ChunkCompressor:
+    def __init__(self, f, chunk_size, chunk_ranges, compress_func):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.compress_func = compress_func
+        self.chunk_nos = itertools.chain.from_iterable(chunk_ranges)
+        # Without pread, reads move the file position, so they can't
+        # run in more than one thread at once.
+        self.pool = futures.ThreadPoolExecutor(
+            compression_workers if hasattr(os,'pread') else 1)
+        # (future, whether compression is tried) for every chunk handed
+        # to the pool, in order.
+        self.pending = collections.deque()
+        self.streak = 0 # Chunks in a row that didn't shrink.
+        self.skip_count = 0 # Chunks left to send without trying.
+        self.chunk_count = 0
+        self.compressed_count = 0
+        self.data_size = 0
+        self.payload_size = 0
+        self.fill()
+
+    # Hands chunks to the pool until compress_ahead are pending.
+    def fill(self):
+        while len(self.pending) < compress_ahead:
+            chunk_no = next(self.chunk_nos,None)
+            if chunk_no is None:
+                break
+            compress_func = self.compress_func
+            if self.skip_count > 0:
+                compress_func = None
+                self.skip_count -= 1
+            self.pending.append((self.pool.submit(compress_chunk,self.f,
+                chunk_no,self.chunk_size,compress_func),
+                compress_func is not None))
+
+    # Returns (chunk_data, payload, compressed) of the next chunk,
+    # waiting for it if it isn't ready yet.
+    def peek(self):
+        return self.pending[0][0].result()
+
+    # Same as peek, but moves on to the chunk after.
+    def pop(self):
+        future, tried = self.pending.popleft()
+        chunk_data, payload, compressed = future.result()
+        self.chunk_count += 1
+        self.data_size += len(chunk_data)
+        self.payload_size += len(payload)
+        if compressed:
+            self.compressed_count += 1
+            self.streak = 0
+        elif tried:
+            self.streak += 1
+            if self.streak >= incompressible_streak:
+                self.skip_count = incompressible_skip_count
+                self.streak = 0
+        self.fill()
+        return chunk_data, payload, compressed
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+# Sends the chunks in chunk_ranges (a sorted list of ranges) of file f
+# through batch, once the handshake is done. Up to window_size chunks
+# are kept in flight, paced to rate (bits per second, 'auto' or None),
+# and followed by a FecPkt every fec_group_size chunks if that's set
+# (only for groups whose chunks are all being sent, since the receiver
+# rebuilds chunks from every other chunk of the group). Each FilePktAck
+# is checked against chunk_checksums. SackPkts ack chunks without
+# checksums, and chunks in NackPkts are sent again straight away.
+# on_ack is called with the number of chunks acked so far every time
+# it goes up. If compress_func is given, chunks are compressed with a
+# ChunkCompressor. Chunks are sent again once rto (an RtoEstimator,
+# which may already hold samples from the handshake) times out.
+# Returns the decoded EOFPkt once one arrives, or None once every chunk
+# is acked if return_when_acked is set. Raises socket.timeout if no
+# FilePktAck arrives for sock_timeout seconds.
+def send_chunks(batch, f, file_size, chunk_size, chunk_ranges,
+    chunk_checksums, checksum_size, window_size, rate, fec_group_size,
+    on_ack, return_when_acked=False, compress_func=None, rto=None):
+    global sock_timeout
+    if rto is None:
+        rto = RtoEstimator()
+    chunk_checksums_view = memoryview(chunk_checksums)
+    # FilePkts are paced by bucket when a rate is given. With rate
+    # auto, adaptive changes the bucket's rate as the transfer goes.
+    bucket = None
+    adaptive = None
+    if rate == 'auto':
+        bucket = TokenBucket(initial_adaptive_rate,
+            file_pkt_header_size+chunk_size)
+        adaptive = AdaptiveRate(bucket)
+    elif rate is not None:
+        bucket = TokenBucket(rate,file_pkt_header_size+chunk_size)
+    # Set when the bucket held back a FilePkt, so the next wait only
+    # lasts until there are enough tokens for it.
+    rate_limited = False
+    # With FEC, a FecPkt follows every fec_group_size chunks. Chunks
+    # are first sent in order, so only the parity of the group being
+    # sent is kept: the XOR of its chunk data (as one big int, little
+    # endian, so shorter chunks count as padded with zeroes), the XOR
+    # of its chunk sizes, and its longest chunk size.
+    fec_parity = 0
+    fec_chunk_size_parity = 0
+    fec_parity_size = 0
+    fec_chunk_count = 0 # Chunks of the group XORed in so far.
+    chunk_count = math.ceil(file_size/chunk_size)
+    state = ProgState.SendingFilePkt
+    # Chunks that haven't been sent yet, in order, and the next one of
+    # them (None once every chunk has been sent).
+    unsent_chunk_nos = itertools.chain.from_iterable(chunk_ranges)
+    next_chunk_no = next(unsent_chunk_nos,None)
+    send_chunk_count = sum(len(chunk_range) for chunk_range in chunk_ranges)
+    acked_chunk_count = 0 # Increments each time a chunk was acknowledged.
+    # Chunks that have been sent but not acknowledged yet. Maps chunk
+    # number to the time the chunk was last sent, so chunks whose
+    # FilePktAck didn't arrive in time can be sent again. At most
+    # window_size chunks are in flight at any time. Chunks are first
+    # sent in order, so its keys are in order too.
+    in_flight = {}
+    # Chunks in in_flight the receiver NACKed, to be sent again as soon
+    # as the bucket lets them.
+    nacked = set()
+    # Chunks in in_flight that have been sent more than once. Their
+    # FilePktAcks don't give RTT samples, since it's not known which
+    # send they answer.
+    retransmitted = set()
+    # Time of the last FilePktAck. If nothing arrives for sock_timeout
+    # seconds the transfer is given up.
+    last_ack_time = time.monotonic()
+    # Once every chunk is acked, the EOFPkt that should follow may get
+    # lost. If it doesn't arrive, the last chunk acked is sent again
+    # (uncompressed) to ask for it again. probe_time is when the last
+    # ack arrived or the last of these was sent.
+    probe_chunk_no = None
+    probe_time = last_ack_time
+    # Data of the chunks in in_flight, so retransmitting or checking
+    # the ack of a chunk doesn't need another file read. Holds at most
+    # window_size chunks. With compression, it's the data as sent, and
+    # compressed_chunks holds the ones that are compressed.
+    chunk_buffer = {}
+    compressed_chunks = set()
+    compressor = None
+    if compress_func is not None:
+        compressor = ChunkCompressor(f,chunk_size,chunk_ranges,
+            compress_func)
 
     # At each iteration, based on state, program does it's job
     # and then changes state to the relevant ProgState.
     while True:
-        # break
-        if state == ProgState.SendingSendReq:
-            # Create and send SendReq msg.
-            print(f'Sending SendReq to {recvr_addr}')
-            msg = encode_message(**{
-                'msg_type':MsgType.SendReq,'file_data':data,
-                'addr':f'{sender_addr[0]}:{str(sender_addr[1])}',
-                'chunk_count':chunk_count})
-            sock.sendto(msg,recvr_addr)
-            # sock.sendto(b'abcdef',addr)
-            # print(f'{addr[0]}:{str(addr[1])}')
-            # print(len(msg))
-            # Change state so at next iteration we are awaiting
-            # SendAccept msg.
-            state = ProgState.AwaitingSendAccept
-            # break
-        elif state == ProgState.AwaitingSendAccept:
-            # Receive and decode SendAccept msg
-            print(f'Awaiting SendAccept')
-            recv_msg = sock.recvfrom(recv_buffer_size)
-            ret_addr = recv_msg[1]
-            recv_msg = recv_msg[0]
-            
-            # If data is received from any address other than recvr_addr
-            # it's not meant for this program, so ignore it and continue
-            # to next iteration.
-            if ret_addr == recvr_addr:
-                print(f'Received SendAccept from {recvr_addr}')
-            else:
-                continue
-
-            # recv_msg = temp_debug_buffer
-            if recv_msg[0] != magic_number:
-                continue
-            decoded_data = decode_message(recv_msg)
-            # print(decoded_data)
-            if decoded_data['msg_type'] == MsgType.SendAccept:
-                # SendAccept received. Change state so we can start
-                # sending file pkts.
-                state = ProgState.SendingFilePkt
-            # print(decoded_data)
-            # break
-        elif state == ProgState.SendingFilePkt:
-            # Create and send FilePkt msg.
+        if return_when_acked and acked_chunk_count == send_chunk_count:
+            if compressor is not None:
+                compressor.close()
+            return None
+        if state == ProgState.SendingFilePkt:
+            # Create and send FilePkt msgs.
             # print('SendingFilePkt')
-            msg = encode_message(**{
-                    'msg_type':MsgType.FilePkt,'chunk_no':curr_chunk_no,
-                    'chunk_size':len(chunk_list[curr_chunk_no]),
-                    'chunk_data':chunk_list[curr_chunk_no]})
-            sock.sendto(msg,recvr_addr)
-            # print(f'curr_chunk_no:{curr_chunk_no}',end='\r')
-            # print(list(msg))
-            curr_chunk_checksum = hashlib.md5(chunk_list[curr_chunk_no]).digest()
+            encode_start_time = time.perf_counter()
+            now = time.monotonic()
+            rate_limited = False
+            timeout_retransmits = 0
+            nack_retransmits = 0
+            # Send again every in flight chunk whose FilePktAck didn't
+            # arrive within the RTO, or that was NACKed. The RTO is read
+            # once, since the first timeout backs it off.
+            timeout = rto.rto
+            for chunk_no in in_flight:
+                timed_out = now-in_flight[chunk_no] >= timeout
+                if timed_out or chunk_no in nacked:
+                    if bucket is not None and not bucket.consume(
+                        file_pkt_header_size+len(chunk_buffer[chunk_no]),now):
+                        rate_limited = True
+                        break
+                    if adaptive is not None:
+                        adaptive.on_loss(in_flight[chunk_no],now)
+                    if timed_out:
+                        rto.backoff(in_flight[chunk_no],now)
+                        timeout_retransmits += 1
+                    else:
+                        nack_retransmits += 1
+                    batch.queue_send(pack_file_pkt(
+                        batch.send_slot(),chunk_no,chunk_buffer[chunk_no],
+                        chunk_no in compressed_chunks))
+                    in_flight[chunk_no] = now
+                    retransmitted.add(chunk_no)
+                    nacked.discard(chunk_no)
+            # Fill up the window with chunks that haven't been sent yet.
+            while not rate_limited and len(in_flight) < window_size and \
+                next_chunk_no is not None:
+                # Every chunk but the last is chunk_size bytes, unless
+                # it's compressed.
+                if compressor is None:
+                    payload_size = min(chunk_size,
+                        file_size-next_chunk_no*chunk_size)
+                else:
+                    payload_size = len(compressor.peek()[1])
+                if bucket is not None and not bucket.consume(
+                    file_pkt_header_size+payload_size,now):
+                    rate_limited = True
+                    break
+                if compressor is None:
+                    chunk_data = read_chunk(f,next_chunk_no,chunk_size)
+                    payload = chunk_data
+                    compressed = False
+                else:
+                    chunk_data, payload, compressed = compressor.pop()
+                    if compressed:
+                        compressed_chunks.add(next_chunk_no)
+                chunk_buffer[next_chunk_no] = payload
+                batch.queue_send(pack_file_pkt(
+                    batch.send_slot(),next_chunk_no,payload,compressed))
+                # print(f'next_chunk_no:{next_chunk_no}',end='\r')
+                in_flight[next_chunk_no] = now
+                chunk_no = next_chunk_no
+                next_chunk_no = next(unsent_chunk_nos,None)
+                if fec_group_size > 0:
+                    fec_parity ^= int.from_bytes(chunk_data,'little')
+                    fec_chunk_size_parity ^= len(chunk_data)
+                    fec_parity_size = max(fec_parity_size,len(chunk_data))
+                    fec_chunk_count += 1
+                    group_no = chunk_no//fec_group_size
+                    # Once the group's last chunk is sent, send its
+                    # FecPkt, if every chunk of the group was sent. It
+                    # isn't acked or sent again, and isn't held back by
+                    # the bucket, only paid for.
+                    if next_chunk_no is None or \
+                        next_chunk_no//fec_group_size != group_no:
+                        if fec_chunk_count == min(fec_group_size,
+                            chunk_count-group_no*fec_group_size):
+                            msg_size = pack_fec_pkt(batch.send_slot(),
+                                group_no,fec_chunk_size_parity,
+                                fec_parity.to_bytes(fec_parity_size,'little'))
+                            batch.queue_send(msg_size)
+                            metrics.count('fec_pkts_sent')
+                            if bucket is not None:
+                                bucket.consume(msg_size,now,force=True)
+                        fec_parity = 0
+                        fec_chunk_size_parity = 0
+                        fec_parity_size = 0
+                        fec_chunk_count = 0
+            if not in_flight and next_chunk_no is None and \
+                probe_chunk_no is not None and \
+                now-probe_time >= min(rto.rto,eof_linger/2):
+                batch.queue_send(pack_file_pkt(batch.send_slot(),
+                    probe_chunk_no,read_chunk(f,probe_chunk_no,chunk_size)))
+                probe_time = now
+            if timeout_retransmits:
+                metrics.count('retransmits_timeout',timeout_retransmits)
+            if nack_retransmits:
+                metrics.count('retransmits_nack',nack_retransmits)
+            metrics.observe('encode_seconds',
+                time.perf_counter()-encode_start_time)
+            batch.flush()
             # Change state so next iteration we're awaiting FilePktAck
             state = ProgState.AwaitingFilePktAck
             # break
         elif state == ProgState.AwaitingFilePktAck:
             # Receive and decode FilePktAck
             # print('AwaitingFilePktAck')
-            recv_msg = sock.recvfrom(recv_buffer_size)
-            recv_msg = recv_msg[0]
-            # recv_msg = temp_debug_buffer
-            if recv_msg[0] != magic_number:
-                continue
-            decoded_data = decode_message(recv_msg)
-            # print(f'curr_chunk_no:{curr_chunk_no}',end='\r')
-            # print(decoded_data)
-            
-            # If FilePktAck is received...
-            if decoded_data['msg_type'] == MsgType.FilePktAck:
-                # If curr_chunk_no is not the last chunk and received
-                # chunk checksum is same as stored chunk checksum...
-                if curr_chunk_no < len(chunk_list) and \
-                    decoded_data['chunk_data_checksum'] == curr_chunk_checksum:
-                    draw_progress_bar(curr_chunk_no+1,chunk_count)
-                    # print(f'Chunks sent: {curr_chunk_no+1}',end='\r')
-                    # Increment curr_chunk_no.
-                    curr_chunk_no += 1
-                # Change state so next chunk can be sent.
+            # Only wait until the oldest in flight chunk is due to be
+            # sent again, or with every chunk acked, until EOFPkt is
+            # asked for again.
+            # If the bucket held back a FilePkt, only wait until there
+            # are enough tokens to send it.
+            wait_time = rto.rto
+            if rate_limited:
+                wait_time = bucket.wait_time(
+                    file_pkt_header_size+chunk_size,time.monotonic())
+            elif len(in_flight) > 0:
+                wait_time = min(in_flight.values())+rto.rto-\
+                    time.monotonic()
+            elif next_chunk_no is None and probe_chunk_no is not None:
+                wait_time = probe_time+min(rto.rto,eof_linger/2)-\
+                    time.monotonic()
+            try:
+                recv_msgs = batch.recv(max(wait_time,0.001))
+            except socket.timeout:
+                if time.monotonic()-last_ack_time >= sock_timeout:
+                    raise
+                # Change state so timed out chunks are sent again.
                 state = ProgState.SendingFilePkt
-            # Else if EOFPkt is received...
-            elif decoded_data['msg_type'] == MsgType.EOFPkt:
-                # If received file checksum is same as stored file checksum...
-                if decoded_data['file_checksum'] == file_checksum:
-                    draw_progress_bar(curr_chunk_no+1,chunk_count)
-                    # print(f'Chunks sent: {curr_chunk_no+1}')
-                    print('\nTransfer successful')
-                    # print(f'Chunks sent: {curr_chunk_no+1}')
-                # Else...
-                else:
-                    print('Transfer failed')
+                continue
+            handle_start_time = time.perf_counter()
+            prev_acked_chunk_count = acked_chunk_count
+            bad_msg_count = 0
+            # Every msg that arrived in this batch is handled before
+            # the next chunks are sent.
+            for recv_msg in recv_msgs:
+                # recv_msg = temp_debug_buffer
+                if len(recv_msg) < msg_header_struct.size or \
+                    recv_msg[0] != magic_number:
+                    bad_msg_count += 1
+                    continue
+                # print(f'next_chunk_no:{next_chunk_no}',end='\r')
+
+                # Chunks this msg acks.
+                acked_chunk_nos = []
+                # If FilePktAck is received...
+                if recv_msg[1] == file_pkt_ack_type:
+                    chunk_no, chunk_data_checksum = \
+                        decode_file_pkt_ack(recv_msg)
+                    # If the acked chunk is still in flight and received
+                    # chunk checksum is same as the checksum of that
+                    # chunk...
+                    checksum_start = chunk_no*checksum_size
+                    if chunk_no in in_flight and chunk_data_checksum == \
+                        chunk_checksums_view[
+                            checksum_start:checksum_start+checksum_size]:
+                        acked_chunk_nos.append(chunk_no)
+                # Else if SackPkt is received, every chunk before its
+                # base chunk is acked, and so is every chunk whose bit
+                # is set in its bitmap.
+                elif recv_msg[1] == sack_pkt_type:
+                    base_chunk_no, sack_bitmap = decode_sack_pkt(recv_msg)
+                    sack_bit_count = len(sack_bitmap)*8
+                    for chunk_no in in_flight:
+                        offset = chunk_no-base_chunk_no
+                        if offset >= sack_bit_count:
+                            break
+                        if offset < 0 or \
+                            (sack_bitmap[offset >> 3] >> (offset & 7)) & 1:
+                            acked_chunk_nos.append(chunk_no)
+                # Else if NackPkt is received, its chunks are sent again
+                # once this batch is handled.
+                elif recv_msg[1] == nack_pkt_type and in_flight:
+                    first_chunk_no = next(iter(in_flight))
+                    last_chunk_no = next(reversed(in_flight))
+                    for chunk_range in decode_message(
+                        recv_msg)['chunk_ranges']:
+                        for chunk_no in range(
+                            max(chunk_range.start,first_chunk_no),
+                            min(chunk_range.stop,last_chunk_no+1)):
+                            if chunk_no in in_flight:
+                                nacked.add(chunk_no)
+                if acked_chunk_nos:
+                    now = time.monotonic()
+                    for chunk_no in acked_chunk_nos:
+                        rtt = None
+                        if chunk_no not in retransmitted:
+                            rtt = now-in_flight[chunk_no]
+                            rto.on_sample(rtt)
+                            metrics.observe('rtt_seconds',rtt)
+                        if adaptive is not None:
+                            adaptive.on_ack(rtt,now)
+                        retransmitted.discard(chunk_no)
+                        compressed_chunks.discard(chunk_no)
+                        nacked.discard(chunk_no)
+                        del in_flight[chunk_no]
+                        del chunk_buffer[chunk_no]
+                        acked_chunk_count += 1
+                        probe_chunk_no = chunk_no
+                        # print(f'Chunks sent: {acked_chunk_count}',end='\r')
+                    last_ack_time = now
+                    probe_time = now
+                if recv_msg[1] in (file_pkt_ack_type,sack_pkt_type,
+                    nack_pkt_type):
+                    continue
+                decoded_data = decode_message(recv_msg)
+                # print(decoded_data)
+                # Else if EOFPkt is received, the transfer is over.
+                if decoded_data['msg_type'] == MsgType.EOFPkt:
+                    if adaptive is not None:
+                        log(f'\nFinal rate: {format_rate(bucket.rate)}')
+                    if compressor is not None:
+                        compressor.close()
+                        log(f'\nCompressed {compressor.compressed_count} '
+                            f'of {compressor.chunk_count} chunks, sent '
+                            f'{compressor.payload_size} of '
+                            f'{compressor.data_size} bytes')
+                    return decoded_data
+            if bad_msg_count:
+                metrics.count('packets_dropped_bad_magic',bad_msg_count)
+            if acked_chunk_count != prev_acked_chunk_count:
+                metrics.count('chunks_acked',
+                    acked_chunk_count-prev_acked_chunk_count)
+                on_ack(acked_chunk_count)
+            metrics.observe('handle_seconds',
+                time.perf_counter()-handle_start_time)
+            # Change state so next chunks can be sent.
+            state = ProgState.SendingFilePkt
+            # print(f'Chunks sent: {acked_chunk_count}',end='\r')
+
+# Journal of the chunks of a file being received that have made it to
+# disk, so the transfer can be resumed if either side dies. Kept next
+# to the file, as path plus '.journal': a header, then the chunk
+# bitmap. If a journal for the same file checksum, chunk size and chunk
+# count is already there (and so is the file), it's picked up, and
+# resumed is set. Otherwise a new, empty one is written.
+# Chunks are marked with mark() as they're written, and sync() writes
+# out the part of the bitmap that changed, at most every
+# journal_sync_interval seconds. The file data is synced to disk first,
+# so the journal never lists chunks that aren't there. Each stream of a
+# parallel transfer opens the journal separately, and only writes the
+# bytes of the bitmap for its own chunks.
+class ChunkJournal:
+    def __init__(self, path, file_checksum, chunk_size, chunk_count):
+        self.path = path+'.journal'
+        # Padded or cut to the 16 bytes the header holds.
+        self.file_checksum = file_checksum[:16].ljust(16,b'\0')
+        self.chunk_size = chunk_size
+        self.chunk_count = chunk_count
+        self.bitmap = create_bitmap(chunk_count)
+        self.last_chunk_size = 0
+        self.resumed = False
+        try:
+            with open(self.path,'rb') as jf:
+                data = jf.read()
+            magic, checksum, journal_chunk_size, journal_chunk_count, \
+                last_chunk_size = journal_header_struct.unpack_from(data)
+            if os.path.exists(path) and \
+                (magic,checksum,journal_chunk_size,journal_chunk_count) == \
+                (journal_magic,self.file_checksum,chunk_size,chunk_count) and \
+                len(data) == journal_header_struct.size+len(self.bitmap):
+                self.bitmap[:] = data[journal_header_struct.size:]
+                self.last_chunk_size = last_chunk_size
+                self.resumed = True
+        except (OSError,struct.error):
+            pass
+        if self.resumed:
+            self.jf = open(self.path,'r+b')
+        else:
+            self.jf = open(self.path,'wb+')
+            self.jf.write(self.get_header())
+            self.jf.write(self.bitmap)
+            self.jf.flush()
+        # Bytes of the bitmap that changed since the last sync.
+        self.dirty_start = None
+        self.dirty_end = 0
+        self.header_dirty = False
+        self.last_sync_time = time.monotonic()
+
+    def get_header(self):
+        return journal_header_struct.pack(journal_magic,self.file_checksum,
+            self.chunk_size,self.chunk_count,self.last_chunk_size)
+
+    # Notes that chunk_no, whose bit is already set in bitmap, was
+    # written.
+    def mark(self, chunk_no, chunk_data_size):
+        byte_no = chunk_no >> 3
+        if self.dirty_start is None or byte_no < self.dirty_start:
+            self.dirty_start = byte_no
+        self.dirty_end = max(self.dirty_end,byte_no+1)
+        if chunk_no == self.chunk_count-1:
+            self.last_chunk_size = chunk_data_size
+            self.header_dirty = True
+
+    # Writes out what changed, if journal_sync_interval has passed since
+    # the last time or force is set. f is the file the chunks are
+    # written to.
+    def sync(self, f, force=False):
+        if self.dirty_start is None and not self.header_dirty:
+            return
+        now = time.monotonic()
+        if not force and now-self.last_sync_time < journal_sync_interval:
+            return
+        os.fsync(f.fileno())
+        if self.header_dirty:
+            self.jf.seek(0)
+            self.jf.write(self.get_header())
+        if self.dirty_start is not None:
+            self.jf.seek(journal_header_struct.size+self.dirty_start)
+            self.jf.write(self.bitmap[self.dirty_start:self.dirty_end])
+        self.jf.flush()
+        self.dirty_start = None
+        self.dirty_end = 0
+        self.header_dirty = False
+        self.last_sync_time = now
+
+    def close(self, f):
+        self.sync(f,force=True)
+        self.jf.close()
+
+    # Deletes the journal, once the transfer is over.
+    def remove(self):
+        self.jf.close()
+        os.remove(self.path)
+
+# Reads the transfer settings out of the options of a SendReq, falling
+# back to what older senders use for the ones they don't send. Returns
+# (chunk_size, integrity_mode, fec_group_size, compression_mode,
+# ack_mode). Integrity modes this side can't do fall back to crc32, and
+# compression modes it can't do fall back to none. Raises ValueError if
+# the chunk size can't be used.
+def read_send_req_options(options):
+    chunk_size = file_chunk_size
+    if MsgOption.ChunkSize in options:
+        chunk_size = int.from_bytes(options[MsgOption.ChunkSize],'little')
+    if chunk_size < 1 or chunk_size > max_chunk_size:
+        raise ValueError(f'Chunk size {chunk_size} not supported')
+    integrity_mode = IntegrityMode.md5
+    if MsgOption.IntegrityMode in options and \
+        options[MsgOption.IntegrityMode][0] in \
+        IntegrityMode._value2member_map_:
+        integrity_mode = IntegrityMode(options[MsgOption.IntegrityMode][0])
+    if not integrity_mode_supported(integrity_mode):
+        integrity_mode = IntegrityMode.crc32
+    fec_group_size = 0
+    if MsgOption.FecGroupSize in options:
+        fec_group_size = int.from_bytes(
+            options[MsgOption.FecGroupSize],'little')
+    compression_mode = CompressionMode.none
+    if MsgOption.Compression in options and \
+        options[MsgOption.Compression][:1] and \
+        options[MsgOption.Compression][0] in \
+        CompressionMode._value2member_map_:
+        compression_mode = CompressionMode(options[MsgOption.Compression][0])
+    if not compression_mode_supported(compression_mode):
+        compression_mode = CompressionMode.none
+    ack_mode = AckMode.chunk
+    if MsgOption.Sack in options:
+        ack_mode = AckMode.sack
+    return chunk_size, integrity_mode, fec_group_size, compression_mode, \
+        ack_mode
+
+# Returns the options of a SendAccept, which tell the sender the
+# settings the receiver will use. Echoing FecGroupSize and StreamMap
+# lets the sender know FecPkts and parallel streams are understood.
+# When a transfer is resumed, missing_ranges lists the chunks still
+# needed. For a delta transfer, old_file_size is the size of the
+# receiver's old copy, whose signatures follow SendAccept. Compression
+# is only echoed if chunks can be compressed with compression_mode, and
+# Batch (with the number of files) if the file is a bundle that will be
+# unpacked. Sack is echoed if ack_mode is sack.
+def get_send_accept_options(chunk_size, integrity_mode, fec_group_size,
+    stream_map=(), missing_ranges=None, old_file_size=None,
+    compression_mode=CompressionMode.none, batch_file_count=None,
+    ack_mode=AckMode.chunk):
+    options = {
+        MsgOption.IntegrityMode:integrity_mode.value.to_bytes(1,'little'),
+        MsgOption.ChunkSize:chunk_size.to_bytes(4,'little')
+    }
+    if fec_group_size > 0:
+        options[MsgOption.FecGroupSize] = fec_group_size.to_bytes(2,'little')
+    if len(stream_map) > 0:
+        options[MsgOption.StreamMap] = encode_stream_map(stream_map)
+    if missing_ranges is not None:
+        options[MsgOption.MissingChunks] = encode_chunk_ranges(
+            merge_ranges(missing_ranges,max_missing_ranges))
+    if old_file_size is not None:
+        options[MsgOption.Delta] = old_file_size.to_bytes(8,'little')
+    if compression_mode != CompressionMode.none:
+        options[MsgOption.Compression] = \
+            compression_mode.value.to_bytes(1,'little')
+    if batch_file_count is not None:
+        options[MsgOption.Batch] = batch_file_count.to_bytes(4,'little')
+    if ack_mode == AckMode.sack:
+        options[MsgOption.Sack] = b''
+    return options
+
+# Once every chunk has been received, cuts the unused end of the last
+# chunk off f, then hashes the file data that was written, closes f
+# and returns the checksum.
+def finish_file(f, file_size):
+    f.truncate(file_size)
+    f.flush()
+    file_checksum = compute_file_checksum(f)
+    f.close()
+    return file_checksum
+
+# Keeps track of the chunks in chunk_nos (a range) of a file of
+# chunk_count chunks as they're received, and writes them straight to
+# f at their offsets. Every FilePkt is acked with its checksum from
+# chunk_checksum_func, and chunks are rebuilt from FecPkts if
+# fec_group_size is set. With a ChunkJournal, chunks are marked in it as
+# they're written, and the ones it already lists count as received. So
+# do the chunks in copied_ranges, which a delta transfer copied to f
+# from the receiver's old copy of the file. file_size is the size of
+# the file data, if it's already known. Compressed chunks are
+# decompressed for compression_mode. With sack set, FilePkts aren't
+# acked one by one, and the SackPkts and NackPkts that answer them are
+# returned by get_sack_msgs instead. Older senders (that send no
+# options) take a FilePktAck for the chunk that completes the file as
+# the go ahead to send the one after it, which doesn't exist, so unless
+# ack_last_chunk is set, that chunk only gets the EOFPkt. Used by
+# recv_chunks, and by every session of serve.
+class ChunkReceiver:
+    def __init__(self, f, chunk_size, chunk_count, chunk_nos,
+        chunk_checksum_func, fec_group_size, journal=None, copied_ranges=(),
+        file_size=0, compression_mode=CompressionMode.none, sack=False,
+        ack_last_chunk=True):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.chunk_count = chunk_count
+        self.chunk_nos = chunk_nos
+        self.chunk_checksum_func = chunk_checksum_func
+        self.fec_group_size = fec_group_size
+        self.journal = journal
+        self.decompress_func = get_decompress_func(compression_mode,
+            chunk_size)
+        # Bitmap of the chunks that have been written to f.
+        self.chunk_bitmap = create_bitmap(chunk_count)
+        if journal is not None:
+            self.chunk_bitmap = journal.bitmap
+        # Size of the file data. Known once the last chunk is received,
+        # since that's the only chunk that can be shorter than
+        # chunk_size, unless it was given.
+        self.file_size = file_size
+        # Number of distinct chunks received so far. Chunks can arrive
+        # out of order (and more than once) when the sender has several
+        # chunks in flight, so this is what tells us the transfer is
+        # complete.
+        self.recvd_chunk_count = 0
+        # Maps group number to (chunk_size_parity, parity) for FecPkts
+        # whose group is missing more than one chunk, so the last
+        # missing one can be rebuilt once the others arrive.
+        self.fec_groups = {}
+        # Number of chunks rebuilt from FecPkts instead of being
+        # received.
+        self.fec_recovered_count = 0
+        # Number of FilePkts for chunks that were already received.
+        self.duplicate_count = 0
+        if journal is not None and journal.resumed:
+            self.recvd_chunk_count = len(chunk_nos)-sum(
+                len(chunk_range) for chunk_range in intersect_ranges(
+                    bitmap_missing_ranges(self.chunk_bitmap,chunk_count),
+                    chunk_nos))
+            if bitmap_get(self.chunk_bitmap,chunk_count-1):
+                self.file_size = (chunk_count-1)*chunk_size+\
+                    journal.last_chunk_size
+        for chunk_range in intersect_ranges(copied_ranges,chunk_nos):
+            for chunk_no in chunk_range:
+                bitmap_set(self.chunk_bitmap,chunk_no)
+            self.recvd_chunk_count += len(chunk_range)
+        self.sack = sack
+        self.ack_last_chunk = ack_last_chunk
+        # FilePkts (and rebuilt chunks) since the last SackPkt.
+        self.unsacked_count = 0
+        # First chunk of chunk_nos that hasn't been received. Every
+        # chunk before it has.
+        self.first_missing_chunk_no = chunk_nos.start
+        self.advance_first_missing()
+        # Highest chunk number a FilePkt arrived for.
+        self.max_chunk_no = chunk_nos.start-1
+        # Chunks before this one have been checked for loss already,
+        # so each lost chunk is only NACKed once. If it's lost again,
+        # the sender sends it again when its ack doesn't arrive in time.
+        self.nack_chunk_no = chunk_nos.start
+        # recvd_chunk_count, fec_recovered_count and duplicate_count as
+        # of the last count_metrics call.
+        self.counted = (self.recvd_chunk_count,0,0)
+
+    # Whether every chunk in chunk_nos has been received.
+    def done(self):
+        return self.recvd_chunk_count == len(self.chunk_nos)
+
+    # Handles a FilePkt or FecPkt, and packs a FilePktAck for every
+    # chunk it received or rebuilt into the bytearray returned by
+    # ack_slot(), then passes its size to ack_ready(). Other msgs are
+    # ignored.
+    def handle_msg(self, recv_msg, ack_slot, ack_ready):
+        # FEC group that might be down to one missing chunk after this
+        # msg.
+        fec_group_no = None
+        # If FilePkt was received...
+        if recv_msg[1] == file_pkt_type:
+            chunk_no, chunk_data, compressed = decode_file_pkt(recv_msg)
+            # Ignore chunk numbers that aren't part of this transfer.
+            if chunk_no not in self.chunk_nos:
+                return
+            # A chunk that can't be decompressed isn't acked, so it's
+            # sent again.
+            if compressed:
+                if self.decompress_func is None:
+                    return
+                try:
+                    chunk_data = self.decompress_func(chunk_data)
+                except Exception:
+                    return
+            # Write chunk to file, unless it's a duplicate of a chunk
+            # we already have (its ack probably got lost, so it still
+            # gets acked again).
+            # print(chunk_no)
+            if not bitmap_get(self.chunk_bitmap,chunk_no):
+                self.add_chunk(chunk_no,chunk_data)
+                if self.fec_groups and \
+                    chunk_no//self.fec_group_size in self.fec_groups:
+                    fec_group_no = chunk_no//self.fec_group_size
+            else:
+                self.duplicate_count += 1
+            # Queue FilePktAck msg, or count it for the next SackPkt.
+            if self.sack:
+                self.unsacked_count += 1
+                self.max_chunk_no = max(self.max_chunk_no,chunk_no)
+            elif self.ack_last_chunk or not self.done():
+                ack_ready(len(pack_file_pkt_ack(ack_slot(),chunk_no,
+                    self.chunk_checksum_func(chunk_data))))
+        # Else if FecPkt was received, keep its parity until the group
+        # is down to one missing chunk.
+        elif recv_msg[1] == fec_pkt_type and self.fec_group_size > 0:
+            group_no, chunk_size_parity, parity = decode_fec_pkt(recv_msg)
+            if group_no*self.fec_group_size not in self.chunk_nos or \
+                len(parity) > self.chunk_size or group_no in self.fec_groups:
+                return
+            self.fec_groups[group_no] = (chunk_size_parity,bytes(parity))
+            fec_group_no = group_no
+        if fec_group_no is None:
+            return
+        # If exactly one chunk of the group is missing, rebuild it from
+        # the FecPkt and ack it as if it was received. Once none are,
+        # the FecPkt isn't needed anymore.
+        group_chunk_nos = range(fec_group_no*self.fec_group_size,
+            min((fec_group_no+1)*self.fec_group_size,self.chunk_count))
+        missing_chunk_nos = bitmap_missing(self.chunk_bitmap,group_chunk_nos)
+        if len(missing_chunk_nos) > 1:
+            return
+        chunk_size_parity, parity = self.fec_groups.pop(fec_group_no)
+        if len(missing_chunk_nos) == 0:
+            return
+        chunk_no = missing_chunk_nos[0]
+        chunk_data = rebuild_chunk(self.f,self.chunk_size,group_chunk_nos,
+            chunk_no,chunk_size_parity,parity,self.chunk_count-1,
+            self.file_size%self.chunk_size or self.chunk_size)
+        self.add_chunk(chunk_no,chunk_data)
+        self.fec_recovered_count += 1
+        if self.sack:
+            self.unsacked_count += 1
+        elif self.ack_last_chunk or not self.done():
+            ack_ready(len(pack_file_pkt_ack(ack_slot(),chunk_no,
+                self.chunk_checksum_func(chunk_data))))
+
+    # Writes a chunk that hasn't been received before to f.
+    def add_chunk(self, chunk_no, chunk_data):
+        write_chunk(self.f,chunk_no,self.chunk_size,chunk_data)
+        bitmap_set(self.chunk_bitmap,chunk_no)
+        self.recvd_chunk_count += 1
+        if chunk_no == self.chunk_count-1:
+            self.file_size = chunk_no*self.chunk_size+len(chunk_data)
+        if self.journal is not None:
+            self.journal.mark(chunk_no,len(chunk_data))
+        if chunk_no == self.first_missing_chunk_no:
+            self.advance_first_missing()
+
+    # Moves first_missing_chunk_no past the chunks that have been
+    # received.
+    def advance_first_missing(self):
+        while self.first_missing_chunk_no < self.chunk_nos.stop and \
+            bitmap_get(self.chunk_bitmap,self.first_missing_chunk_no):
+            self.first_missing_chunk_no += 1
+
+    # With SACK, returns the msgs that answer the FilePkts handled since
+    # the last call: a SackPkt, and a NackPkt if chunks were found lost.
+    # Returns an empty list if there's nothing to answer.
+    def get_sack_msgs(self):
+        if self.unsacked_count == 0:
+            return []
+        self.unsacked_count = 0
+        # The bitmap is sent from a whole byte on, so it's a slice of
+        # chunk_bitmap.
+        base_chunk_no = self.first_missing_chunk_no & ~7
+        stop_chunk_no = min(self.max_chunk_no+1,
+            base_chunk_no+max_sack_bitmap_size*8)
+        msgs = [encode_message(**{
+            'msg_type':MsgType.SackPkt,'base_chunk_no':base_chunk_no,
+            'bitmap':bytes(self.chunk_bitmap[
+                base_chunk_no >> 3:(stop_chunk_no+7) >> 3])})]
+        # With FEC, a lost chunk might still be rebuilt once the rest of
+        # its group and the FecPkt arrive, so that's waited for too.
+        nack_stop = min(self.max_chunk_no+1-nack_reorder-
+            self.fec_group_size,stop_chunk_no)
+        nack_ranges = []
+        for chunk_no in bitmap_missing(self.chunk_bitmap,range(
+            max(self.nack_chunk_no,self.first_missing_chunk_no),nack_stop)):
+            if nack_ranges and nack_ranges[-1].stop == chunk_no:
+                nack_ranges[-1] = range(nack_ranges[-1].start,chunk_no+1)
+            elif len(nack_ranges) < max_nack_ranges:
+                nack_ranges.append(range(chunk_no,chunk_no+1))
+            else:
+                # The rest are checked next time.
+                nack_stop = chunk_no
+                break
+        self.nack_chunk_no = max(self.nack_chunk_no,nack_stop)
+        if nack_ranges:
+            msgs.append(encode_message(**{
+                'msg_type':MsgType.NackPkt,'chunk_ranges':nack_ranges}))
+        return msgs
+
+    # Adds the chunks received, rebuilt and received again since the
+    # last call to metrics. Called once per batch, instead of counting
+    # every FilePkt.
+    def count_metrics(self):
+        recvd_count, fec_count, duplicate_count = self.counted
+        fec_recovered = self.fec_recovered_count-fec_count
+        if self.recvd_chunk_count != recvd_count:
+            metrics.count('chunks_received',
+                self.recvd_chunk_count-recvd_count-fec_recovered)
+        if fec_recovered:
+            metrics.count('chunks_recovered_fec',fec_recovered)
+        if self.duplicate_count != duplicate_count:
+            metrics.count('chunks_duplicate',
+                self.duplicate_count-duplicate_count)
+        self.counted = (self.recvd_chunk_count,self.fec_recovered_count,
+            self.duplicate_count)
+
+    # Writes out the journal, if there is one and it's time to.
+    def sync_journal(self, force=False):
+        if self.journal is not None:
+            self.journal.sync(self.f,force)
+
+# Receives the chunks in chunk_nos (a range) of a file of chunk_count
+# chunks through batch, once the handshake is done, and writes them
+# straight to f with a ChunkReceiver, marking them in journal if one is
+# given. Chunks in copied_ranges are already in f, and file_size is the
+# size of the file data if it's known, compressed chunks are
+# decompressed for compression_mode, and sack and ack_last_chunk work
+# as for ChunkReceiver. on_progress is called with the number of chunks
+# received so far after every batch.
+# Once every chunk is in, returns (file_size, fec_recovered_count),
+# file_size being 0 unless the file's last chunk is in chunk_nos. If
+# on_done is given, it's called with that instead, and FilePkts that
+# are sent again (because their FilePktAck got lost) keep being acked
+# until none arrive for sock_timeout seconds. If send_accept_msg is
+# given, it's sent again for every SendReq that arrives, since the
+# sender didn't get it.
+def recv_chunks(batch, f, chunk_size, chunk_count, chunk_nos,
+    chunk_checksum_func, fec_group_size, on_progress, on_done=None,
+    journal=None, copied_ranges=(), file_size=0,
+    compression_mode=CompressionMode.none, sack=False,
+    send_accept_msg=None, ack_last_chunk=True):
+    receiver = ChunkReceiver(f,chunk_size,chunk_count,chunk_nos,
+        chunk_checksum_func,fec_group_size,journal,copied_ranges,file_size,
+        compression_mode,sack,ack_last_chunk)
+    try:
+        return recv_chunks_loop(batch,receiver,on_progress,on_done,
+            send_accept_msg)
+    finally:
+        # Whatever was received is kept for next time.
+        receiver.sync_journal(force=True)
+
+def recv_chunks_loop(batch, receiver, on_progress, on_done,
+    send_accept_msg=None):
+    global magic_number
+    global sock_timeout
+    # Set once every chunk is in and on_done was called.
+    done = False
+    state = ProgState.AwaitingFilePkt
+    # If no chunks are missing (there are none, or they were all
+    # received before the transfer was resumed), there are no FilePkts,
+    # so go straight to the end.
+    if receiver.done():
+        state = ProgState.SendingFilePktAck
+
+    # At each iteration, based on state, program does it's job
+    # and then changes state to the relevant ProgState.
+    while True:
+        if state == ProgState.AwaitingFilePkt:
+            # Receive and decode FilePkt.
+            # print('AwaitingFilePkt')
+            try:
+                recv_msgs = batch.recv(sock_timeout)
+            except socket.timeout:
+                if done:
+                    return
+                raise
+            handle_start_time = time.perf_counter()
+            bad_msg_count = 0
+            for recv_msg in recv_msgs:
+                # recv_msg = temp_debug_buffer
+                if len(recv_msg) < msg_header_struct.size or \
+                    recv_msg[0] != magic_number:
+                    bad_msg_count += 1
+                    continue
+                if recv_msg[1] == send_req_type and \
+                    send_accept_msg is not None:
+                    batch.sock.sendto(send_accept_msg,batch.peer_addr)
+                    continue
+                receiver.handle_msg(recv_msg,batch.send_slot,
+                    batch.queue_send)
+            if bad_msg_count:
+                metrics.count('packets_dropped_bad_magic',bad_msg_count)
+            receiver.count_metrics()
+            metrics.observe('handle_seconds',
+                time.perf_counter()-handle_start_time)
+            # Change state so next iteration we send the FilePktAcks.
+            state = ProgState.SendingFilePktAck
+            # break
+        elif state == ProgState.SendingFilePktAck:
+            # Send queued FilePktAcks, or the SackPkt (and NackPkt)
+            # answering the whole batch. They're bigger than the send
+            # slots, and there's only one or two, so they go out
+            # straight away.
+            # print('SendingFilePktAck')
+            batch.flush()
+            for msg in receiver.get_sack_msgs():
+                batch.sock.sendto(msg,batch.peer_addr)
+                metrics.count('packets_sent')
+                metrics.count('bytes_sent',len(msg))
+            receiver.sync_journal()
+            if not done:
+                on_progress(receiver.recvd_chunk_count)
+            # If every chunk has been received...
+            if receiver.done() and not done:
+                result = (receiver.file_size,receiver.fec_recovered_count)
+                if on_done is None:
+                    return result
+                on_done(result)
+                done = True
+            # Change state so next iteration we await another FilePkt.
+            state = ProgState.AwaitingFilePkt
+
+# Delta transfers send only the chunks of a file that changed since an
+# older copy the receiver already has. The receiver hashes every block
+# (chunk_size bytes, but the last one can be shorter) of its copy and
+# sends the signatures to the sender, as if they were a file being sent
+# the other way. The sender rolls the weak hash through its file one
+# byte at a time, like rsync, to find those blocks at any offset, and
+# sends the matches back in CopyBlocks. The receiver copies them into
+# the new file, and every chunk they wholly cover counts as received.
+
+# Hashes every block of chunk_size bytes of file object f, and writes
+# their signatures to sig_f, back to back.
+def write_signatures(f, chunk_size, sig_f):
+    buffer = bytearray(max(read_block_size//chunk_size,1)*chunk_size)
+    buffer_view = memoryview(buffer)
+    f.seek(0)
+    while True:
+        read_size = f.readinto(buffer)
+        if not read_size:
+            break
+        for start in range(0,read_size,chunk_size):
+            block = buffer_view[start:min(start+chunk_size,read_size)]
+            sig_f.write(signature_struct.pack(zlib.adler32(block),
+                hashlib.blake2b(block,digest_size=8).digest()))
+    sig_f.flush()
+
+# Finds the blocks of the receiver's old copy of a file (old_file_size
+# bytes) that are also in file object f, the new version (file_size
+# bytes), from their signatures as written by write_signatures. A last
+# block shorter than chunk_size is only looked for at the end of f.
+# Returns them as runs of blocks that follow each other in both files:
+# (offset in f, first block number, block count), sorted by offset.
+# Rolling through changed data is slow, so keepalive is called after
+# every read_block_size bytes of it, and if too little of the file
+# matches (see delta_probe_size), no runs are returned at all.
+def find_copy_runs(f, file_size, chunk_size, signatures, old_file_size,
+    keepalive):
+    if file_size == 0 or len(signatures) == 0:
+        return []
+    # Block numbers by weak hash, and strong hash of every block.
+    blocks_by_weak = {}
+    strong_hashes = []
+    for block_no, (weak, strong) in enumerate(
+        signature_struct.iter_unpack(signatures)):
+        if (block_no+1)*chunk_size <= old_file_size:
+            blocks_by_weak.setdefault(weak,[]).append(block_no)
+        strong_hashes.append(strong)
+    data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    copy_runs = []
+    # Adds block_no at offset to copy_runs, extending the last run if
+    # the block follows on from it.
+    def add_block(offset, block_no):
+        if copy_runs and copy_runs[-1][0]+copy_runs[-1][2]*chunk_size == \
+            offset and copy_runs[-1][1]+copy_runs[-1][2] == block_no:
+            copy_runs[-1][2] += 1
+        else:
+            copy_runs.append([offset,block_no,1])
+    offset = 0
+    last_offset = file_size-chunk_size
+    weak = None
+    next_keepalive_offset = read_block_size
+    # Bytes of f found in the old copy so far.
+    matched_size = 0
+    while offset <= last_offset:
+        if weak is None:
+            weak = zlib.adler32(data[offset:offset+chunk_size])
+        block_nos = blocks_by_weak.get(weak)
+        if block_nos is not None:
+            strong = hashlib.blake2b(data[offset:offset+chunk_size],
+                digest_size=8).digest()
+            for block_no in block_nos:
+                if strong_hashes[block_no] == strong:
+                    break
+            else:
+                block_no = None
+            if block_no is not None:
+                add_block(offset,block_no)
+                matched_size += chunk_size
+                offset += chunk_size
+                weak = None
+                continue
+        if offset == last_offset:
+            break
+        # Roll the weak hash on by one byte. An Adler-32 is two sums:
+        # of the bytes (low 16 bits), and of those sums (high 16 bits).
+        out_byte = data[offset]
+        in_byte = data[offset+chunk_size]
+        a = ((weak & 0xffff)-out_byte+in_byte)%adler32_modulus
+        b = ((weak >> 16)-chunk_size*out_byte+a-1)%adler32_modulus
+        weak = a | b << 16
+        offset += 1
+        if offset >= next_keepalive_offset:
+            keepalive()
+            next_keepalive_offset = offset+read_block_size
+            if offset >= delta_probe_size and \
+                matched_size < offset*delta_min_match_rate:
+                log(f'Delta: only {matched_size/offset:.0%} of the first '
+                    f'{offset} bytes matched, so every chunk is sent')
+                data.close()
+                return []
+    # A short last block can only be the end of f too.
+    last_block_size = old_file_size%chunk_size
+    tail_offset = file_size-last_block_size
+    if last_block_size > 0 and tail_offset >= 0 and (not copy_runs or
+        copy_runs[-1][0]+copy_runs[-1][2]*chunk_size <= tail_offset):
+        tail = data[tail_offset:]
+        if signature_struct.pack(zlib.adler32(tail),
+            hashlib.blake2b(tail,digest_size=8).digest()) == \
+            signatures[-signature_struct.size:]:
+            add_block(tail_offset,len(strong_hashes)-1)
+    data.close()
+    return [tuple(copy_run) for copy_run in copy_runs]
+
+# Returns the chunks of a file_size byte file that copy_runs wholly
+# cover, as a sorted list of ranges. Runs that touch are joined first,
+# so chunks that span two of them count too. A run ending in a short
+# last block ends at file_size.
+def copied_chunk_ranges(copy_runs, chunk_size, file_size):
+    covered = []
+    for offset, block_no, block_count in copy_runs:
+        end = min(offset+block_count*chunk_size,file_size)
+        if covered and covered[-1][1] == offset:
+            covered[-1][1] = end
+        else:
+            covered.append([offset,end])
+    chunk_ranges = []
+    for start, end in covered:
+        first_chunk_no = -(-start//chunk_size)
+        # The last chunk is the only one that can end before a whole
+        # chunk_size.
+        stop_chunk_no = end//chunk_size
+        if end == file_size:
+            stop_chunk_no = math.ceil(file_size/chunk_size)
+        if first_chunk_no < stop_chunk_no:
+            chunk_ranges.append(range(first_chunk_no,stop_chunk_no))
+    return chunk_ranges
+
+# Returns the chunks of chunk_count that aren't in chunk_ranges (a
+# sorted list of ranges), as a sorted list of ranges.
+def complement_ranges(chunk_ranges, chunk_count):
+    ranges = []
+    start = 0
+    for chunk_range in chunk_ranges:
+        if chunk_range.start > start:
+            ranges.append(range(start,chunk_range.start))
+        start = chunk_range.stop
+    if start < chunk_count:
+        ranges.append(range(start,chunk_count))
+    return ranges
+
+# Copies the blocks in copy_runs from old_f, the receiver's old copy
+# of a file, to their offsets in f, the new version. A short last
+# block is copied as it is.
+def copy_blocks(old_f, f, chunk_size, copy_runs):
+    for offset, block_no, block_count in copy_runs:
+        copied_size = 0
+        while copied_size < block_count*chunk_size:
+            size = min(read_block_size,block_count*chunk_size-copied_size)
+            if hasattr(os,'pread'):
+                data = os.pread(old_f.fileno(),size,
+                    block_no*chunk_size+copied_size)
+                os.pwrite(f.fileno(),data,offset+copied_size)
+            else:
+                old_f.seek(block_no*chunk_size+copied_size)
+                data = old_f.read(size)
+                f.seek(offset+copied_size)
+                f.write(data)
+            if len(data) < size:
+                break
+            copied_size += size
+
+# Receiver side of a delta transfer. Hashes old_f, the receiver's old
+# copy of the file, and sends the signatures to the sender at
+# sender_addr over sock, the same way chunks of a file are sent, until
+# every one is acked or the sender's EOFPkt says they all arrived.
+def send_signatures(sock, sender_addr, old_f, chunk_size,
+    chunk_checksum_func, batch_size):
+    sig_f = tempfile.TemporaryFile()
+    write_signatures(old_f,chunk_size,sig_f)
+    sig_size = os.fstat(sig_f.fileno()).st_size
+    sig_checksum, sig_chunk_checksums = scan_file(
+        sig_f,chunk_size,chunk_checksum_func)
+    batch = DatagramBatch(sock,sender_addr,batch_size,
+        file_pkt_header_size+chunk_size,1250)
+    eof_data = send_chunks(batch,sig_f,sig_size,chunk_size,
+        [range(math.ceil(sig_size/chunk_size))],sig_chunk_checksums,
+        len(chunk_checksum_func(b'')),signature_window_size,None,0,
+        lambda acked_chunk_count: None,return_when_acked=True)
+    sig_f.close()
+    if eof_data is not None and eof_data['file_checksum'] != sig_checksum:
+        raise ValueError('Signatures didn\'t arrive intact')
+
+# Sender side of send_signatures. Receives the signatures of the blocks
+# of the receiver's old copy of the file, old_file_size bytes,
+# and sends back EOFPkt. Returns (signatures, the EOFPkt msg), so the
+# EOFPkt can be sent again if the last FilePktAcks get lost.
+def recv_signatures(sock, recvr_addr, old_file_size, chunk_size,
+    chunk_checksum_func, batch_size):
+    sig_size = math.ceil(old_file_size/chunk_size)*signature_struct.size
+    sig_chunk_count = math.ceil(sig_size/chunk_size)
+    sig_f = tempfile.TemporaryFile()
+    sig_f.truncate(sig_chunk_count*chunk_size)
+    batch = DatagramBatch(sock,recvr_addr,batch_size,
+        file_pkt_header_size+max_checksum_size,
+        file_pkt_header_size+chunk_size)
+    recv_chunks(batch,sig_f,chunk_size,sig_chunk_count,
+        range(sig_chunk_count),chunk_checksum_func,0,
+        lambda recvd_chunk_count: None)
+    sig_f.truncate(sig_size)
+    eof_msg = encode_message(**{
+        'msg_type':MsgType.EOFPkt,
+        'total_filepkts_received':sig_chunk_count,
+        'file_checksum':compute_file_checksum(sig_f)
+    })
+    sock.sendto(eof_msg,recvr_addr)
+    sig_f.seek(0)
+    signatures = sig_f.read()
+    sig_f.close()
+    return signatures, eof_msg
+
+# Sends copy_runs, the runs of blocks the receiver copies from its old
+# copy of the file (file_size bytes), in CopyBlocks msgs of at most
+# copy_runs_per_msg runs each. Up to copy_blocks_window_size of them
+# are in flight, and each is sent again every retransmit_timeout
+# seconds until it's acked. FilePkts of signatures mean the receiver
+# missed sig_eof_msg, so it's sent again. Returns None once every
+# CopyBlocks is acked, or the decoded EOFPkt if the receiver needed no
+# chunks and is already done. Raises socket.timeout if nothing arrives
+# for sock_timeout seconds.
+def send_copy_blocks(sock, recvr_addr, file_size, copy_runs, sig_eof_msg):
+    recv_buffer = bytearray(max_datagram_size)
+    recv_view = memoryview(recv_buffer)
+    # Unacked CopyBlocks msgs by the number of their first run, in
+    # order. With no runs at all, one empty msg still has to be sent.
+    unacked_msgs = {}
+    for first_run in range(0,max(len(copy_runs),1),copy_runs_per_msg):
+        unacked_msgs[first_run] = encode_message(**{
+            'msg_type':MsgType.CopyBlocks,'file_size':file_size,
+            'run_count':len(copy_runs),'first_run':first_run,
+            'copy_runs':copy_runs[first_run:first_run+copy_runs_per_msg]})
+    next_send_times = {}
+    last_msg_time = time.monotonic()
+    try:
+        while True:
+            now = time.monotonic()
+            next_send_time = now+retransmit_timeout
+            for first_run in itertools.islice(unacked_msgs,
+                copy_blocks_window_size):
+                if now >= next_send_times.get(first_run,0):
+                    sock.sendto(unacked_msgs[first_run],recvr_addr)
+                    next_send_times[first_run] = now+retransmit_timeout
+                next_send_time = min(next_send_time,
+                    next_send_times[first_run])
+            sock.settimeout(next_send_time-now)
+            try:
+                recv_size, ret_addr = sock.recvfrom_into(recv_buffer)
+            except socket.timeout:
+                if time.monotonic()-last_msg_time >= sock_timeout:
+                    raise
+                continue
+            recv_msg = recv_view[:recv_size]
+            if ret_addr != recvr_addr or \
+                recv_size < msg_header_struct.size or \
+                recv_msg[0] != magic_number:
+                continue
+            last_msg_time = time.monotonic()
+            if recv_msg[1] == MsgType.CopyBlocksAck.value and \
+                recv_size >= msg_header_struct.size+ \
+                    copy_blocks_ack_struct.size:
+                unacked_msgs.pop(decode_message(recv_msg)['first_run'],None)
+                if not unacked_msgs:
+                    return None
+            elif recv_msg[1] == MsgType.EOFPkt.value:
+                return decode_message(recv_msg)
+            elif recv_msg[1] == file_pkt_type:
+                sock.sendto(sig_eof_msg,recvr_addr)
+    finally:
+        sock.settimeout(sock_timeout)
+
+# Receiver side of send_copy_blocks. Acks every CopyBlocks (again, if
+# it's sent again), and once it has all of the runs, copies their
+# blocks from old_f to f. Any other msg from the sender, like the
+# EOFPkt it sends while it looks for blocks, restarts the wait.
+# Returns (copied chunk ranges, file size) once the first FilePkt or
+# FecPkt shows up on sock or any of stream_socks (it's left there to
+# be received), or straight away if every chunk of chunk_count was
+# copied. Raises socket.timeout if nothing arrives for sock_timeout
+# seconds.
+def recv_copy_blocks(sock, sender_addr, stream_socks, old_f, f,
+    chunk_size, chunk_count):
+    old_file_size = os.fstat(old_f.fileno()).st_size
+    old_block_count = math.ceil(old_file_size/chunk_size)
+    recv_buffer = bytearray(max_datagram_size)
+    recv_view = memoryview(recv_buffer)
+    copied_ranges = None
+    file_size = 0
+    run_count = None
+    # Runs received so far, by the number of the first run of their msg.
+    copy_runs_by_first = {}
+    while True:
+        readable = select.select([sock]+stream_socks,[],[],sock_timeout)[0]
+        if not readable:
+            raise socket.timeout('timed out')
+        # Once every CopyBlocks is acked, FilePkts mean the sender has
+        # started sending chunks.
+        if copied_ranges is not None:
+            if readable != [sock]:
+                break
+            recv_size = sock.recvfrom_into(recv_buffer,0,socket.MSG_PEEK)[0]
+            if recv_size >= 2 and recv_buffer[0] == magic_number and \
+                recv_buffer[1] in (file_pkt_type,fec_pkt_type):
                 break
-            # print(f'Chunks sent: {curr_chunk_no+1}',end='\r')
+        recv_size, ret_addr = sock.recvfrom_into(recv_buffer)
+        recv_msg = recv_view[:recv_size]
+        if ret_addr != sender_addr or \
+            recv_size < msg_header_struct.size+copy_blocks_struct.size or \
+            recv_msg[0] != magic_number or \
+            recv_msg[1] != MsgType.CopyBlocks.value:
+            continue
+        decoded_data = decode_message(recv_msg)
+        first_run = decoded_data['first_run']
+        if copied_ranges is None:
+            copy_runs = decoded_data['copy_runs']
+            if run_count is None:
+                file_size = decoded_data['file_size']
+                run_count = decoded_data['run_count']
+            if math.ceil(file_size/chunk_size) != chunk_count or \
+                decoded_data['file_size'] != file_size or \
+                decoded_data['run_count'] != run_count or \
+                first_run+len(copy_runs) > run_count or \
+                any(block_no+block_count > old_block_count or
+                    offset+min(block_count*chunk_size,
+                        old_file_size-block_no*chunk_size) > file_size
+                    for offset, block_no, block_count in copy_runs):
+                log('Ignoring CopyBlocks: blocks out of range')
+                continue
+            copy_runs_by_first[first_run] = copy_runs
+            if sum(len(copy_runs) for copy_runs in
+                copy_runs_by_first.values()) == run_count:
+                copy_runs = [copy_run
+                    for first_run_no in sorted(copy_runs_by_first)
+                    for copy_run in copy_runs_by_first[first_run_no]]
+                copy_blocks(old_f,f,chunk_size,copy_runs)
+                copied_ranges = copied_chunk_ranges(copy_runs,chunk_size,
+                    file_size)
+        sock.sendto(encode_message(**{'msg_type':MsgType.CopyBlocksAck,
+            'first_run':first_run}),sender_addr)
+        # With every chunk copied, no FilePkts are coming.
+        if copied_ranges is not None and \
+            sum(len(chunk_range) for chunk_range in copied_ranges) == \
+            chunk_count:
+            break
+    return copied_ranges, file_size
+
+# Returns the paths of every file under directory dir_path, relative
+# to it and with '/' between their parts. They're sorted, so the same
+# directory always makes the same bundle, and an interrupted batch
+# transfer can be resumed.
+def list_batch_files(dir_path):
+    paths = []
+    for root, dirs, names in os.walk(dir_path):
+        for name in names:
+            path = os.path.join(root,name)
+            if os.path.isfile(path):
+                paths.append(os.path.relpath(path,dir_path).replace(
+                    os.sep,'/'))
+    return sorted(paths)
+
+# Packs every file under directory dir_path into bundle_f, a file
+# opened for writing in binary mode, for a batch transfer: the
+# manifest first, then the data of each file back to back, so the
+# bundle can be sent like any other file, and small files share chunks
+# instead of taking a FilePkt each. Returns the number of files.
+def write_bundle(dir_path, bundle_f):
+    paths = list_batch_files(dir_path)
+    encoded_paths = [path.encode() for path in paths]
+    for encoded_path in encoded_paths:
+        if len(encoded_path) > 0xffff:
+            raise ValueError(f'Path too long: {encoded_path[:64]}...')
+    # File data goes after the manifest, which is written last, once
+    # every file's size and checksum are known.
+    bundle_f.seek(manifest_header_struct.size+sum(
+        manifest_entry_struct.size+len(encoded_path)
+        for encoded_path in encoded_paths))
+    buffer = bytearray(read_block_size)
+    buffer_view = memoryview(buffer)
+    entries = []
+    for path in paths:
+        file_checksum = hashlib.md5()
+        file_size = 0
+        with open(os.path.join(dir_path,*path.split('/')),'rb') as f:
+            while True:
+                read_size = f.readinto(buffer)
+                if not read_size:
+                    break
+                file_checksum.update(buffer_view[:read_size])
+                bundle_f.write(buffer_view[:read_size])
+                file_size += read_size
+        entries.append((file_size,file_checksum.digest()))
+    bundle_f.seek(0)
+    bundle_f.write(manifest_header_struct.pack(len(paths)))
+    for encoded_path, (file_size, file_checksum) in zip(encoded_paths,
+        entries):
+        bundle_f.write(manifest_entry_struct.pack(file_size,
+            len(encoded_path),file_checksum))
+        bundle_f.write(encoded_path)
+    return len(paths)
+
+# Reads the manifest at the start of bundle_f and returns a list of
+# (path, file_size, file_checksum), path being split into its parts.
+# Raises ValueError if the manifest is cut short, or lists a path that
+# would end up outside the directory the bundle is unpacked into.
+def read_manifest(bundle_f):
+    bundle_f.seek(0)
+    header = bundle_f.read(manifest_header_struct.size)
+    if len(header) < manifest_header_struct.size:
+        raise ValueError('Manifest cut short')
+    entries = []
+    for i in range(manifest_header_struct.unpack(header)[0]):
+        entry = bundle_f.read(manifest_entry_struct.size)
+        if len(entry) < manifest_entry_struct.size:
+            raise ValueError('Manifest cut short')
+        file_size, path_size, file_checksum = \
+            manifest_entry_struct.unpack(entry)
+        encoded_path = bundle_f.read(path_size)
+        if len(encoded_path) < path_size:
+            raise ValueError('Manifest cut short')
+        path = encoded_path.decode(errors='replace')
+        path_parts = path.split('/')
+        if any(part in ('','.','..') or
+            os.sep in part or (os.altsep and os.altsep in part)
+            for part in path_parts):
+            raise ValueError(f'Bad path in manifest: {path}')
+        entries.append((path_parts,file_size,file_checksum))
+    return entries
+
+# Unpacks the bundle at bundle_path into directory dir_path, creating
+# it and any directories under it that are needed. Files that are
+# already there are overwritten. Returns (file count, paths of the
+# files whose data doesn't match their checksum in the manifest).
+def unpack_bundle(bundle_path, dir_path):
+    buffer = bytearray(read_block_size)
+    buffer_view = memoryview(buffer)
+    bad_paths = []
+    with open(bundle_path,'rb') as bundle_f:
+        entries = read_manifest(bundle_f)
+        os.makedirs(dir_path,exist_ok=True)
+        for path_parts, file_size, file_checksum in entries:
+            path = os.path.join(dir_path,*path_parts)
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            data_checksum = hashlib.md5()
+            with open(path,'wb') as f:
+                left = file_size
+                while left > 0:
+                    read_size = bundle_f.readinto(
+                        buffer_view[:min(left,read_block_size)])
+                    if not read_size:
+                        break
+                    data_checksum.update(buffer_view[:read_size])
+                    f.write(buffer_view[:read_size])
+                    left -= read_size
+            if data_checksum.digest() != file_checksum:
+                bad_paths.append('/'.join(path_parts))
+    return len(entries), bad_paths
 
-    # print(list(msg))
-    # print('Closing socket.')
+# Once the bundle of a batch transfer at bundle_path is received,
+# unpacks it into directory dir_path and deletes it. Returns whether
+# every file came out intact. If not, says what went wrong, and the
+# bundle is kept.
+def finish_batch(bundle_path, dir_path):
+    try:
+        file_count, bad_paths = unpack_bundle(bundle_path,dir_path)
+    except (OSError,ValueError) as e:
+        log(f'Can\'t unpack {bundle_path}: {e}')
+        return False
+    if len(bad_paths) > 0:
+        log('Files that don\'t match their checksum: '+', '.join(bad_paths))
+        return False
+    os.remove(bundle_path)
+    log(f'Unpacked {file_count} files into {dir_path}')
+    return True
+
+# Runs in its own process for each stream of a parallel transfer, and
+# sends the chunks in chunk_ranges (a sorted list of ranges) over sock,
+# which is already bound to the stream's port. Adds to acked_counter (a
+# shared Value) as chunks are acked, and returns once every chunk is.
+# Chunks are compressed for compression_mode, and rto is the
+# RtoEstimator of the handshake.
+def send_stream(sock, recvr_addr, filename, file_size, chunk_size,
+    chunk_ranges, chunk_checksums, checksum_size, window_size, rate,
+    fec_group_size, batch_size, acked_counter, compression_mode, rto,
+    metrics_queue):
+    # Only what this stream does is counted, and sent back at the end.
+    metrics.reset()
+    f = open(filename,'rb')
+    batch = DatagramBatch(sock,recvr_addr,batch_size,
+        file_pkt_header_size+chunk_size,max_ack_msg_size)
+    # Chunks acked that acked_counter already knows about.
+    counted = [0]
+    def on_ack(acked_chunk_count):
+        with acked_counter.get_lock():
+            acked_counter.value += acked_chunk_count-counted[0]
+        counted[0] = acked_chunk_count
+    send_chunks(batch,f,file_size,chunk_size,chunk_ranges,chunk_checksums,
+        checksum_size,window_size,rate,fec_group_size,on_ack,
+        return_when_acked=True,
+        compress_func=get_compress_func(compression_mode),rto=rto)
+    f.close()
     sock.close()
+    metrics_queue.put(metrics.snapshot())
+
+# Runs in its own process for each stream of a parallel transfer, and
+# receives the chunks in chunk_nos over sock, which is already bound to
+# the stream's port. Adds to recvd_counter (a shared Value) as chunks
+# arrive. If resume is set, they're marked in the journal of filename,
+# which is opened again here. copied_ranges, file_size,
+# compression_mode and ack_mode are passed on to recv_chunks. Once
+# every chunk is in, puts (stream_no, file_size, fec_recovered_count,
+# metrics snapshot) on result_queue, then keeps acking FilePkts that
+# are sent again until it's terminated or none arrive for a while.
+def recv_stream(sock, sender_addr, filename, chunk_size, chunk_count,
+    chunk_nos, integrity_mode, fec_group_size, batch_size, recvd_counter,
+    result_queue, stream_no, file_checksum, resume, copied_ranges,
+    file_size, compression_mode, ack_mode):
+    # Only what this stream does is counted, and sent back with the
+    # result.
+    metrics.reset()
+    f = open(filename,'r+b')
+    journal = None
+    if resume:
+        journal = ChunkJournal(filename,file_checksum,chunk_size,
+            chunk_count)
+    batch = DatagramBatch(sock,sender_addr,batch_size,
+        file_pkt_header_size+max_checksum_size,
+        file_pkt_header_size+chunk_size)
+    # Chunks received that recvd_counter already knows about.
+    counted = [0]
+    def on_progress(recvd_chunk_count):
+        with recvd_counter.get_lock():
+            recvd_counter.value += recvd_chunk_count-counted[0]
+        counted[0] = recvd_chunk_count
+    recv_chunks(batch,f,chunk_size,chunk_count,chunk_nos,
+        get_chunk_checksum_func(integrity_mode),fec_group_size,on_progress,
+        on_done=lambda result: result_queue.put(
+            (stream_no,)+result+(metrics.snapshot(),)),
+        journal=journal,copied_ranges=copied_ranges,file_size=file_size,
+        compression_mode=compression_mode,sack=ack_mode == AckMode.sack)
+    if journal is not None:
+        journal.close(f)
+    f.close()
+    sock.close()
+
+# Sends send_accept_msg again for every SendReq from sender_addr
+# waiting on sock, without blocking. Other msgs are dropped.
+def answer_send_reqs(sock, sender_addr, send_accept_msg):
+    recv_buffer = bytearray(max_datagram_size)
+    while select.select([sock],[],[],0)[0]:
+        try:
+            recv_size, ret_addr = sock.recvfrom_into(recv_buffer)
+        except OSError:
+            continue
+        if ret_addr == sender_addr and recv_size >= 2 and \
+            recv_buffer[0] == magic_number and \
+            recv_buffer[1] == send_req_type:
+            sock.sendto(send_accept_msg,sender_addr)
+
+# Once the receiver has sent eof_msg (EOFPkt), the sender may still be
+# waiting for it if it got lost, or for the ack of its last chunk. Any
+# msg from the sender's host, on sock or any of stream_socks, means
+# that, so eof_msg is sent again (once for every batch of them that
+# arrives). Returns once none have arrived for eof_linger seconds.
+def linger_eof(sock, stream_socks, sender_addr, eof_msg):
+    recv_buffer = bytearray(max_datagram_size)
+    while True:
+        readable = select.select([sock]+stream_socks,[],[],eof_linger)[0]
+        if not readable:
+            return
+        heard = False
+        for readable_sock in readable:
+            while select.select([readable_sock],[],[],0)[0]:
+                try:
+                    ret_addr = readable_sock.recvfrom_into(recv_buffer)[1]
+                except OSError:
+                    continue
+                if ret_addr[0] == sender_addr[0]:
+                    heard = True
+        if heard:
+            sock.sendto(eof_msg,sender_addr)
+
+# Waits for the worker processes of a parallel transfer while drawing
+# the progress of counter (a shared Value) out of chunk_count. Returns
+# as soon as done() returns True, which it's asked every
+# stream_poll_interval seconds. Raises socket.timeout if counter
+# doesn't move for sock_timeout seconds. Worker processes are
+# terminated either way.
+def wait_for_streams(workers, counter, chunk_count, done):
+    global sock_timeout
+    last_count = -1
+    last_progress_time = time.monotonic()
+    try:
+        while not done():
+            if counter.value != last_count:
+                last_count = counter.value
+                last_progress_time = time.monotonic()
+                draw_progress_bar(last_count,chunk_count)
+            elif time.monotonic()-last_progress_time >= sock_timeout:
+                raise socket.timeout('timed out')
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+# Raised by Sender and Receiver when a transfer doesn't go through.
+class TransferError(Exception):
+    pass
+
+# Nothing arrived from the other side for sock_timeout seconds. Also a
+# TimeoutError, like the socket.timeout it stands for.
+class TransferTimeout(TransferError, TimeoutError):
     pass
 
-def recv(filename, sender_addr, recvr_addr):
+# Every chunk arrived, but the receiver's checksum of the file didn't
+# match the sender's (or a batch couldn't be unpacked).
+class ChecksumMismatch(TransferError):
+    pass
+
+# The receiver can't take the transfer the way it was asked for, like
+# an older version that only knows 1024 byte chunks. Raised by send too,
+# and also a ValueError, which it used to raise.
+class ReceiverUnsupported(TransferError, ValueError):
+    pass
+
+# What a transfer came to, returned by send and recv, and by Sender and
+# Receiver. ok is whether the receiver's checksum of the file matched
+# the sender's. elapsed is the seconds the whole transfer took, hashing
+# the file included. counters holds what the metrics counters counted
+# during it (a loopback transfer's sides count into the same ones).
+# data holds the file, if Receiver was given no sink to write it to.
+class TransferResult:
+    def __init__(self, ok, file_size, chunk_count, elapsed, file_checksum,
+        fec_recovered_count=0, counters=None):
+        self.ok = ok
+        self.file_size = file_size
+        self.chunk_count = chunk_count
+        self.elapsed = elapsed
+        self.file_checksum = file_checksum
+        self.fec_recovered_count = fec_recovered_count
+        self.counters = counters or {}
+        # Bytes of file data per second.
+        self.rate = file_size/elapsed if elapsed > 0 else 0
+        self.data = None
+
+    def __repr__(self):
+        return f'TransferResult(ok={self.ok}, file_size={self.file_size}, '+\
+            f'elapsed={self.elapsed:.3f})'
+
+# Returns how much each metrics counter went up since it was start_counters.
+def counters_since(start_counters):
+    return {name:value-start_counters.get(name,0)
+        for name, value in dict(metrics.counters).items()
+        if value != start_counters.get(name,0)}
+
+# Sends file (or directory) filename from sender_addr to recvr_addr.
+# If sock is given, it's used instead of binding a socket to
+# sender_addr (which should then be its address), and left open. name
+# is sent in FileName, for serve to save the file under, instead of
+# filename's base name. Returns a TransferResult.
+def send(filename, sender_addr, recvr_addr, window_size=1,
+    integrity_mode=IntegrityMode.crc32, chunk_size=file_chunk_size,
+    probe_mtu=False, batch_size=64, sock_buffer_size=None, rate=None,
+    fec_group_size=0, streams=1, delta=False,
+    compression_mode=CompressionMode.none, ack_mode=AckMode.sack,
+    sock=None, name=None):
     global magic_number
     global sock_timeout
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(recvr_addr)
+    start_time = time.monotonic()
+    start_counters = dict(metrics.counters)
+    if window_size < 1:
+        raise ValueError('Window size must be at least 1')
+    if chunk_size < 1 or chunk_size > max_chunk_size:
+        raise ValueError(f'Chunk size must be between 1 and {max_chunk_size}')
+    if not integrity_mode_supported(integrity_mode):
+        raise ValueError(f'{integrity_mode.name} needs the xxhash package')
+    if not compression_mode_supported(compression_mode):
+        package = compression_mode.name
+        if compression_mode == CompressionMode.zstd:
+            package = 'zstandard'
+        raise ValueError(f'{compression_mode.name} needs the {package} '
+            'package')
+    if batch_size < 1:
+        raise ValueError('Batch size must be at least 1')
+    if rate is not None and rate != 'auto' and rate <= 0:
+        raise ValueError('Rate must be above 0')
+    if fec_group_size < 0 or fec_group_size > 0xffff:
+        raise ValueError('FEC group size must be between 0 and 65535')
+    if streams < 1 or streams > max_streams:
+        raise ValueError(f'Streams must be between 1 and {max_streams}')
+    # print('Opening socket.')
+    own_sock = sock is None
+    if own_sock:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        log(f'Binding socket to {sender_addr}')
+        sock.bind(sender_addr)
     sock.settimeout(sock_timeout)
-    recv_buffer_size = 1250
+    if sock_buffer_size is not None:
+        set_sock_buffer_size(sock,sock_buffer_size)
+    # The chunk size has to be known before the file is read, so the
+    # path MTU is probed first.
+    if probe_mtu:
+        log(f'Probing path MTU to {recvr_addr}')
+        probed_chunk_size = probe_path_mtu(sock,recvr_addr)
+        if probed_chunk_size is None:
+            log(f'Path MTU unknown, using chunk size {chunk_size}')
+        else:
+            chunk_size = probed_chunk_size
+            log(f'Using chunk size {chunk_size}')
+    # File data isn't read into memory up front. Chunks are read from
+    # the file when they are sent for the first time, and only kept
+    # until they are acked.
+    # A directory is sent as a batch: its files are packed into a
+    # bundle in the temp directory, which is sent like any other file,
+    # and unpacked by the receiver.
+    batch_file_count = None
+    bundle_path = None
+    f = None
+    stream_socks = []
+    # The bundle is deleted, and the file and sockets closed, however
+    # the transfer ends.
+    try:
+        if os.path.isdir(filename):
+            log(f'Packing {filename}...')
+            fd, bundle_path = tempfile.mkstemp(suffix='.bundle')
+            with open(fd,'wb') as bundle_f:
+                batch_file_count = write_bundle(filename,bundle_f)
+            log(f'Files: {batch_file_count}')
+        log('Reading file...')
+        f = open(filename if bundle_path is None else bundle_path,'rb')
+        file_size = os.fstat(f.fileno()).st_size
+        # The checksum of every chunk is worked out here, in the same pass
+        # as the file checksum, rather than in the send loop. With SACK
+        # they aren't needed, unless the receiver turns out not to
+        # support it.
+        chunk_checksum_func = get_chunk_checksum_func(integrity_mode)
+        scan_checksum_func = chunk_checksum_func
+        if ack_mode == AckMode.sack:
+            scan_checksum_func = get_chunk_checksum_func(IntegrityMode.none)
+        file_checksum, chunk_checksums = scan_file(
+            f,chunk_size,scan_checksum_func)
+        checksum_size = len(scan_checksum_func(b''))
+        chunk_count = math.ceil(file_size/chunk_size)
+        log(f'File Data Size: {file_size}, Chunk Count:{chunk_count}')
+        log('Reading complete.')
+        recv_buffer_size = 1250
+        # Handshake msgs are received into one reusable buffer and decoded
+        # from memoryview slices of it. Once the transfer starts, FilePkts
+        # and FilePktAcks go through batch, which packs and receives them
+        # in preallocated slots, many per syscall.
+        recv_buffer = bytearray(recv_buffer_size)
+        recv_view = memoryview(recv_buffer)
+        batch = DatagramBatch(sock,recvr_addr,batch_size,
+            file_pkt_header_size+chunk_size,recv_buffer_size)
+        # With more than one stream, the chunks are split into ranges, each
+        # sent by its own process over its own socket, bound to the ports
+        # after sender_addr's. stream_map holds (chunk_nos, sender_port,
+        # recvr_port) for each of them, and is sent in SendReq.
+        stream_map = []
+        stream_socks = []
+        stream_chunk_nos = split_chunks(chunk_count,streams,
+            math.lcm(8,max(fec_group_size,1)))
+        if len(stream_chunk_nos) > 1:
+            for stream_no, chunk_nos in enumerate(stream_chunk_nos):
+                stream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                stream_sock.bind((sender_addr[0],sender_addr[1]+1+stream_no))
+                if sock_buffer_size is not None:
+                    set_sock_buffer_size(stream_sock,sock_buffer_size)
+                stream_socks.append(stream_sock)
+                stream_map.append((chunk_nos,sender_addr[1]+1+stream_no,
+                    recvr_addr[1]+1+stream_no))
+        # Random id of this transfer, sent in SendReq.
+        transfer_id = int.from_bytes(os.urandom(4),'little')
+        # Chunks to send, as a sorted list of ranges. Every chunk, unless
+        # the receiver is resuming an earlier transfer of the file and
+        # lists the ones it's missing in SendAccept.
+        send_ranges = [range(chunk_count)]
+        # Size of the receiver's old copy of the file, if it does a delta
+        # transfer.
+        old_file_size = None
+        # SendReq is sent again whenever SendAccept doesn't arrive within
+        # the RTO, which backs off each time, until sock_timeout seconds
+        # have passed since the first one. If it was only sent once,
+        # SendAccept gives the first RTT sample.
+        rto = RtoEstimator()
+        first_send_req_time = None
+        send_req_time = None
+        send_req_count = 0
+        state = ProgState.SendingSendReq
+
+        # Debugging code
+        # ------------------------------------
+        # SendAccept
+        # temp_recvr_addr = ('192.168.8.103',9510)
+    #     temp_debug_buffer = [26, 2, 19, 0, 0, 0, 18, 49, 57, 50, 46, 49, 54, 56, 46, 56, 46, 49, 49, 49, 58, 57,
+    # 53, 49, 48]
+    #     temp_debug_buffer = bytes(temp_debug_buffer)
+    #     state = ProgState.AwaitingSendAccept
+        # ------------------------------------
+
+        # At each iteration, based on state, program does it's job
+        # and then changes state to the relevant ProgState. Once SendAccept
+        # is received, the loop ends and file data is sent.
+        while True:
+            # break
+            if state == ProgState.SendingSendReq:
+                # Create and send SendReq msg.
+                log(f'Sending SendReq to {recvr_addr}')
+                options = {
+                    MsgOption.IntegrityMode:
+                        integrity_mode.value.to_bytes(1,'little'),
+                    MsgOption.ChunkSize:chunk_size.to_bytes(4,'little')
+                }
+                if fec_group_size > 0:
+                    options[MsgOption.FecGroupSize] = \
+                        fec_group_size.to_bytes(2,'little')
+                if len(stream_map) > 1:
+                    options[MsgOption.StreamMap] = encode_stream_map(stream_map)
+                # A server in serve mode tells transfers apart by TransferId,
+                # and saves the file under FileName.
+                options[MsgOption.TransferId] = transfer_id.to_bytes(4,'little')
+                if name is None:
+                    name = os.path.basename(os.path.normpath(filename))
+                options[MsgOption.FileName] = name.encode()
+                if batch_file_count is not None:
+                    options[MsgOption.Batch] = \
+                        batch_file_count.to_bytes(4,'little')
+                if delta:
+                    options[MsgOption.Delta] = b''
+                if compression_mode != CompressionMode.none:
+                    options[MsgOption.Compression] = \
+                        compression_mode.value.to_bytes(1,'little')
+                if ack_mode == AckMode.sack:
+                    options[MsgOption.Sack] = b''
+                msg = encode_message(**{
+                    'msg_type':MsgType.SendReq,'file_checksum':file_checksum,
+                    'addr':f'{sender_addr[0]}:{str(sender_addr[1])}',
+                    'chunk_count':chunk_count,'options':options})
+                sock.sendto(msg,recvr_addr)
+                send_req_time = time.monotonic()
+                if first_send_req_time is None:
+                    first_send_req_time = send_req_time
+                send_req_count += 1
+                # sock.sendto(b'abcdef',addr)
+                # print(f'{addr[0]}:{str(addr[1])}')
+                # print(len(msg))
+                # Change state so at next iteration we are awaiting
+                # SendAccept msg.
+                state = ProgState.AwaitingSendAccept
+                # break
+            elif state == ProgState.AwaitingSendAccept:
+                # Receive and decode SendAccept msg
+                log(f'Awaiting SendAccept')
+                sock.settimeout(max(send_req_time+rto.rto-time.monotonic(),
+                    0.001))
+                try:
+                    recv_size, ret_addr = sock.recvfrom_into(recv_buffer)
+                except socket.timeout:
+                    now = time.monotonic()
+                    if now-first_send_req_time >= sock_timeout:
+                        raise
+                    rto.backoff(send_req_time,now)
+                    state = ProgState.SendingSendReq
+                    continue
+                finally:
+                    sock.settimeout(sock_timeout)
+                recv_msg = recv_view[:recv_size]
+
+                # If data is received from any address other than recvr_addr
+                # it's not meant for this program, so ignore it and continue
+                # to next iteration.
+                if ret_addr == recvr_addr:
+                    log(f'Received SendAccept from {recvr_addr}')
+                else:
+                    continue
+
+                # recv_msg = temp_debug_buffer
+                if recv_size < msg_header_struct.size or \
+                    recv_msg[0] != magic_number:
+                    continue
+                decoded_data = decode_message(recv_msg)
+                # print(decoded_data)
+                if decoded_data['msg_type'] == MsgType.SendAccept:
+                    if send_req_count == 1:
+                        rto.on_sample(time.monotonic()-send_req_time)
+                    # Older receivers don't send options, and can only take
+                    # chunks of file_chunk_size.
+                    if MsgOption.ChunkSize not in decoded_data['options'] and \
+                        chunk_size != file_chunk_size:
+                        raise ReceiverUnsupported(
+                            'Receiver only supports a chunk size '
+                            f'of {file_chunk_size}')
+                    # The receiver may have picked a different integrity
+                    # mode, or be an older version that only knows md5.
+                    accepted_mode = IntegrityMode.md5
+                    if MsgOption.IntegrityMode in decoded_data['options']:
+                        accepted_value = \
+                            decoded_data['options'][MsgOption.IntegrityMode]
+                        if len(accepted_value) < 1:
+                            raise ReceiverUnsupported('Receiver sent an '
+                                'empty integrity mode')
+                        if accepted_value[0] not in \
+                            IntegrityMode._value2member_map_:
+                            raise ReceiverUnsupported('Receiver chose '
+                                f'unknown integrity mode {accepted_value[0]}')
+                        accepted_mode = IntegrityMode(accepted_value[0])
+                    if accepted_mode != integrity_mode:
+                        log('Receiver chose integrity mode '
+                            f'{accepted_mode.name}')
+                        integrity_mode = accepted_mode
+                        chunk_checksum_func = get_chunk_checksum_func(
+                            integrity_mode)
+                    # Receivers echo Sack if they support it. Older ones
+                    # send a FilePktAck for every chunk.
+                    if ack_mode == AckMode.sack and \
+                        MsgOption.Sack not in decoded_data['options']:
+                        log('Receiver doesn\'t support SACK')
+                        ack_mode = AckMode.chunk
+                    # If FilePktAcks will be checked and the chunk
+                    # checksums weren't worked out for that, they're
+                    # worked out again.
+                    if ack_mode == AckMode.chunk and \
+                        scan_checksum_func is not chunk_checksum_func:
+                        scan_checksum_func = chunk_checksum_func
+                        chunk_checksums = scan_file(
+                            f,chunk_size,chunk_checksum_func)[1]
+                        checksum_size = len(chunk_checksum_func(b''))
+                    # Older receivers don't know FecPkts.
+                    if fec_group_size > 0 and \
+                        MsgOption.FecGroupSize not in decoded_data['options']:
+                        log('Receiver doesn\'t support FEC')
+                        fec_group_size = 0
+                    # Receivers echo StreamMap if they set up every stream.
+                    # Otherwise everything goes over the one socket.
+                    if len(stream_map) > 1 and \
+                        MsgOption.StreamMap not in decoded_data['options']:
+                        log('Receiver doesn\'t support parallel streams')
+                        stream_map = []
+                    if MsgOption.MissingChunks in decoded_data['options']:
+                        send_ranges = decode_chunk_ranges(
+                            decoded_data['options'][MsgOption.MissingChunks],
+                            chunk_count)
+                        log('Resuming: '+str(chunk_count-sum(
+                            len(chunk_range) for chunk_range in send_ranges))+
+                            f' of {chunk_count} chunks already received')
+                    # Older receivers would save the bundle as it is.
+                    if batch_file_count is not None and \
+                        MsgOption.Batch not in decoded_data['options']:
+                        raise ReceiverUnsupported('Receiver doesn\'t support '
+                            'batch transfers')
+                    if delta and MsgOption.Delta in decoded_data['options']:
+                        old_file_size = int.from_bytes(
+                            decoded_data['options'][MsgOption.Delta],'little')
+                    elif delta:
+                        log('Receiver has no old copy to update, '
+                            'sending every chunk')
+                    # Receivers echo Compression if they can decompress
+                    # chunks. Older ones don't know it.
+                    if compression_mode != CompressionMode.none and \
+                        MsgOption.Compression not in decoded_data['options']:
+                        log('Receiver doesn\'t support compression '
+                            f'{compression_mode.name}')
+                        compression_mode = CompressionMode.none
+                    # SendAccept received, so file data can be sent.
+                    break
+                # print(decoded_data)
+                # break
+
+        # For a delta transfer, get the signatures of the receiver's old
+        # copy, and tell it which of its blocks to copy. Only the chunks
+        # they don't cover are sent.
+        eof_data = None
+        if old_file_size is not None:
+            log(f'Receiving signatures of the receiver\'s old copy '
+                f'({old_file_size} bytes)')
+            signatures, sig_eof_msg = recv_signatures(sock,recvr_addr,
+                old_file_size,chunk_size,chunk_checksum_func,batch_size)
+            # The receiver is kept waiting while the blocks are looked for,
+            # so it's sent the EOFPkt of the signatures again now and then.
+            last_keepalive_time = [time.monotonic()]
+            def keepalive():
+                now = time.monotonic()
+                if now-last_keepalive_time[0] >= retransmit_timeout:
+                    sock.sendto(sig_eof_msg,recvr_addr)
+                    last_keepalive_time[0] = now
+            copy_runs = find_copy_runs(f,file_size,chunk_size,signatures,
+                old_file_size,keepalive)
+            send_ranges = complement_ranges(
+                copied_chunk_ranges(copy_runs,chunk_size,file_size),chunk_count)
+            log('Delta: '+str(sum(len(chunk_range)
+                for chunk_range in send_ranges))+
+                f' of {chunk_count} chunks changed')
+            eof_data = send_copy_blocks(sock,recvr_addr,file_size,copy_runs,
+                sig_eof_msg)
+        # Chunks the receiver already had count as acked for the progress
+        # bar.
+        resumed_chunk_count = chunk_count-sum(
+            len(chunk_range) for chunk_range in send_ranges)
+        if eof_data is not None:
+            # The receiver copied every chunk, and is already done.
+            pass
+        elif len(stream_map) > 1:
+            # Each stream gets its share of the rate.
+            stream_rate = rate
+            if rate is not None and rate != 'auto':
+                stream_rate = rate/len(stream_map)
+            acked_counter = multiprocessing.Value('q',resumed_chunk_count)
+            metrics_queue = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=send_stream,args=(
+                stream_socks[stream_no],(recvr_addr[0],recvr_port),f.name,
+                file_size,chunk_size,intersect_ranges(send_ranges,chunk_nos),
+                chunk_checksums,checksum_size,
+                window_size,stream_rate,fec_group_size,batch_size,
+                acked_counter,compression_mode,rto,metrics_queue),daemon=True)
+                for stream_no, (chunk_nos, sender_port, recvr_port)
+                in enumerate(stream_map)]
+            for worker in workers:
+                worker.start()
+            log(f'Sending over {len(workers)} streams')
+            # The receiver sends EOFPkt on the main socket once every
+            # stream is done. Once every chunk is acked, the last chunk is
+            # sent there now and then, so a lost EOFPkt is sent again.
+            # Once it's in, the workers' metrics are waited for, for up
+            # to eof_linger seconds.
+            eof_data = []
+            eof_time = [None]
+            probe_time = [None]
+            stream_snapshots = []
+            def eof_received():
+                now = time.monotonic()
+                if eof_data:
+                    try:
+                        stream_snapshots.append(
+                            metrics_queue.get(timeout=stream_poll_interval))
+                    except queue.Empty:
+                        pass
+                    return len(stream_snapshots) == len(workers) or \
+                        now-eof_time[0] >= eof_linger
+                if acked_counter.value == chunk_count and chunk_count > 0:
+                    if probe_time[0] is None:
+                        probe_time[0] = now
+                    elif now-probe_time[0] >= min(rto.rto,eof_linger/2):
+                        chunk_data = read_chunk(f,chunk_count-1,chunk_size)
+                        sock.sendto(encode_message(**{
+                            'msg_type':MsgType.FilePkt,
+                            'chunk_no':chunk_count-1,
+                            'chunk_size':len(chunk_data),
+                            'chunk_data':chunk_data}),recvr_addr)
+                        probe_time[0] = now
+                try:
+                    recv_msgs = batch.recv(stream_poll_interval)
+                except socket.timeout:
+                    return False
+                for recv_msg in recv_msgs:
+                    if len(recv_msg) >= msg_header_struct.size and \
+                        recv_msg[0] == magic_number and \
+                        recv_msg[1] == MsgType.EOFPkt.value:
+                        eof_data.append(decode_message(recv_msg))
+                        eof_time[0] = now
+                        return False
+                return False
+            wait_for_streams(workers,acked_counter,chunk_count,eof_received)
+            for snapshot in stream_snapshots:
+                metrics.merge(snapshot)
+            eof_data = eof_data[0]
+        else:
+            eof_data = send_chunks(batch,f,file_size,chunk_size,send_ranges,
+                chunk_checksums,checksum_size,window_size,rate,fec_group_size,
+                lambda acked_chunk_count: draw_progress_bar(
+                    resumed_chunk_count+acked_chunk_count,chunk_count),
+                compress_func=get_compress_func(compression_mode),rto=rto)
+        # If received file checksum is same as stored file checksum...
+        if eof_data['file_checksum'] == file_checksum:
+            draw_progress_bar(chunk_count,chunk_count)
+            # print(f'Chunks sent: {chunk_count}')
+            log('\nTransfer successful')
+        # Else...
+        else:
+            log('Transfer failed')
+        return TransferResult(eof_data['file_checksum'] == file_checksum,
+            file_size,chunk_count,time.monotonic()-start_time,file_checksum,
+            counters=counters_since(start_counters))
+    finally:
+        # print(list(msg))
+        # print('Closing socket.')
+        for stream_sock in stream_socks:
+            stream_sock.close()
+        if own_sock:
+            sock.close()
+        if f is not None:
+            f.close()
+        if bundle_path is not None:
+            os.remove(bundle_path)
+
+# Receives a file (or directory) from sender_addr into filename, at
+# recvr_addr. If sock is given, it's used instead of binding a socket to
+# recvr_addr (which should then be its address), and left open. Unless
+# linger is False, it then stays around to send EOFPkt again if the
+# sender didn't get it (see linger_eof). Returns a TransferResult.
+def recv(filename, sender_addr, recvr_addr, batch_size=64,
+    sock_buffer_size=None, sock=None, linger=True):
+    global magic_number
+    global sock_timeout
+    start_time = time.monotonic()
+    start_counters = dict(metrics.counters)
+    if batch_size < 1:
+        raise ValueError('Batch size must be at least 1')
+    own_sock = sock is None
+    if own_sock:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(recvr_addr)
+    sock.settimeout(sock_timeout)
+    if sock_buffer_size is not None:
+        set_sock_buffer_size(sock,sock_buffer_size)
+    # The handshake buffer has to fit the biggest MtuProbe.
+    recv_buffer_size = max_datagram_size
+    # Handshake msgs are received into one reusable buffer and decoded
+    # from memoryview slices of it. Once SendReq tells us the chunk
+    # size, FilePkts and FilePktAcks go through batch, which receives
+    # and packs them in preallocated slots sized for one FilePkt, many
+    # per syscall. Chunk data is written to the file before the next
+    # batch is received, so it never needs copying.
+    recv_buffer = bytearray(recv_buffer_size)
+    recv_view = memoryview(recv_buffer)
+    batch = None
     # addr = ('192.168.8.103',9050)
-    print(f'Binding socket to {recvr_addr}')
+    log(f'Binding socket to {recvr_addr}')
     file_checksum = b''
-    chunk_list = [] # This list gets populated once SendReq is recv'd
-    chunk_count = 0
+    # Chunks are written straight to the output file at their offsets
+    # as they arrive, instead of being kept in memory. The file is
+    # opened once SendReq is recv'd.
+    f = None
+    # Chunk size asked for in SendReq. Senders that don't send one
+    # only know file_chunk_size.
+    chunk_size = file_chunk_size
     state = ProgState.AwaitingSendReq
-    curr_chunk_no = 0
 
     sendreq_chunk_count = 0
     sendreq_file_checksum = b''
+    # Integrity mode asked for in SendReq. Senders that don't send
+    # one only know md5.
+    integrity_mode = IntegrityMode.md5
+    chunk_checksum_func = get_chunk_checksum_func(integrity_mode)
+    # Chunks per FEC group asked for in SendReq, 0 if FEC is off.
+    fec_group_size = 0
+    # Streams of a parallel transfer asked for in SendReq, as
+    # (chunk_nos, sender_port, recvr_port), and the sockets bound for
+    # them. Empty if everything goes over sock.
+    stream_map = []
+    stream_socks = []
+    # Journal of the chunks written so far, so an interrupted transfer
+    # can be resumed. None for empty files.
+    journal = None
+    # For a delta transfer, the old copy of the file (filename), while
+    # the new version is written to part_filename. Once it's complete,
+    # it replaces the old copy.
+    old_f = None
+    part_filename = filename+'.part'
+    # For a batch transfer, the directory the bundle is unpacked into.
+    # filename is then where the bundle is written, next to it.
+    batch_dir = None
+    batch_file_count = None
+    # Chunks a delta transfer copied from old_f, and the size of the
+    # new version.
+    copied_ranges = []
+    delta_file_size = 0
     # Debugging code
     # ----------------------------------------------
     # temp_sender_addr = ('192.168.8.111',9510)
     # SendReq
-#     temp_debug_buffer = [26, 1, 46, 0, 0, 0, 1, 0, 0, 0, 0, 18, 18, 16, 34, 0, 0, 0, 49, 57, 50, 46, 49, 54, 
+#     temp_debug_buffer = [26, 1, 46, 0, 0, 0, 1, 0, 0, 0, 0, 18, 18, 16, 34, 0, 0, 0, 49, 57, 50, 46, 49, 54,
 # 56, 46, 56, 46, 49, 48, 51, 58, 57, 53, 49, 48, 144, 1, 80, 152, 60, 210, 79, 176, 214, 150, 63, 125, 40, 225, 127, 114]
-#     # FilePkt
-#     temp_debug_buffer = [26, 3, 11, 0, 0, 0, 0, 0, 0, 0, 3, 0, 0, 0, 97, 98, 99]
 #     temp_debug_buffer = bytes(temp_debug_buffer)
-#     state = ProgState.SendingFilePktAck
-#     chunk_list = [b'abc']
-#     sendreq_chunk_count = 1
     # ----------------------------------------------
 
-    # At each iteration, based on state, program does it's job
-    # and then changes state to the relevant ProgState.
-    while True:
-        # break
-        if state == ProgState.AwaitingSendReq:
-            # Receive and decode SendReq
-            print(f'AwaitingSendReq')
-            recv_msg = sock.recvfrom(recv_buffer_size)
-            ret_addr = recv_msg[1]
-            recv_msg = recv_msg[0]
-
-            # If data is received from any address other than sender_addr
-            # it's not meant for this program, so ignore it and continue
-            # to next iteration.
-            if ret_addr == sender_addr:
-                print(f'Received SendReq from {sender_addr}')
-            else:
-                continue
+    # The file and sockets are closed however the transfer ends.
+    try:
+        # At each iteration, based on state, program does it's job
+        # and then changes state to the relevant ProgState. Once SendAccept
+        # is sent, the loop ends and file data is received.
+        while True:
+            # break
+            if state == ProgState.AwaitingSendReq:
+                # Receive and decode SendReq
+                log(f'AwaitingSendReq')
+                recv_size, ret_addr = sock.recvfrom_into(recv_buffer)
+                recv_msg = recv_view[:recv_size]
 
-            # print(recv_msg)
-            # recv_msg = temp_debug_buffer
-            if recv_msg[0] != magic_number:
-                continue
-            decoded_data = decode_message(recv_msg)
-            # print(decoded_data['msg_type'])
-            # If SendReq was received...
-            if decoded_data['msg_type'] == MsgType.SendReq:
-                # Use it to set initial values for variables
-                sendreq_chunk_count = decoded_data['chunk_count']
-                sendreq_file_checksum = decoded_data['file_checksum']
-                for i in range(sendreq_chunk_count):
-                    chunk_list.append([0])
-                # Change state so next iteration, we send SendAccept.
-                state = ProgState.SendingSendAccept
+                # If data is received from any address other than sender_addr
+                # it's not meant for this program, so ignore it and continue
+                # to next iteration.
+                if ret_addr != sender_addr:
+                    continue
+
+                # print(recv_msg)
+                # recv_msg = temp_debug_buffer
+                if recv_size < msg_header_struct.size or \
+                    recv_msg[0] != magic_number:
+                    continue
+                decoded_data = decode_message(recv_msg)
                 # print(decoded_data['msg_type'])
-            # print(decoded_data)
-            # break
-        elif state == ProgState.SendingSendAccept:
-            # Create and send SendAccept
-            print('SendingSendAccept')
-            msg = encode_message(**{
-                'msg_type':MsgType.SendAccept,
-                'addr':f'{sender_addr[0]}:{str(sender_addr[1])}'})
-            sock.sendto(msg, sender_addr)
-            # print(list(msg))
-            # Change state so next iteration we start receiving FilePkts.
-            state = ProgState.AwaitingFilePkt
-            # break
-        elif state == ProgState.AwaitingFilePkt:
-            # Receive and decode FilePkt.
-            # print('AwaitingFilePkt')
-            recv_msg = sock.recvfrom(recv_buffer_size)
-            recv_msg = recv_msg[0]
-            # recv_msg = temp_debug_buffer
-            if recv_msg[0] != magic_number:
-                continue
-            decoded_data = decode_message(recv_msg)
-            # If FilePkt was received...
-            if decoded_data['msg_type'] == MsgType.FilePkt:
-                # Set curr_chunk_no and add chunk to chunk_list.
-                curr_chunk_no = decoded_data['chunk_no']
-                # print(curr_chunk_no)
-                chunk_list[curr_chunk_no] = decoded_data['chunk_data']
-
-                # Change state so next iteration we send FilePktAck.
-                state = ProgState.SendingFilePktAck
-            # print(decoded_data)
-            # break
-        elif state == ProgState.SendingFilePktAck:
-            # Create and send FilePktAckt
-            # print('SendingFilePkt')
-            msg = b''
-            # If curr_chunk_no is last chunk...
-            if curr_chunk_no == sendreq_chunk_count-1:
-                # Create file_data object out of chunks in chunk_list
-                file_data = b''
-                file_data = file_data.join(chunk_list)
-                # for i in range(len(chunk_list)):
-                #     file_data += chunk_list[i]
-
-                # Check if received file data's checksum matches checksum
-                # that was received in SendReq. If it does, file data 
-                # transfer was successful.
-                if hashlib.md5(file_data).digest() == sendreq_file_checksum:
-                    # Create and send EOFPkt msg
+                # If MtuProbe was received, the sender is finding out the
+                # chunk size to ask for, so let it know the probe made it.
+                if decoded_data['msg_type'] == MsgType.MtuProbe:
                     msg = encode_message(**{
-                        'msg_type':MsgType.EOFPkt,'total_filepkts_received':curr_chunk_no+1,
-                        'file_data':file_data
-                    })
+                        'msg_type':MsgType.MtuProbeAck,
+                        'probe_size':decoded_data['probe_size']})
                     sock.sendto(msg,sender_addr)
-                    draw_progress_bar(curr_chunk_no+1,sendreq_chunk_count)
-                    # print(f'Chunks received:{curr_chunk_no+1}')
-                    print(f'\nFile data received. File Data Size: {len(file_data)}.')
-                    # print(list(msg))
-
-                    # Create (if needed) and write data to it.
-                    print('Writing data to file...')
-                    with open(filename, 'wb+') as f:
-                        f.write(file_data)
-                    print('Done.')
-                    # break loop so we can exit program.
+                # If SendReq was received...
+                elif decoded_data['msg_type'] == MsgType.SendReq:
+                    log(f'Received SendReq from {sender_addr}')
+                    options = decoded_data['options']
+                    try:
+                        chunk_size, integrity_mode, fec_group_size, \
+                            compression_mode, ack_mode = \
+                            read_send_req_options(options)
+                    except ValueError as e:
+                        log(f'Ignoring SendReq: {e}')
+                        continue
+                    # Use it to set initial values for variables
+                    sendreq_chunk_count = decoded_data['chunk_count']
+                    sendreq_file_checksum = decoded_data['file_checksum']
+                    chunk_checksum_func = get_chunk_checksum_func(
+                        integrity_mode)
+                    if MsgOption.Batch in options and batch_dir is None:
+                        batch_file_count = int.from_bytes(
+                            options[MsgOption.Batch],'little')
+                        batch_dir = filename
+                        filename = os.path.normpath(filename)+'.bundle'
+                        part_filename = filename+'.part'
+                        log(f'Receiving {batch_file_count} files into '
+                            f'{batch_dir}')
+                    # Bind a socket for every stream asked for. If any of
+                    # them can't be, StreamMap isn't echoed, and the sender
+                    # sends everything over sock.
+                    stream_map = []
+                    if MsgOption.StreamMap in options:
+                        stream_map = decode_stream_map(
+                            options[MsgOption.StreamMap])
+                    try:
+                        for chunk_nos, sender_port, recvr_port in stream_map:
+                            if chunk_nos.stop > sendreq_chunk_count:
+                                raise ValueError('Stream chunks out of range')
+                            stream_sock = socket.socket(
+                                socket.AF_INET, socket.SOCK_DGRAM)
+                            stream_socks.append(stream_sock)
+                            stream_sock.bind((recvr_addr[0],recvr_port))
+                            if sock_buffer_size is not None:
+                                set_sock_buffer_size(stream_sock,
+                                    sock_buffer_size)
+                    except (OSError,ValueError) as e:
+                        log(f'Can\'t receive over parallel streams: {e}')
+                        stream_map = []
+                        for stream_sock in stream_socks:
+                            stream_sock.close()
+                        stream_socks = []
+                    batch = DatagramBatch(sock,sender_addr,batch_size,
+                        file_pkt_header_size+max_checksum_size,
+                        file_pkt_header_size+chunk_size)
+                    # If an earlier transfer of the same file was cut off,
+                    # its journal says which chunks are already in the file.
+                    # Otherwise create (if needed) the file. Either way make
+                    # it big enough to hold every chunk, so they can be
+                    # written in any order.
+                    if sendreq_chunk_count > 0:
+                        journal = ChunkJournal(filename,sendreq_file_checksum,
+                            chunk_size,sendreq_chunk_count)
+                    # If there's nothing to resume, but the sender asked for
+                    # a delta transfer and there's an old copy with at least
+                    # one whole chunk, the new version is built next to it.
+                    if journal is not None and journal.resumed:
+                        f = open(filename, 'r+b')
+                    elif journal is not None and \
+                        MsgOption.Delta in options and \
+                        os.path.isfile(filename) and \
+                        os.path.getsize(filename) >= chunk_size:
+                        journal.remove()
+                        journal = None
+                        old_f = open(filename, 'rb')
+                        f = open(part_filename, 'wb+')
+                    else:
+                        f = open(filename, 'wb+')
+                    f.truncate(sendreq_chunk_count*chunk_size)
+                    # Change state so next iteration, we send SendAccept.
+                    state = ProgState.SendingSendAccept
+                    # print(decoded_data['msg_type'])
+                # print(decoded_data)
+                # break
+            elif state == ProgState.SendingSendAccept:
+                # Create and send SendAccept
+                log('SendingSendAccept')
+                # When resuming, the sender is told which chunks are still
+                # missing.
+                missing_ranges = None
+                if journal is not None and journal.resumed:
+                    missing_ranges = bitmap_missing_ranges(journal.bitmap,
+                        sendreq_chunk_count)
+                    log('Resuming: '+str(sendreq_chunk_count-sum(
+                        len(chunk_range) for chunk_range in missing_ranges))+
+                        f' of {sendreq_chunk_count} chunks already received')
+                old_file_size = None
+                if old_f is not None:
+                    old_file_size = os.fstat(old_f.fileno()).st_size
+                send_accept_msg = encode_message(**{
+                    'msg_type':MsgType.SendAccept,
+                    'addr':f'{sender_addr[0]}:{str(sender_addr[1])}',
+                    'options':get_send_accept_options(chunk_size,
+                        integrity_mode,fec_group_size,stream_map,
+                        missing_ranges,old_file_size,compression_mode,
+                        batch_file_count,ack_mode)})
+                sock.sendto(send_accept_msg, sender_addr)
+                # print(list(msg))
+                # SendAccept sent, so file data can be received.
+                break
+                # break
+
+        # For a delta transfer, send the signatures of the old copy, and
+        # copy the blocks the sender says are still in the file.
+        if old_f is not None:
+            log(f'Sending signatures of {filename}')
+            send_signatures(sock,sender_addr,old_f,chunk_size,
+                chunk_checksum_func,batch_size)
+            copied_ranges, delta_file_size = recv_copy_blocks(sock,sender_addr,
+                stream_socks,old_f,f,chunk_size,sendreq_chunk_count)
+            log('Delta: '+str(sum(len(chunk_range)
+                for chunk_range in copied_ranges))+
+                f' of {sendreq_chunk_count} chunks copied')
+
+        if len(stream_map) > 0:
+            recvd_counter = multiprocessing.Value('q',0)
+            result_queue = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=recv_stream,args=(
+                stream_socks[stream_no],(sender_addr[0],sender_port),f.name,
+                chunk_size,sendreq_chunk_count,chunk_nos,integrity_mode,
+                fec_group_size,batch_size,recvd_counter,result_queue,
+                stream_no,sendreq_file_checksum,journal is not None,
+                copied_ranges,delta_file_size,compression_mode,ack_mode),
+                daemon=True)
+                for stream_no, (chunk_nos, sender_port, recvr_port)
+                in enumerate(stream_map)]
+            for worker in workers:
+                worker.start()
+            log(f'Receiving over {len(workers)} streams')
+            # Every stream puts its result on result_queue once all its
+            # chunks are in. SendReqs on the main socket mean SendAccept got
+            # lost.
+            results = []
+            def streams_done():
+                answer_send_reqs(sock,sender_addr,send_accept_msg)
+                try:
+                    results.append(
+                        result_queue.get(timeout=stream_poll_interval))
+                except queue.Empty:
+                    pass
+                return len(results) == len(workers)
+            wait_for_streams(workers,recvd_counter,sendreq_chunk_count,
+                streams_done)
+            file_size = max(result[1] for result in results)
+            fec_recovered_count = sum(result[2] for result in results)
+            for result in results:
+                metrics.merge(result[3])
+        else:
+            file_size, fec_recovered_count = recv_chunks(batch,f,chunk_size,
+                sendreq_chunk_count,range(sendreq_chunk_count),
+                chunk_checksum_func,fec_group_size,
+                lambda recvd_chunk_count: draw_progress_bar(
+                    recvd_chunk_count,sendreq_chunk_count),
+                journal=journal,copied_ranges=copied_ranges,
+                file_size=delta_file_size,compression_mode=compression_mode,
+                sack=ack_mode == AckMode.sack,send_accept_msg=send_accept_msg,
+                ack_last_chunk=len(options) > 0)
+
+        # Every chunk has been received, so the journal isn't needed.
+        file_checksum = finish_file(f,file_size)
+        if journal is not None:
+            journal.remove()
+        # The new version of a delta transfer replaces the old copy only if
+        # it came out right.
+        if old_f is not None:
+            old_f.close()
+            if file_checksum == sendreq_file_checksum:
+                os.replace(part_filename,filename)
+            else:
+                os.remove(part_filename)
+        # A batch only counts as received once it's unpacked. If it can't
+        # be, the sender is told the transfer failed.
+        if batch_dir is not None and file_checksum == sendreq_file_checksum:
+            log()
+            if not finish_batch(filename,batch_dir):
+                file_checksum = b''
+
+        # Check if received file data's checksum matches checksum
+        # that was received in SendReq. If it does, file data
+        # transfer was successful.
+        # Either way the EOFPkt lets the sender know how it went.
+        msg = encode_message(**{
+            'msg_type':MsgType.EOFPkt,
+            'total_filepkts_received':sendreq_chunk_count,
+            'file_checksum':file_checksum
+        })
+        sock.sendto(msg,sender_addr)
+        if file_checksum == sendreq_file_checksum:
+            draw_progress_bar(sendreq_chunk_count,sendreq_chunk_count)
+            # print(f'Chunks received:{recvd_chunk_count}')
+            log(f'\nFile data received. File Data Size: {file_size}.')
+            if fec_group_size > 0:
+                log(f'Chunks recovered by FEC: {fec_recovered_count}')
+            # print(list(msg))
+            log('Done.')
+        else:
+            log('\nTransfer failed')
+        elapsed = time.monotonic()-start_time
+        if linger:
+            linger_eof(sock,stream_socks,sender_addr,msg)
+
+        return TransferResult(file_checksum == sendreq_file_checksum,
+            file_size,sendreq_chunk_count,elapsed,file_checksum,
+            fec_recovered_count,counters_since(start_counters))
+    finally:
+        # print('Closing socket.')
+        for stream_sock in stream_socks:
+            stream_sock.close()
+        if own_sock:
+            sock.close()
+        # An unfinished transfer keeps its journal, so it can be resumed.
+        if journal is not None and not f.closed:
+            journal.close(f)
+        if f is not None:
+            f.close()
+        if old_f is not None:
+            old_f.close()
+
+# A transfer being received by serve, from the sender at addr. Holds
+# what recv keeps in local variables: the file checksum from SendReq,
+# the SendAccept sent back (sent again if SendReq is), the
+# ChunkReceiver writing the file, and when the sender was last heard
+# from. Once the file is written and hashed, eof_msg holds the EOFPkt,
+# which is sent again to a sender that's still sending FilePkts. For a
+# batch transfer, path is the bundle, and batch_dir the directory it's
+# unpacked into. out_path is what the session writes, as far as other
+# sessions are concerned: batch_dir for a batch, and path otherwise.
+class ServeSession:
+    def __init__(self, addr, transfer_id, path, f, file_checksum,
+        chunk_count, send_accept_msg, receiver, batch_dir=None):
+        self.addr = addr
+        self.transfer_id = transfer_id
+        self.path = path
+        self.batch_dir = batch_dir
+        self.out_path = path if batch_dir is None else batch_dir
+        self.f = f
+        self.file_checksum = file_checksum
+        self.chunk_count = chunk_count
+        self.send_accept_msg = send_accept_msg
+        self.receiver = receiver
+        self.last_msg_time = time.monotonic()
+        # FilePktAcks are packed here before they're sent.
+        self.ack_buffer = bytearray(file_pkt_header_size+max_checksum_size)
+        self.finishing = False
+        self.eof_msg = None
+        # With SACK, the timer that sends the SackPkt being held back.
+        self.sack_handle = None
+
+# Receives files for serve. Every sender gets its own ServeSession,
+# keyed by (address, transfer id). FilePkts don't carry the transfer
+# id, so they're matched to the session of the address they came from,
+# which is the latest one that address started. A new SendReq from the
+# same address replaces its old session. Sessions are also kept by
+# the path they write (the directory, for a batch) until their file is
+# finished, so two of them never write the same one. It doesn't
+# subclass asyncio.DatagramProtocol, so asyncio isn't imported until
+# serve runs, and has the callbacks that would have given it instead.
+class ServeProtocol:
+    def __init__(self, out_dir, idle_timeout):
+        self.out_dir = out_dir
+        self.idle_timeout = idle_timeout
+        self.transport = None
+        self.sessions = {}
+        self.addr_sessions = {}
+        self.path_sessions = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        pass
+
+    # ICMP errors (like port unreachable) about datagrams sent to
+    # senders that went away are ignored.
+    def error_received(self, exc):
+        pass
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    # Sends msg to addr, counting it in metrics.
+    def send(self, msg, addr):
+        self.transport.sendto(msg,addr)
+        metrics.count('packets_sent')
+        metrics.count('bytes_sent',len(msg))
+
+    def datagram_received(self, data, addr):
+        metrics.count('packets_received')
+        metrics.count('bytes_received',len(data))
+        msg = memoryview(data)
+        if len(msg) < msg_header_struct.size or msg[0] != magic_number:
+            metrics.count('packets_dropped_bad_magic')
+            return
+        msg_type = msg[1]
+        if msg_type == file_pkt_type or msg_type == fec_pkt_type:
+            session = self.addr_sessions.get(addr)
+            if session is None:
+                metrics.count('packets_dropped_stray')
+                return
+            session.last_msg_time = time.monotonic()
+            # The sender didn't get the EOFPkt yet.
+            if session.eof_msg is not None:
+                self.send(session.eof_msg,addr)
+                return
+            # A session whose file can't be written is ended, so the
+            # rest of its FilePkts are dropped as stray.
+            try:
+                session.receiver.handle_msg(msg,lambda: session.ack_buffer,
+                    lambda size: self.send(session.ack_buffer[:size],addr))
+                session.receiver.count_metrics()
+                if session.receiver.sack:
+                    self.schedule_sack(session)
+                session.receiver.sync_journal()
+            except (OSError,ValueError) as e:
+                self.end_session(session,f'failed: {e}')
+                return
+            if session.receiver.done() and not session.finishing:
+                self.finish_session(session)
+            return
+        if msg_type not in msg_types:
+            return
+        decoded_data = decode_message(msg)
+        # Senders probing the path MTU are told which probes made it.
+        if decoded_data['msg_type'] == MsgType.MtuProbe:
+            self.send(encode_message(**{
+                'msg_type':MsgType.MtuProbeAck,
+                'probe_size':decoded_data['probe_size']}),addr)
+        elif decoded_data['msg_type'] == MsgType.SendReq:
+            self.start_session(decoded_data,addr)
+
+    # Starts a session for a SendReq, or sends SendAccept again if the
+    # session already exists.
+    def start_session(self, decoded_data, addr):
+        options = decoded_data['options']
+        transfer_id = 0
+        if MsgOption.TransferId in options:
+            transfer_id = int.from_bytes(options[MsgOption.TransferId],'little')
+        session = self.sessions.get((addr,transfer_id))
+        if session is not None:
+            session.last_msg_time = time.monotonic()
+            self.send(session.send_accept_msg,addr)
+            return
+        try:
+            chunk_size, integrity_mode, fec_group_size, compression_mode, \
+                ack_mode = read_send_req_options(options)
+        except ValueError as e:
+            log(f'Ignoring SendReq from {addr}: {e}')
+            return
+        # Only the base name of FileName is used, so files can't be
+        # written outside out_dir. Older senders don't send one.
+        filename = ''
+        if MsgOption.FileName in options:
+            filename = os.path.basename(
+                options[MsgOption.FileName].decode(errors='replace'))
+        if filename in ('','.','..'):
+            filename = f'{addr[0]}_{addr[1]}_{transfer_id}'
+        old_session = self.addr_sessions.get(addr)
+        if old_session is not None:
+            self.end_session(old_session,'replaced')
+        chunk_count = decoded_data['chunk_count']
+        # If another session is still writing a file of the same name,
+        # this one gets a number added to it: name_1.ext, name_2.ext...
+        path = os.path.join(self.out_dir,filename)
+        if path in self.path_sessions:
+            root, ext = os.path.splitext(filename)
+            for n in itertools.count(1):
+                path = os.path.join(self.out_dir,f'{root}_{n}{ext}')
+                if path not in self.path_sessions:
                     break
-            # Else if curr_chunk_no is not last chunk.
+            log(f'{filename} is already being received, so the one from '
+                f'{addr[0]}:{addr[1]} goes to {path}')
+        # A batch is received into a bundle next to the directory it's
+        # unpacked into.
+        batch_dir = None
+        batch_file_count = None
+        if MsgOption.Batch in options:
+            batch_file_count = int.from_bytes(options[MsgOption.Batch],
+                'little')
+            batch_dir = path
+            path += '.bundle'
+        # Pick up where an earlier transfer of the same file was cut
+        # off, if its journal is there. Otherwise create (if needed) the
+        # file. Either way make it big enough to hold every chunk, so
+        # they can be written in any order.
+        journal = None
+        missing_ranges = None
+        try:
+            if chunk_count > 0:
+                journal = ChunkJournal(path,decoded_data['file_checksum'],
+                    chunk_size,chunk_count)
+            if journal is not None and journal.resumed:
+                f = open(path,'r+b')
+                missing_ranges = bitmap_missing_ranges(journal.bitmap,
+                    chunk_count)
             else:
-                # Create and send FilePktAck msg.
-                msg = encode_message(**{
-                    'msg_type':MsgType.FilePktAck,'chunk_no':curr_chunk_no,
-                    'chunk_data':chunk_list[curr_chunk_no]
-                })
-                sock.sendto(msg,sender_addr)
-                # print(list(msg))
-                draw_progress_bar(curr_chunk_no+1,sendreq_chunk_count)
-                # print(f'Chunks received:{curr_chunk_no+1}',end='\r')
+                f = open(path,'wb+')
+            f.truncate(chunk_count*chunk_size)
+        except OSError as e:
+            log(f'Ignoring SendReq from {addr}: {e}')
+            if journal is not None:
+                journal.jf.close()
+            return
+        send_accept_msg = encode_message(**{
+            'msg_type':MsgType.SendAccept,
+            'addr':f'{addr[0]}:{str(addr[1])}',
+            'options':get_send_accept_options(chunk_size,integrity_mode,
+                fec_group_size,missing_ranges=missing_ranges,
+                compression_mode=compression_mode,
+                batch_file_count=batch_file_count,ack_mode=ack_mode)})
+        session = ServeSession(addr,transfer_id,path,f,
+            decoded_data['file_checksum'],chunk_count,send_accept_msg,
+            ChunkReceiver(f,chunk_size,chunk_count,range(chunk_count),
+                get_chunk_checksum_func(integrity_mode),fec_group_size,
+                journal,compression_mode=compression_mode,
+                sack=ack_mode == AckMode.sack,
+                ack_last_chunk=len(options) > 0),batch_dir)
+        self.sessions[(addr,transfer_id)] = session
+        self.addr_sessions[addr] = session
+        self.path_sessions[session.out_path] = session
+        resumed = ''
+        if missing_ranges is not None:
+            resumed = ' (resumed)'
+        log(f'Receiving {path} from {addr[0]}:{addr[1]}, '
+            f'{chunk_count} chunks{resumed}')
+        self.send(send_accept_msg,addr)
+        # If no chunks are missing (the file is empty, or every chunk
+        # arrived before it was resumed), there are no FilePkts, so go
+        # straight to EOFPkt.
+        if session.receiver.done():
+            self.finish_session(session)
 
-                # Change state so next iteration we await another FilePkt.
-                state = ProgState.AwaitingFilePkt
-            # break
-        # break
+    # Datagrams are handled one at a time here, so with SACK there's no
+    # batch to answer. Instead a session's SackPkt is sent once
+    # sack_every chunks are waiting for it, or sack_delay seconds after
+    # the first of them arrived.
+    def schedule_sack(self, session):
+        if session.receiver.unsacked_count >= sack_every:
+            self.send_sack(session)
+        elif session.receiver.unsacked_count > 0 and \
+            session.sack_handle is None:
+            session.sack_handle = asyncio.get_running_loop().call_later(
+                sack_delay,self.send_sack,session)
 
-    # print('Closing socket.')
-    sock.close()
-    pass
+    def send_sack(self, session):
+        if session.sack_handle is not None:
+            session.sack_handle.cancel()
+            session.sack_handle = None
+        for msg in session.receiver.get_sack_msgs():
+            self.send(msg,session.addr)
+
+    # Hashes the written file in a worker thread, so other sessions
+    # aren't held up, then sends EOFPkt.
+    def finish_session(self, session):
+        session.finishing = True
+        asyncio.get_running_loop().create_task(self.send_eof_pkt(session))
+
+    async def send_eof_pkt(self, session):
+        # A file that can't be finished fails the transfer, and the
+        # sender is told so.
+        try:
+            file_checksum = await asyncio.get_running_loop().run_in_executor(
+                None,finish_file,session.f,session.receiver.file_size)
+            if session.receiver.journal is not None:
+                session.receiver.journal.remove()
+            if session.batch_dir is not None and \
+                file_checksum == session.file_checksum and \
+                not await asyncio.get_running_loop().run_in_executor(
+                    None,finish_batch,session.path,session.batch_dir):
+                file_checksum = b''
+        except (OSError,ValueError) as e:
+            log(f'Can\'t finish {session.path}: {e}')
+            file_checksum = b''
+        # The file is done with, so its name is free again.
+        self.release_path(session)
+        session.eof_msg = encode_message(**{
+            'msg_type':MsgType.EOFPkt,
+            'total_filepkts_received':session.chunk_count,
+            'file_checksum':file_checksum
+        })
+        self.send(session.eof_msg,session.addr)
+        if file_checksum == session.file_checksum:
+            log(f'Received {session.path} from '
+                f'{session.addr[0]}:{session.addr[1]}, '
+                f'{session.receiver.file_size} bytes')
+        else:
+            log(f'Transfer of {session.path} failed')
+
+    # Forgets a session. Files of sessions that didn't finish are left
+    # as they are, with their journals, so they can be resumed.
+    def end_session(self, session, reason):
+        del self.sessions[(session.addr,session.transfer_id)]
+        if self.addr_sessions.get(session.addr) is session:
+            del self.addr_sessions[session.addr]
+        if not session.finishing:
+            self.release_path(session)
+            if session.receiver.journal is not None:
+                try:
+                    session.receiver.journal.close(session.f)
+                except (OSError,ValueError) as e:
+                    log(f'Can\'t save the journal of {session.path}: {e}')
+            session.f.close()
+            log(f'Transfer of {session.path} {reason}')
+
+    def release_path(self, session):
+        if self.path_sessions.get(session.out_path) is session:
+            del self.path_sessions[session.out_path]
+
+    # Ends every session that hasn't heard from its sender for
+    # idle_timeout seconds.
+    def expire_sessions(self):
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            if now-session.last_msg_time >= self.idle_timeout and \
+                (not session.finishing or session.eof_msg is not None):
+                self.end_session(session,'timed out')
+
+async def run_server(out_dir, listen_addr, idle_timeout, sock_buffer_size):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    log(f'Binding socket to {listen_addr}')
+    sock.bind(listen_addr)
+    if sock_buffer_size is not None:
+        set_sock_buffer_size(sock,sock_buffer_size)
+    transport, protocol = \
+        await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: ServeProtocol(out_dir,idle_timeout),sock=sock)
+    try:
+        while True:
+            await asyncio.sleep(session_check_interval)
+            protocol.expire_sessions()
+    finally:
+        transport.close()
+
+# Receives files from any number of senders at once on listen_addr,
+# until it's stopped, saving each under out_dir with the name the
+# sender gave it. Unlike recv, it doesn't need to know the sender's
+# address beforehand. Sessions that don't hear from their sender for
+# idle_timeout seconds are dropped.
+def serve(out_dir, listen_addr, idle_timeout=sock_timeout,
+    sock_buffer_size=None):
+    if not os.path.isdir(out_dir):
+        raise ValueError(f'{out_dir} is not a directory')
+    try:
+        asyncio.run(run_server(out_dir,listen_addr,idle_timeout,
+            sock_buffer_size))
+    except KeyboardInterrupt:
+        pass
+
+# Keyword arguments of send and recv that Sender and Receiver pass on.
+sender_options = ('window_size','integrity_mode','chunk_size','probe_mtu',
+    'batch_size','sock_buffer_size','rate','fec_group_size','streams','delta',
+    'compression_mode','ack_mode')
+receiver_options = ('batch_size','sock_buffer_size','linger')
+
+def check_options(options, names):
+    for name in options:
+        if name not in names:
+            raise TypeError(f'Unknown option: {name}')
+
+# Writes source (bytes, or a file object opened for reading in binary
+# mode) to a file in dir_path, and returns its path.
+def spool_source(source, dir_path):
+    path = os.path.join(dir_path,'source')
+    with open(path,'wb') as f:
+        if isinstance(source,(bytes,bytearray,memoryview)):
+            f.write(source)
+        else:
+            shutil.copyfileobj(source,f)
+    return path
+
+# Sends files from code, the way the send mode does, but silently.
+# Binds a socket to addr, which every transfer is sent from. With port
+# 0 the OS picks one, and addr holds it afterwards. options are send's
+# keyword arguments, like window_size=64. Parallel streams use the ports
+# after addr's, as in send mode.
+class Sender:
+    def __init__(self, addr, **options):
+        check_options(options,sender_options)
+        self.options = options
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(addr)
+        self.addr = self.sock.getsockname()
+
+    # Sends source to the receiver at recvr_addr. source is a path (of a
+    # file, or of a directory to send as a batch), bytes, or a file
+    # object opened for reading in binary mode, which is read to the
+    # end first. name is what a receiver in serve mode saves it under,
+    # by default the base name of the path (or a name made from the
+    # sender's address). Returns a TransferResult, or raises a
+    # TransferError.
+    def send(self, source, recvr_addr, name=None):
+        if isinstance(source,(str,os.PathLike)):
+            return self.send_path(os.fspath(source),recvr_addr,name)
+        with tempfile.TemporaryDirectory() as dir_path:
+            return self.send_path(spool_source(source,dir_path),recvr_addr,
+                name or '')
+
+    # Like send, from a coroutine. source can also be an async iterable
+    # of bytes, which is read to the end first. The transfer runs in a
+    # worker thread, so the event loop isn't held up.
+    async def send_async(self, source, recvr_addr, name=None):
+        if not hasattr(source,'__aiter__'):
+            return await asyncio.to_thread(self.send,source,recvr_addr,name)
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join(dir_path,'source')
+            with open(path,'wb') as f:
+                async for data in source:
+                    f.write(data)
+            return await asyncio.to_thread(self.send_path,path,recvr_addr,
+                name or '')
+
+    def send_path(self, path, recvr_addr, name):
+        try:
+            result = send(path,self.addr,recvr_addr,sock=self.sock,name=name,
+                **self.options)
+        except TimeoutError as e:
+            raise TransferTimeout(f'Nothing heard from {recvr_addr} for '
+                f'{sock_timeout} seconds') from e
+        if not result.ok:
+            raise ChecksumMismatch(f'Transfer of {path} failed')
+        return result
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Receives files from code, the way the recv mode does, but silently.
+# Binds a socket to addr like Sender, and takes transfers from the
+# sender at sender_addr. options are recv's keyword arguments.
+class Receiver:
+    def __init__(self, addr, sender_addr, **options):
+        check_options(options,receiver_options)
+        self.options = options
+        self.sender_addr = sender_addr
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(addr)
+        self.addr = self.sock.getsockname()
+
+    # Receives one transfer into sink: a path (of a file, or of the
+    # directory a batch is unpacked into), a file object opened for
+    # writing in binary mode, or None, to get the data in the
+    # TransferResult. Only a path can take a batch. Returns a
+    # TransferResult, or raises a TransferError.
+    def recv(self, sink=None):
+        if isinstance(sink,(str,os.PathLike)):
+            return self.recv_path(os.fspath(sink))
+        with tempfile.TemporaryDirectory() as dir_path:
+            path, result = self.recv_temp(dir_path)
+            with open(path,'rb') as f:
+                if sink is None:
+                    result.data = f.read()
+                else:
+                    shutil.copyfileobj(f,sink)
+        return result
+
+    # Like recv, from a coroutine. sink can also be an object whose
+    # write method is a coroutine, which gets the data once it's all
+    # in. The transfer runs in a worker thread, so the event loop isn't
+    # held up.
+    async def recv_async(self, sink=None):
+        if sink is None or isinstance(sink,(str,os.PathLike)):
+            return await asyncio.to_thread(self.recv,sink)
+        with tempfile.TemporaryDirectory() as dir_path:
+            path, result = await asyncio.to_thread(self.recv_temp,dir_path)
+            with open(path,'rb') as f:
+                while data := f.read(read_block_size):
+                    written = sink.write(data)
+                    if hasattr(written,'__await__'):
+                        await written
+        return result
+
+    def recv_path(self, path):
+        try:
+            result = recv(path,self.sender_addr,self.addr,sock=self.sock,
+                **self.options)
+        except TimeoutError as e:
+            raise TransferTimeout(f'Nothing heard from {self.sender_addr} '
+                f'for {sock_timeout} seconds') from e
+        if not result.ok:
+            raise ChecksumMismatch(f'Transfer into {path} failed')
+        return result
+
+    # Receives into a file in dir_path, for the sinks that aren't paths,
+    # and returns (its path, the TransferResult).
+    def recv_temp(self, dir_path):
+        path = os.path.join(dir_path,'sink')
+        result = self.recv_path(path)
+        if os.path.isdir(path):
+            raise TransferError('A batch can only be received into a path')
+        return path, result
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Sends source to sink within this process, over 127.0.0.1 on ports the
+# OS picks, with the receiver in a thread. Meant for tests. source and
+# sink are what Sender.send and Receiver.recv take, and options are
+# send's keyword arguments (batch_size and sock_buffer_size apply to
+# both sides). The receiver doesn't linger, so it's over as soon as the
+# sender is. (If its EOFPkt is dropped anyway, the sender times out.)
+# Returns the receiver's TransferResult, or raises what either side
+# raised, the sender's first.
+def loopback(source, sink=None, **options):
+    recv_options = {name:options[name] for name in receiver_options
+        if name in options}
+    with Sender(('127.0.0.1',0),**options) as sender, \
+        Receiver(('127.0.0.1',0),sender.addr,linger=False,
+            **recv_options) as receiver:
+        results = []
+        def run_receiver():
+            try:
+                results.append(receiver.recv(sink))
+            except Exception as e:
+                results.append(e)
+        thread = threading.Thread(target=run_receiver,daemon=True)
+        thread.start()
+        try:
+            sender.send(source,receiver.addr)
+        finally:
+            thread.join()
+    if isinstance(results[0],Exception):
+        raise results[0]
+    return results[0]
+
+# Takes the arguments that follow the positional ones and returns a
+# dict of them. Options look like '--name value', or just '--name'
+# for on/off switches, which are stored as True.
+def parse_options(args):
+    options = {}
+    i = 0
+    while i < len(args):
+        if not args[i].startswith('--'):
+            raise ValueError(f'Unexpected argument: {args[i]}')
+        name = args[i][2:]
+        if i+1 < len(args) and not args[i+1].startswith('--'):
+            options[name] = args[i+1]
+            i += 2
+        else:
+            options[name] = True
+            i += 1
+    return options
 
 if __name__ == '__main__':
     # Read arguments and prepare variables.
@@ -483,12 +4318,42 @@ if __name__ == '__main__':
         help_msg = 'Send or receive files over UDP. Start the receiver first, then the sender.\n\n\
 Usage:\n\
 Mode: send/recv\n\
-Filename\n\
+Filename (a directory sends every file under it in one transfer, and recv unpacks them into that directory)\n\
 Sender address: (IP:Port)\n\
 Receiver address: (IP:Port)\n\n\
+Serve mode usage:\n\
+Mode: serve\n\
+Output directory\n\
+Address to listen on: (IP:Port)\n\n\
+Send options:\n\
+--window N: Number of FilePkts kept in flight before waiting for FilePktAcks (default 1)\n\
+--integrity MODE: Per chunk checksum sent back in FilePktAck. md5, none, crc32, blake2b or xxh64 (default crc32)\n\
+--chunk-size N: Bytes of file data per FilePkt, or auto to probe the path MTU (default 1024)\n\
+--rate RATE: Most bits per second to send, like 800K, 200M or 1G, or auto to adapt it to loss and RTT (default: unlimited)\n\
+--fec K: Send a FecPkt (XOR parity) after every K FilePkts, so the receiver can rebuild one lost chunk per group (default 0, off)\n\
+--streams N: Split the file into N ranges, each sent by its own process over its own port pair, the ports after the given ones (default 1)\n\
+--delta: If the receiver has an older copy of the file, only send the chunks that changed\n\
+--compression MODE: Compress each chunk before it\'s sent, if that makes it smaller. none, zlib, lzma, zstd or lz4 (default none)\n\
+--ack MODE: How the receiver acks chunks. sack (one SackPkt per batch of FilePkts, NackPkts for lost chunks) or chunk (a FilePktAck with the chunk\'s checksum for every FilePkt) (default sack)\n\n\
+Send and recv options:\n\
+--batch N: Most datagrams sent or received per syscall (default 64)\n\
+--sock-buf BYTES: Socket send and receive buffer size (default: OS default)\n\n\
+Serve options:\n\
+--idle-timeout SECONDS: Drop sessions whose sender isn\'t heard from for this long (default 20)\n\
+--sock-buf BYTES: Socket send and receive buffer size (default: OS default)\n\n\
+Options of every mode:\n\
+--quiet: Don\'t draw the progress bar\n\
+--metrics-file PATH: Append a JSON line with every counter and histogram to PATH every --metrics-interval seconds, and once more at the end\n\
+--metrics-interval SECONDS: Seconds between the lines of --metrics-file (default 1)\n\
+--metrics-port PORT: Serve the metrics in the Prometheus text format on http://127.0.0.1:PORT/ while running\n\n\
 Example:\n\
 python file_transfer.py send somefile01.txt 192.168.8.111:9510 192.168.8.103:9510\n\
-python file_transfer.py recv somefile01.txt 192.168.8.111:9510 192.168.8.103:9510\n\n\
+python file_transfer.py send somefile01.txt 192.168.8.111:9510 192.168.8.103:9510 --window 64\n\
+python file_transfer.py send somefile01.txt 192.168.8.111:9510 192.168.8.103:9510 --window 256 --rate 200M\n\
+python file_transfer.py recv somefile01.txt 192.168.8.111:9510 192.168.8.103:9510\n\
+python file_transfer.py serve received_files 192.168.8.103:9510\n\
+python file_transfer.py send photos/ 192.168.8.111:9510 192.168.8.103:9510 --window 64\n\
+python file_transfer.py send somefile01.txt 192.168.8.111:9510 192.168.8.103:9510 --window 64 --quiet --metrics-file metrics.jsonl\n\n\
 NOTE:\n\
 Socket timeout in both modes is set to 20 seconds by default. If you\'re sending a big file and the program might take longer than 10 seconds to read and process the data, consider increasing the value of sock_timeout in the script, to avoid reaching socket timeout.'
 
@@ -496,16 +4361,57 @@ Socket timeout in both modes is set to 20 seconds by default. If you\'re sending
     else:
         try:
             mode = sys.argv[1] # mode
-            filename = sys.argv[2] # file name
-            addr_temp = sys.argv[3].split(':') # sender addr
-            sender_addr = (addr_temp[0],int(addr_temp[1]))
-            addr_temp = sys.argv[4].split(':') # recvr addr
-            recvr_addr = (addr_temp[0],int(addr_temp[1]))
-
-            if mode == 'send':
-                send(filename, sender_addr, recvr_addr)
-            elif mode == 'recv':
-                recv(filename, sender_addr, recvr_addr)
+            # Serve mode takes an output directory and the address to
+            # listen on instead.
+            if mode == 'serve':
+                out_dir = sys.argv[2] # output directory
+                addr_temp = sys.argv[3].split(':') # listen addr
+                listen_addr = (addr_temp[0],int(addr_temp[1]))
+                options = parse_options(sys.argv[4:])
+            else:
+                filename = sys.argv[2] # file name
+                addr_temp = sys.argv[3].split(':') # sender addr
+                sender_addr = (addr_temp[0],int(addr_temp[1]))
+                addr_temp = sys.argv[4].split(':') # recvr addr
+                recvr_addr = (addr_temp[0],int(addr_temp[1]))
+                options = parse_options(sys.argv[5:])
+            verbose = True
+            quiet = options.get('quiet',False)
+            stop_metrics_export = start_metrics_export(options)
+            try:
+                if mode == 'serve':
+                    serve(out_dir, listen_addr,
+                        idle_timeout=float(options.get('idle-timeout',
+                            sock_timeout)),
+                        sock_buffer_size=int(options['sock-buf']) \
+                            if 'sock-buf' in options else None)
+                elif mode == 'send':
+                    send(filename, sender_addr, recvr_addr,
+                        window_size=int(options.get('window',1)),
+                        integrity_mode=IntegrityMode[
+                            options.get('integrity','crc32')],
+                        chunk_size=file_chunk_size \
+                            if options.get('chunk-size','auto') == 'auto' \
+                            else int(options['chunk-size']),
+                        probe_mtu=options.get('chunk-size') == 'auto',
+                        batch_size=int(options.get('batch',64)),
+                        sock_buffer_size=int(options['sock-buf']) \
+                            if 'sock-buf' in options else None,
+                        rate=options.get('rate') if options.get('rate') in \
+                            (None,'auto') else parse_rate(options['rate']),
+                        fec_group_size=int(options.get('fec',0)),
+                        streams=int(options.get('streams',1)),
+                        delta=options.get('delta',False),
+                        compression_mode=CompressionMode[
+                            options.get('compression','none')],
+                        ack_mode=AckMode[options.get('ack','sack')])
+                elif mode == 'recv':
+                    recv(filename, sender_addr, recvr_addr,
+                        batch_size=int(options.get('batch',64)),
+                        sock_buffer_size=int(options['sock-buf']) \
+                            if 'sock-buf' in options else None)
+            finally:
+                stop_metrics_export()
         except Exception as e:
             # print(f'Incorrect arguments')
             print(e)
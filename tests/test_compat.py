@@ -0,0 +1,76 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Returns the source of file_transfer.py as of the first commit, or
+# None if the git history isn't there.
+def baseline_source():
+    try:
+        root_commit = subprocess.run(
+            ['git','rev-list','--max-parents=0','HEAD'],cwd=package_dir,
+            capture_output=True,text=True,check=True).stdout.split()[-1]
+        return subprocess.run(
+            ['git','show',f'{root_commit}:file_transfer.py'],
+            cwd=package_dir,capture_output=True,text=True,
+            check=True).stdout
+    except (OSError,subprocess.CalledProcessError,IndexError):
+        return None
+
+def free_port():
+    sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1',0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class BaselineSenderTest(unittest.TestCase):
+    # The first version's sender sends one chunk at a time, and takes a
+    # FilePktAck for the last chunk as the go ahead to send one more.
+    def test_baseline_send(self):
+        source = baseline_source()
+        if source is None:
+            self.skipTest('git history not available')
+        with tempfile.TemporaryDirectory() as dir_path:
+            baseline_path = os.path.join(dir_path,'baseline_ft.py')
+            with open(baseline_path,'w') as f:
+                f.write(source)
+            src_path = os.path.join(dir_path,'src')
+            dst_path = os.path.join(dir_path,'dst')
+            with open(src_path,'wb') as f:
+                f.write(os.urandom(50000))
+            sender_port, recvr_port = free_port(), free_port()
+            # The baseline sends SendReq only once, so the receiver's
+            # socket is bound before the sender starts.
+            recv_process = subprocess.Popen([sys.executable,'-c',
+                'import socket, file_transfer as ft\n'
+                'sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)\n'
+                f'sock.bind(("127.0.0.1",{recvr_port}))\n'
+                'print("ready",flush=True)\n'
+                f'result = ft.recv({dst_path!r},("127.0.0.1",{sender_port}),'
+                f'("127.0.0.1",{recvr_port}),sock=sock,linger=False)\n'
+                'assert result.ok\n'],cwd=package_dir,
+                stdout=subprocess.PIPE,stderr=subprocess.PIPE,text=True)
+            try:
+                self.assertEqual(recv_process.stdout.readline().strip(),
+                    'ready')
+                send_result = subprocess.run([sys.executable,baseline_path,
+                    'send',src_path,f'127.0.0.1:{sender_port}',
+                    f'127.0.0.1:{recvr_port}'],capture_output=True,
+                    text=True,timeout=60)
+                self.assertEqual(recv_process.wait(timeout=60),0,
+                    recv_process.stderr.read())
+            finally:
+                recv_process.kill()
+                recv_process.stdout.close()
+                recv_process.stderr.close()
+            self.assertIn('Transfer successful',send_result.stdout)
+            with open(src_path,'rb') as src_f, open(dst_path,'rb') as dst_f:
+                self.assertEqual(src_f.read(),dst_f.read())
+
+if __name__ == '__main__':
+    unittest.main()
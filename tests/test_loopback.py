@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each case runs in a fresh interpreter, so the lazily imported modules
+# are used for the first time by the loopback's two threads at once.
+def run_fresh(code):
+    return subprocess.run([sys.executable,'-c',code],cwd=package_dir,
+        capture_output=True,text=True,timeout=60)
+
+class LoopbackTest(unittest.TestCase):
+    def test_bytes(self):
+        result = run_fresh(
+            'import os, file_transfer as ft\n'
+            'data = os.urandom(300000)\n'
+            'result = ft.loopback(data,window_size=64)\n'
+            'assert result.ok and result.data == data\n'
+            'print("ok")\n')
+        self.assertEqual(result.returncode,0,result.stderr)
+        self.assertEqual(result.stdout.strip(),'ok')
+
+    def test_path(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            src_path = os.path.join(dir_path,'src')
+            dst_path = os.path.join(dir_path,'dst')
+            with open(src_path,'wb') as f:
+                f.write(os.urandom(300000))
+            result = run_fresh(
+                'import file_transfer as ft\n'
+                f'result = ft.loopback({src_path!r},{dst_path!r},'
+                'window_size=64)\n'
+                'assert result.ok\n'
+                'print("ok")\n')
+            self.assertEqual(result.returncode,0,result.stderr)
+            self.assertEqual(result.stdout.strip(),'ok')
+            with open(src_path,'rb') as src_f, open(dst_path,'rb') as dst_f:
+                self.assertEqual(src_f.read(),dst_f.read())
+
+if __name__ == '__main__':
+    unittest.main()